@@ -62,6 +62,14 @@ from hfoscsp.file_management import list_lamp
 from hfoscsp.file_management import list_object
 # from hfoscsp.file_management import setccd
 from hfoscsp.file_management import SetCCD
+from hfoscsp.file_management import KEYWORDS
+from hfoscsp.catalog import FrameCatalog
+from hfoscsp.inventory import Inventory
+from hfoscsp.library import CalibrationLibrary
+from hfoscsp.crcache import ResultCache
+from hfoscsp.library import night_date
+from hfoscsp.badpixel import detector_mask
+from hfoscsp.association import CalibrationIndex
 
 from hfoscsp.reduction import ccdsec_removal
 from hfoscsp.reduction import bias_correction
@@ -73,12 +81,14 @@ from hfoscsp.reduction import flux_calibrate
 from hfoscsp.cosmicray import cosmic_correction_individual
 from hfoscsp.cosmicray import cosmic_correction_batch
 from hfoscsp.cosmicray import cosmic_correction
+from hfoscsp.cosmicray import display_co
 
 from hfoscsp.headercorrection import headercorr
 from hfoscsp.interactive import options
 from hfoscsp.interactive import multioptions
 from hfoscsp.plotspec import spectral_plot
 from hfoscsp.batch import batch_fuc
+from hfoscsp.multinight import reduce_nights
 from hfoscsp.headercorrection import headercorr_k
 
 # --------------------------------------------------------------------------- #
@@ -108,7 +118,7 @@ bar = """
 """
 
 
-def part1(CCD):
+def part1(CCD, catalog=None, folder_name=None, inventory=None, library=None):
     """Part one - wavelength calibration."""
     # Backing up the whole directory
     # Backup (BACKUP)
@@ -126,48 +136,73 @@ def part1(CCD):
     choices = ['Yes']
     options(message, choices)
 
-    PATH = os.path.join(os.getcwd(), list_subdir()[0])
-    folder_name = list_subdir()[0]
+    if folder_name is None:
+        folder_name = list_subdir()[0]
+    PATH = os.path.join(os.getcwd(), folder_name)
     print(folder_name)
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    # Folder is listed once, every step below reports the files it changes.
+    if inventory is None:
+        inventory = Inventory(PATH)
+    list_files = inventory.search('*.fits')
     # print list_files
 
+    # Headers of the night are read once and shared by every step below.
+    if catalog is None:
+        catalog = FrameCatalog(location=PATH, persistent=True)
+    catalog.refresh(list_files)
+
     # Separating photometric and spectroscopic files
-    speclist, photlist = spec_or_phot(list_files, PATH, CCD, 'spec')
+    speclist, photlist = spec_or_phot(list_files, PATH, CCD, 'spec',
+                                      catalog=catalog)
     # file_list is updated from passing list
     # print (speclist)
 
     # Running bias corrections
-    bias_list, passing_list = list_bias(speclist, PATH)
+    bias_list, passing_list = list_bias(speclist, PATH, catalog=catalog)
     # print(bias_list)
+    # Master-bias of a nearby night is used if this night has no bias.
+    if library is None:
+        library = CalibrationLibrary()
+    date = night_date(speclist, catalog)
     if len(bias_list) == 0:
-        sys.exit('Bias list is empty, please check header of bias files')
+        if not library.has_master('bias', CCD.profile.mode, date):
+            sys.exit('Bias list is empty, please check header of bias files')
+        print('Bias list is empty, master-bias is taken from the library')
     # print (passing_list)
 
     # Running bias corrections
-    bias_correction(bias_list, passing_list, CCD, PATH)
-    list_files = search_files(location=folder_name, keyword='*.fits')
-    ccdsec_removal(file_list=list_files, location=PATH)
+    bias_correction(bias_list, passing_list, CCD, PATH, inventory=inventory,
+                    library=library, date=date)
+    list_files = inventory.search('*.fits')
+    ccdsec_removal(file_list=catalog.selected(list_files),
+                   location=PATH)
 
     # Running cosmic ray corrections
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    catalog.refresh(list_files)
     # print list_files
-    obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(list_files,
-                                                                     PATH)
-    flat_list, flat_list_gr7, flat_list_gr8, passing_list = list_flat(list_files,
-                                                                      PATH)
+    obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(
+        list_files, PATH, catalog=catalog)
+    flat_list, flat_list_gr7, flat_list_gr8, passing_list = list_flat(
+        list_files, PATH, catalog=catalog)
     # cosmic_curr_list = list(set(obj_list).union(flat_list))
     # file which needed to correct for cosmic ray
     cosmic_curr_list = obj_list  # file which needed to correct for cosmic ray
     cosmic_curr_list_flats = flat_list
     print(len(cosmic_curr_list))
+    # Bad-pixel mask of the detector, made once from the master-bias and flats
+    mask = detector_mask(library, CCD.profile.mode,
+                         os.path.join(PATH, 'Backup', 'master-bias.fits'),
+                         [os.path.join(PATH, file) for file in flat_list])
+
     write_list(file_list=cosmic_curr_list, file_name='cosmic_curr_list',
                location=PATH)
 
-    cr_check_list = cosmic_correction(cosmic_curr_list_flats, location=PATH)
+    cr_check_list = cosmic_correction(cosmic_curr_list_flats, location=PATH,
+                                      inventory=inventory)
 
     for file in cr_check_list:
         remove_file(str(file))
+    inventory.update(removed=cr_check_list)
 
     # cosmic-ray correction manually for individual files
     # or all files automatically
@@ -175,23 +210,37 @@ def part1(CCD):
     choices = ['Default', 'Manually']
     input = options(message, choices)
 
+    # results of earlier reductions of the night are reused
+    cache = ResultCache()
     if input.lower() == 'manually':
         cr_check_list = cosmic_correction_individual(cosmic_curr_list, CCD=CCD,
-                                                     location=PATH)
+                                                     location=PATH,
+                                                     inventory=inventory,
+                                                     mask=mask, cache=cache)
     else:
         cr_check_list = cosmic_correction_batch(cosmic_curr_list, CCD=CCD,
-                                                location=PATH)
+                                                location=PATH,
+                                                inventory=inventory,
+                                                mask=mask, workers=None,
+                                                cache=cache)
+    cache.close()
 
     # Stop running code for checking the cosmic ray corrected files
-    print("Cosmic ray correction is done. Please check chk files then continue")
-
-    # raw_input("Press Enter to continue...")  # Python 2
-    message = "Do you want to continue ?"
-    choices = ['Yes']
-    options(message, choices)
+    # residuals are made from the cosmic-ray masks when they are viewed
+    message = """Cosmic ray correction is done.
+Do you want to check chk files then continue?"""
+    choices = ['Yes', 'No']
+    if options(message, choices) == 'Yes':
+        display_co(image_list=cosmic_curr_list, location=PATH)
 
     for file in cr_check_list:
         remove_file(str(file))
+    inventory.update(removed=cr_check_list)
+
+    # Time index of lamps and flats for flat-correction and spectral extraction
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
+    association = CalibrationIndex(list_files, catalog, KEYWORDS)
 
     # ---------------------------flat-correction----------------------------- #
     if str(flat_flag).lower() == 'no':
@@ -199,28 +248,35 @@ def part1(CCD):
         print("No flat fielding")
     elif str(flat_flag).lower() == 'yes':
         # Making file list for flat-correction
-        list_files = search_files(location=folder_name, keyword='*.fits')
-        obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(list_files, PATH)
-        flat_list, flat_list_gr7, flat_list_gr8, passing_list = list_flat(list_files, PATH)
+        obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(
+            list_files, PATH, catalog=catalog)
+        flat_list, flat_list_gr7, flat_list_gr8, passing_list = list_flat(
+            list_files, PATH, catalog=catalog)
         # Flat correction using file lists made.
 
         flat_curr_list = flat_correction(flat_list=flat_list_gr8,
                                          file_list=obj_list_gr8, grism='gr8',
                                          CCD=CCD,
-                                         location=PATH, prefix_string='f')
+                                         location=PATH, prefix_string='f',
+                                         association=association,
+                                         inventory=inventory, mask=mask)
         print("Flat correction grism 8 is done.", flat_curr_list)
 
         flat_curr_list = flat_correction(flat_list=flat_list_gr7,
                                          file_list=obj_list_gr7, grism='gr7',
                                          CCD=CCD,
-                                         location=PATH, prefix_string='f')
+                                         location=PATH, prefix_string='f',
+                                         association=association,
+                                         inventory=inventory, mask=mask)
         print("Flat correction grism 7 is done.", flat_curr_list)
 
     # making list for spectral extraction and wavelength calibration
-    list_files = search_files(location=folder_name, keyword='*.fits')
-    obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(list_files,
-                                                                     PATH)
-    lamp_list_gr7, lamp_list_gr8, passing_list = list_lamp(list_files, PATH)
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
+    obj_list, obj_list_gr7, obj_list_gr8, passing_list = list_object(
+        list_files, PATH, catalog=catalog)
+    lamp_list_gr7, lamp_list_gr8, passing_list = list_lamp(
+        list_files, PATH, catalog=catalog)
 
     message = "Press Enter for spectral_extraction and wavelength calibration.."
     choices = ['Yes']
@@ -228,15 +284,19 @@ def part1(CCD):
 
     # Running spectral_extraction function using file lists made
     spectral_extraction(obj_list=obj_list_gr7, lamp_list=lamp_list_gr7,
-                        location=PATH, CCD=CCD, grism='gr7')
+                        location=PATH, CCD=CCD, grism='gr7',
+                        association=association, inventory=inventory,
+                        mask=mask)
 
     spectral_extraction(obj_list=obj_list_gr8, lamp_list=lamp_list_gr8,
-                        location=PATH, CCD=CCD, grism='gr8')
+                        location=PATH, CCD=CCD, grism='gr8',
+                        association=association, inventory=inventory,
+                        mask=mask)
 
     print("Wavelength calibration of spectra is done")
 
 
-def part2(folder_name, PATH, CCD):
+def part2(folder_name, PATH, CCD, catalog=None, inventory=None):
     print(PATH)
     print(folder_name)
 
@@ -245,21 +305,30 @@ def part2(folder_name, PATH, CCD):
     choices = ['Yes']
     options(message, choices)
 
+    if inventory is None:
+        inventory = Inventory(PATH)
+
     # Header correction
-    list_files = search_files(location=folder_name, keyword='*.ms.fits')
+    list_files = inventory.search('*.ms.fits')
     headercorr(file_list=list_files, location=folder_name)
 
     # Running Flux calibration
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    list_files = inventory.search('*.fits')
     print(list_files)
 
-    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(list_files, PATH)
+    if catalog is None:
+        catalog = FrameCatalog(location=PATH, persistent=True)
+    catalog.refresh(list_files)
+    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(
+        list_files, PATH, catalog=catalog)
     print(obj_list_gr7)
     flux_calibrate(obj_list=obj_list_gr8, location=PATH,
                    default_path=default_path, CCD=CCD)
 
     flux_calibrate(obj_list=obj_list_gr7, location=PATH,
                    default_path=default_path, CCD=CCD)
+    # standard, sensfunc and calibrate outputs are not reported
+    inventory.scan()
 
 
 def b_headercorr(folder_name):
@@ -283,12 +352,19 @@ def main():
     print(logo)
 
     print("Current working directory :", working_dir_path)
-    PATH = os.path.join(os.getcwd(), list_subdir()[0])
-    folder_name = list_subdir()[0]
+    nights = list_subdir()
+    folder_name = nights[0]
+    if len(nights) > 1:
+        message = "Select the night folder"
+        folder_name = options(message, nights)
+    PATH = os.path.join(os.getcwd(), folder_name)
 
-    list_files_ccdcheck = search_files(location=folder_name, keyword='*.fits')
+    inventory = Inventory(PATH)
+    library = CalibrationLibrary()
+    list_files_ccdcheck = inventory.search('*.fits')
 
-    CCD = SetCCD(file_list=list_files_ccdcheck, location=PATH)
+    catalog = FrameCatalog(list_files_ccdcheck, PATH, persistent=True)
+    CCD = SetCCD(file_list=list_files_ccdcheck, location=PATH, catalog=catalog)
 
     A = True
     while A is True:
@@ -296,19 +372,24 @@ def main():
         message = "Select the mode of running the Pipeline"
         choices = ['Batch-wise operation', 'Complete Code',
                    'Only Flux Calibration',
-                   'Plot spectra', 'Header correction', 'Quit']
+                   'Plot spectra', 'Header correction',
+                   'All nights (bias and cosmic-ray)', 'Quit']
         input = options(message, choices)
 
         if input == 'Batch-wise operation':
-            batch_fuc(CCD=CCD)
+            batch_fuc(CCD=CCD, catalog=catalog, folder_name=folder_name,
+                      inventory=inventory, library=library)
 
         elif input == 'Complete Code':
-            part1(CCD=CCD)
+            part1(CCD=CCD, catalog=catalog, folder_name=folder_name,
+                  inventory=inventory, library=library)
             os.chdir(working_dir_path)
-            part2(folder_name=folder_name, PATH=PATH, CCD=CCD)
+            part2(folder_name=folder_name, PATH=PATH, CCD=CCD,
+                  catalog=catalog, inventory=inventory)
 
         elif input == 'Only Flux Calibration':
-            part2(folder_name=folder_name, PATH=PATH, CCD=CCD)
+            part2(folder_name=folder_name, PATH=PATH, CCD=CCD,
+                  catalog=catalog, inventory=inventory)
             os.chdir(working_dir_path)
 
         elif input == 'Plot spectra':
@@ -323,6 +404,15 @@ def main():
         elif input == 'Header correction':
             b_headercorr(folder_name)
 
+        elif input == 'All nights (bias and cosmic-ray)':
+            message = "Select the cosmic ray correction module"
+            # IRAF modules can not run in the nights side by side
+            choices = ['None', 'la_cosmic']
+            method = options(message, choices)
+            if method == 'None':
+                method = None
+            reduce_nights(cosmic_method=method)
+
         elif input == 'Quit':
             A = False
 
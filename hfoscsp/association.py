@@ -0,0 +1,185 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the calibration association index. Lamps and flats of a
+night are kept in time order for each grism and aperture, and every science
+frame is matched to the calibration frame taken nearest in time by bisection.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import bisect
+import datetime
+import numpy as np
+
+from hfoscsp.classify import FrameType
+from hfoscsp.classify import classify_frames
+from hfoscsp.classify import GR7, GR8
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Grism of the lamp frames, FeAr for grism 7 and FeNe for grism 8.
+LAMP_GRISM = {FrameType.LAMP_FEAR: GR7, FrameType.LAMP_FENE: GR8}
+
+GRISM_CODE = {'gr7': GR7, 'gr8': GR8}
+
+
+def _seconds(date, time=''):
+    """Seconds since EPOCH from 'YYYY-MM-DD' and 'HH:MM:SS[.sss]' strings."""
+    day = datetime.datetime.strptime(date.strip()[:10], '%Y-%m-%d')
+    seconds = (day - EPOCH).total_seconds()
+    if time.strip() != '':
+        hms = time.strip().split(':')
+        seconds += int(hms[0])*3600 + int(hms[1])*60 + float(hms[2])
+    return seconds
+
+
+def frame_time(row):
+    """
+    Time of observation of a frame from its catalog row.
+
+    Parameters
+    ----------
+        row : dict
+            Catalog row of the frame.
+    Returns
+    -------
+        time: float
+            Seconds since 1970-01-01 (UT), None if the header has no time.
+    """
+    try:
+        # HFOSC2
+        if str(row['DATE-AVG']).strip() != '':
+            date_time = str(row['DATE-AVG']).split('T')
+            return _seconds(date_time[0], date_time[1])
+
+        # HFOSC (TM_START is seconds from the start of DATE-OBS)
+        date_obs = str(row['DATE-OBS'])
+        if str(row['TM_START']).strip() != '':
+            return _seconds(date_obs) + float(row['TM_START'])
+        if 'T' in date_obs:
+            date_time = date_obs.split('T')
+            return _seconds(date_time[0], date_time[1])
+        return _seconds(date_obs)
+    except (ValueError, IndexError):
+        return None
+
+
+class CalibrationIndex:
+    """Time index of lamp and flat frames for each grism and aperture."""
+
+    def __init__(self, file_list, catalog, keywords):
+        """
+        Build the time index from the frames of a night.
+
+        Parameters
+        ----------
+            file_list: list
+                List of files in the night folder.
+            catalog  : FrameCatalog
+                Catalog containing the files.
+            keywords : dict
+                KEYWORDS dictionary of the file management utilities.
+        """
+        self.catalog = catalog
+        self._index = {}
+
+        frames = classify_frames(file_list, catalog, keywords)
+        for frame in frames:
+            ftype = FrameType(frame['ftype'])
+            if ftype == FrameType.FLAT:
+                kind, grism = 'flat', int(frame['grism'])
+            elif ftype in LAMP_GRISM:
+                kind, grism = 'lamp', LAMP_GRISM[ftype]
+            else:
+                continue
+
+            file = str(frame['file'])
+            row = catalog.row(file)
+            time = frame_time(row)
+            if time is None:
+                time = np.inf  # used only if nothing else is available
+            aperture = str(row['APERTUR']).strip()
+            self._insert((kind, grism, aperture), time, file)
+            self._insert((kind, grism, None), time, file)
+
+    def _insert(self, key, time, file):
+        times, files = self._index.setdefault(key, ([], []))
+        i = bisect.bisect_right(times, time)
+        times.insert(i, time)
+        files.insert(i, file)
+
+    def _bucket(self, kind, grism, aperture):
+        """Calibrations of the same aperture, or of the grism as fall back."""
+        if (kind, grism, aperture) in self._index:
+            return self._index[(kind, grism, aperture)]
+        return self._index.get((kind, grism, None), ([], []))
+
+    def nearest(self, kind, file, grism):
+        """
+        Calibration frame taken nearest in time to a science frame.
+
+        Parameters
+        ----------
+            kind : str ('lamp' or 'flat')
+                Type of calibration.
+            file : str
+                Science frame, it should be in the catalog.
+            grism: str ('gr7' or 'gr8')
+                Grism of the science frame.
+        Returns
+        -------
+            calib: str
+                File name of the calibration frame, None if there is none.
+            dt   : float
+                Time difference in seconds (None if the time is unknown).
+        """
+        row = self.catalog.row(file)
+        times, files = self._bucket(kind, GRISM_CODE[grism],
+                                    str(row['APERTUR']).strip())
+        if len(files) == 0:
+            return None, None
+
+        time = frame_time(row)
+        if time is None:
+            return files[0], None
+
+        i = bisect.bisect_left(times, time)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(files)]
+        j = min(candidates, key=lambda k: abs(times[k] - time))
+        dt = abs(times[j] - time)
+        return files[j], (None if np.isinf(dt) else dt)
+
+    def flat_list(self, grism, file_list):
+        """
+        Flat frames for the science frames of a grism. Flats taken with the\
+        apertures of the science frames are used if there are any, otherwise\
+        all flats of the grism.
+
+        Parameters
+        ----------
+            grism    : str ('gr7' or 'gr8')
+                Type of grism used.
+            file_list: list
+                List of science frames which need flat correction.
+        Returns
+        -------
+            flat_list: list
+                List of flat files.
+        """
+        flats = []
+        for file in file_list:
+            aperture = str(self.catalog.value(file, 'APERTUR')).strip()
+            for flat in self._bucket('flat', GRISM_CODE[grism], aperture)[1]:
+                if flat not in flats:
+                    flats.append(flat)
+        if len(flats) == 0:
+            flats = list(self._index.get(('flat', GRISM_CODE[grism], None),
+                                         ([], []))[1])
+        return flats
+
+# -------------------------------------------------------------------------------------------------------------------- #
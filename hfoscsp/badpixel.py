@@ -0,0 +1,258 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the bad-pixel mask of the detector. Hot pixels and hot
+columns are found in the master-bias, dead and hot pixels in the flats. The
+mask is made once for every instrument mode and kept bit-packed in the
+calibration library. The cosmic-ray, flat and extraction steps use it as a
+boolean array (True for bad pixels), so that the defects are interpolated
+over or left out before cosmic rays are searched.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import numpy as np
+from astropy.io import fits
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+HOT_SIGMA = 8.0        # hot pixels and columns in the master-bias (sigma)
+FLAT_LOW = 0.5         # dead pixels, fraction of the neighbouring pixels
+FLAT_HIGH = 1.5        # hot pixels, fraction of the neighbouring pixels
+COLUMN_FRACTION = 0.3  # a column is bad if this fraction of it is bad
+NEIGHBOURS = 2         # pixels on each side along a line for the flats
+COLUMN_DEGREE = 2      # polynomial of the level of the bias columns
+
+
+def _robust_sigma(values):
+    """Sigma from the median absolute deviation."""
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return 0.0
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def _line_median(data, half_width=NEIGHBOURS):
+    """Median of the neighbouring pixels along every line (centre left out)."""
+    shifted = []
+    for shift in range(-half_width, half_width + 1):
+        if shift == 0:
+            continue
+        shifted.append(np.roll(data, shift, axis=1))
+    return np.median(np.array(shifted), axis=0)
+
+
+def _column_excess(columns, hot_sigma, degree=COLUMN_DEGREE,
+                   iterations=5):
+    """
+    Columns above a smooth level (polynomial fitted with the outlying\
+    columns left out) and the limit of hot_sigma sigma.
+    """
+    position = np.arange(columns.size)
+    good = np.ones(columns.size, dtype=bool)
+    for iteration in range(iterations):
+        level = np.polyval(np.polyfit(position[good], columns[good], degree),
+                           position)
+        excess = columns - level
+        limit = hot_sigma * max(_robust_sigma(excess[good]), 1e-6)
+        new_good = np.abs(excess) <= limit
+        if np.array_equal(new_good, good) or new_good.sum() <= degree:
+            break
+        good = new_good
+    return excess, limit
+
+
+def bias_defects(master_bias, hot_sigma=HOT_SIGMA):
+    """
+    Hot pixels and hot columns of the master-bias.
+
+    Parameters
+    ----------
+        master_bias: numpy.ndarray
+            Master-bias image.
+        hot_sigma  : float
+            Pixels (columns) above hot_sigma sigma from the line (column)
+            level are bad.
+    Returns
+    -------
+        mask       : numpy.ndarray
+            True for bad pixels.
+    """
+    residual = master_bias - np.median(master_bias, axis=1)[:, None]
+    mask = residual > hot_sigma * max(_robust_sigma(residual), 1e-6)
+
+    # hot columns only, above the smooth level of the columns so that cold
+    # columns and gradients of the bias are not taken
+    excess, limit = _column_excess(np.median(residual, axis=0), hot_sigma)
+    bad_columns = excess > limit
+    mask[:, bad_columns] = True
+    return mask
+
+
+def flat_defects(flat, low=FLAT_LOW, high=FLAT_HIGH):
+    """
+    Dead and hot pixels of a flat, compared to the neighbouring pixels along\
+    the line so that the spectral shape of the flat does not matter.
+
+    Parameters
+    ----------
+        flat: numpy.ndarray
+            Median of the flats.
+        low : float
+            Pixels below this fraction of their neighbours are bad.
+        high: float
+            Pixels above this fraction of their neighbours are bad.
+    Returns
+    -------
+        mask: numpy.ndarray
+            True for bad pixels.
+    """
+    local = _line_median(flat)
+    # only the illuminated part of the flat is used
+    illuminated = local > 0.1 * np.percentile(local, 95)
+    ratio = np.ones(flat.shape, dtype=np.float32)
+    ratio[illuminated] = flat[illuminated] / local[illuminated]
+    return illuminated & ((ratio < low) | (ratio > high))
+
+
+def build_mask(master_bias, flat_list=(), index=0,
+               column_fraction=COLUMN_FRACTION):
+    """
+    Bad-pixel mask from the master-bias and the flats.
+
+    Parameters
+    ----------
+        master_bias    : str
+            Master-bias with complete path.
+        flat_list      : list
+            Bias corrected flats with complete path.
+        index          : int
+            HDU containing the image of the flats.
+        column_fraction: float
+            Columns with more bad pixels than this fraction are bad.
+    Returns
+    -------
+        mask           : numpy.ndarray
+            True for bad pixels.
+    """
+    bias = fits.getdata(master_bias).astype(np.float32)
+    mask = bias_defects(bias)
+
+    flats = []
+    for file_name in flat_list:
+        data = fits.getdata(file_name, index).astype(np.float32)
+        if data.shape == mask.shape:
+            flats.append(data)
+    if len(flats) != 0:
+        mask |= flat_defects(np.median(np.array(flats), axis=0))
+
+    bad_columns = mask.mean(axis=0) > column_fraction
+    mask[:, bad_columns] = True
+    return mask
+
+
+def save_mask(mask, file_name):
+    """Write the mask bit-packed (one bit for each pixel)."""
+    # written under a temporary name, nights reduced in parallel may read it
+    temp_name = file_name + '.' + str(os.getpid())
+    with open(temp_name, 'wb') as f:
+        np.savez_compressed(f, bits=np.packbits(mask.ravel()),
+                            shape=np.array(mask.shape))
+    os.replace(temp_name, file_name)
+
+
+def load_mask(file_name):
+    """Read a mask written by save_mask()."""
+    with np.load(file_name) as saved:
+        shape = tuple(saved['shape'])
+        size = int(np.prod(shape))
+        return np.unpackbits(saved['bits'])[:size].reshape(shape).astype(bool)
+
+
+def detector_mask(library, mode, master_bias=None, flat_list=(), index=0):
+    """
+    Bad-pixel mask of an instrument mode from the calibration library. The\
+    mask is made and stored if it is not in the library and a master-bias is\
+    given.
+
+    Parameters
+    ----------
+        library    : CalibrationLibrary
+            Calibration library.
+        mode       : tuple
+            (instrument, binning, readout) of the frames.
+        master_bias: str
+            Master-bias with complete path.
+        flat_list  : list
+            Bias corrected flats with complete path.
+        index      : int
+            HDU containing the image of the flats.
+    Returns
+    -------
+        mask       : numpy.ndarray
+            True for bad pixels, None if there is no mask.
+    """
+    if library is None:
+        return None
+    file_name = library.mask_file(mode)
+    if os.path.isfile(file_name):
+        return load_mask(file_name)
+    if master_bias is None or not os.path.isfile(master_bias):
+        return None
+
+    mask = build_mask(master_bias, flat_list, index=index)
+    save_mask(mask, file_name)
+    print("Bad-pixel mask : {} pixels, {} columns ({})".format(
+        int(mask.sum()), int(mask.all(axis=0).sum()),
+        os.path.basename(file_name)))
+    return mask
+
+
+def fix_bad_pixels(data, mask):
+    """
+    Interpolate over the bad pixels along every line, in place.
+
+    Parameters
+    ----------
+        data: numpy.ndarray
+            Image, float.
+        mask: numpy.ndarray
+            True for bad pixels.
+    Returns
+    -------
+        data: numpy.ndarray
+    """
+    columns = np.arange(data.shape[1])
+    for line in np.nonzero(mask.any(axis=1))[0]:
+        bad = mask[line]
+        if bad.all():
+            continue
+        data[line, bad] = np.interp(columns[bad], columns[~bad],
+                                    data[line, ~bad])
+    return data
+
+
+def fix_file(file_name, mask, index=0):
+    """
+    Interpolate over the bad pixels of a fits file, in place.
+
+    Returns
+    -------
+        fixed: bool
+            False if the image size is different from the mask.
+    """
+    with fits.open(file_name, mode='update') as hdu_list:
+        data = hdu_list[index].data
+        if data is None or data.shape != mask.shape:
+            print("Bad-pixel mask is not used for " +
+                  os.path.basename(file_name))
+            return False
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float32)
+        hdu_list[index].data = fix_bad_pixels(data, mask)
+    return True
+
+# -------------------------------------------------------------------------------------------------------------------- #
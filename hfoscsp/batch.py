@@ -31,6 +31,14 @@ from hfoscsp.file_management import list_lamp
 from hfoscsp.file_management import list_object
 # from hfoscsp.file_management import setccd
 # from hfoscsp.file_management import SetCCD
+from hfoscsp.file_management import KEYWORDS
+from hfoscsp.catalog import FrameCatalog
+from hfoscsp.inventory import Inventory
+from hfoscsp.library import CalibrationLibrary
+from hfoscsp.crcache import ResultCache
+from hfoscsp.library import night_date
+from hfoscsp.badpixel import detector_mask
+from hfoscsp.association import CalibrationIndex
 
 from hfoscsp.reduction import ccdsec_removal
 from hfoscsp.reduction import bias_correction
@@ -119,41 +127,75 @@ def list_sub(location=''):
     return sub_directories
 
 
-def b_bias(folder_name, PATH, CCD):
+def b_bias(folder_name, PATH, CCD, catalog, inventory, library):
     """Batch-wise bias correction"""
 
-    list_files = search_files(location=folder_name, keyword='*.fits')
-    speclist, photlist = spec_or_phot(list_files, PATH, CCD, 'spec')
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
+    speclist, photlist = spec_or_phot(list_files, PATH, CCD, 'spec',
+                                      catalog=catalog)
     # Check [Errno 17] File exists
-    bias_list, passing_list = list_bias(speclist, PATH)
+    bias_list, passing_list = list_bias(speclist, PATH, catalog=catalog)
     print(bias_list, passing_list)
 
-    bias_correction(bias_list=bias_list, list_file=passing_list, CCD=CCD,
-                    location=PATH, prefix_string='b_')
-    list_files = search_files(location=folder_name, keyword='*.fits')
-    ccdsec_removal(file_list=list_files, location=PATH)
+    date = night_date(speclist, catalog)
+    if len(bias_list) == 0 and \
+            not library.has_master('bias', CCD.profile.mode, date):
+        print('Bias list is empty, please check header of bias files')
+        return
+
+    message = "Select the bias correction engine"
+    choices = ['iraf', 'numpy']
+    method = options(message, choices)
+    workers = 1
+    if method == 'numpy' and (os.cpu_count() or 1) > 1:
+        message = "Number of processes subtracting the master-bias"
+        choices = ['1', str(os.cpu_count())]
+        workers = int(options(message, choices))
 
-
-def b_cosmic(folder_name, PATH, CCD):
+    bias_correction(bias_list=bias_list, list_file=passing_list, CCD=CCD,
+                    location=PATH, prefix_string='b_', inventory=inventory,
+                    method=method, library=library, date=date,
+                    workers=workers)
+    list_files = inventory.search('*.fits')
+    ccdsec_removal(file_list=catalog.selected(list_files),
+                   location=PATH)
+
+    # Bad-pixel mask of the detector, made once from the master-bias and flats
+    catalog.refresh(list_files)
+    flat_list, flat_l_gr7, flat_l_gr8, pas_list = list_flat(list_files, PATH,
+                                                            catalog=catalog)
+    detector_mask(library, CCD.profile.mode,
+                  os.path.join(PATH, 'Backup', 'master-bias.fits'),
+                  [os.path.join(PATH, file) for file in flat_list])
+
+
+def b_cosmic(folder_name, PATH, CCD, catalog, inventory, library):
     """Batch-wise cosmic ray correction"""
 
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
     # print list_files
 
-    obj_list, obj_l_gr7, obj_l_gr8, pas_list = list_object(list_files, PATH)
-    flat_list, f_l_gr7, flat_l_gr8, pas_list = list_flat(list_files, PATH)
+    obj_list, obj_l_gr7, obj_l_gr8, pas_list = list_object(list_files, PATH,
+                                                           catalog=catalog)
+    flat_list, f_l_gr7, flat_l_gr8, pas_list = list_flat(list_files, PATH,
+                                                         catalog=catalog)
     # cosmic_curr_list = list(set(obj_list).union(flat_list))
     # file which needed to correct for cosmic ray
 
     cosmic_curr_list = obj_list  # file which needed to correct for cosmic ray
     cosmic_curr_list_flats = flat_list
     print(len(cosmic_curr_list))
+    mask = detector_mask(library, CCD.profile.mode)
     write_list(file_list=cosmic_curr_list, file_name='cosmic_curr_list',
                location=PATH)
 
-    cr_check_list = cosmic_correction(cosmic_curr_list_flats, location=PATH)
+    cr_check_list = cosmic_correction(cosmic_curr_list_flats, location=PATH,
+                                      inventory=inventory)
     for file in cr_check_list:
         remove_file(str(file))
+    inventory.update(removed=cr_check_list)
 
     # cosmic-ray correction manually for individual files
     # or all files automatically
@@ -161,12 +203,21 @@ def b_cosmic(folder_name, PATH, CCD):
     choices = ['Default', 'Manually']
     input = options(message, choices)
 
+    # results of earlier reductions of the night are reused
+    cache = ResultCache()
     if input.lower() == 'manually':
         cr_check_list = cosmic_correction_individual(cosmic_curr_list,
-                                                     CCD=CCD, location=PATH)
+                                                     CCD=CCD, location=PATH,
+                                                     inventory=inventory,
+                                                     mask=mask, cache=cache)
+        cache.close()
     else:
         cr_check_list = cosmic_correction_batch(cosmic_curr_list, CCD=CCD,
-                                                location=PATH)
+                                                location=PATH,
+                                                inventory=inventory,
+                                                mask=mask, workers=None,
+                                                cache=cache)
+        cache.close()
         print(len(cr_check_list))
         # Stop running code for checking the cosmic ray corrected files
         message = """Cosmic ray correction is done.
@@ -184,34 +235,49 @@ Do you want to check chk files then continue?"""
             #     remove_file(str(file))
 
 
-def b_flat(folder_name, PATH, CCD):
+def b_flat(folder_name, PATH, CCD, catalog, inventory, library):
     """Batch-wise flat correction."""
 
     # Making file list for flat-correction
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
 
-    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(list_files, PATH)
-    flt_lst, flat_list_gr7, flat_list_gr8, pas_lst = list_flat(list_files, PATH)
+    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(
+        list_files, PATH, catalog=catalog)
+    flt_lst, flat_list_gr7, flat_list_gr8, pas_lst = list_flat(
+        list_files, PATH, catalog=catalog)
+    association = CalibrationIndex(list_files, catalog, KEYWORDS)
+    mask = detector_mask(library, CCD.profile.mode)
 
     # Flat correction using file lists made.
     flat_curr_list = flat_correction(flat_list=flat_list_gr8,
                                      file_list=obj_list_gr8, grism='gr8',
-                                     CCD=CCD, location=PATH, prefix_string='f')
+                                     CCD=CCD, location=PATH, prefix_string='f',
+                                     association=association,
+                                     inventory=inventory, mask=mask)
 
     print("Flat correction grism 8 is done.", flat_curr_list)
 
     flat_curr_list = flat_correction(flat_list=flat_list_gr7,
                                      file_list=obj_list_gr7, grism='gr7',
-                                     CCD=CCD, location=PATH, prefix_string='f')
+                                     CCD=CCD, location=PATH, prefix_string='f',
+                                     association=association,
+                                     inventory=inventory, mask=mask)
     print("Flat correction grism 7 is done.", flat_curr_list)
 
 
-def b_wave(folder_name, PATH, CCD, default_path):
+def b_wave(folder_name, PATH, CCD, default_path, catalog, inventory,
+           library):
 
     # making list for spectral extraction and wavelength calibration
-    list_files = search_files(location=folder_name, keyword='*.fits')
-    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(list_files, PATH)
-    lamp_list_gr7, lamp_list_gr8, passing_list = list_lamp(list_files, PATH)
+    list_files = inventory.search('*.fits')
+    catalog.refresh(list_files)
+    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(
+        list_files, PATH, catalog=catalog)
+    lamp_list_gr7, lamp_list_gr8, passing_list = list_lamp(
+        list_files, PATH, catalog=catalog)
+    association = CalibrationIndex(list_files, catalog, KEYWORDS)
+    mask = detector_mask(library, CCD.profile.mode)
 
     message = "Press Enter for spectral_extraction and wavelength calibration.."
     choices = ['Yes']
@@ -219,16 +285,20 @@ def b_wave(folder_name, PATH, CCD, default_path):
 
     # Running spectral_extraction function using file lists made
     spectral_extraction(obj_list=obj_list_gr7, lamp_list=lamp_list_gr7,
-                        location=PATH, CCD=CCD, grism='gr7')
+                        location=PATH, CCD=CCD, grism='gr7',
+                        association=association, inventory=inventory,
+                        mask=mask)
 
     spectral_extraction(obj_list=obj_list_gr8, lamp_list=lamp_list_gr8,
-                        location=PATH, CCD=CCD, grism='gr8')
+                        location=PATH, CCD=CCD, grism='gr8',
+                        association=association, inventory=inventory,
+                        mask=mask)
 
     print("Wavelength calibration of spectra is done")
     os.chdir(default_path)
 
 
-def b_flux(folder_name, PATH, CCD, default_path):
+def b_flux(folder_name, PATH, CCD, default_path, catalog, inventory):
 
     # raw_input("Press Enter for Flux_Calibration...") # Python 2
     message = "Press Enter for Flux_Calibration..."
@@ -236,19 +306,23 @@ def b_flux(folder_name, PATH, CCD, default_path):
     options(message, choices)
 
     # Header correction
-    list_files = search_files(location=folder_name, keyword='*.ms.fits')
+    list_files = inventory.search('*.ms.fits')
     headercorr(file_list=list_files, location=folder_name)
 
     # Running Flux calibration
-    list_files = search_files(location=folder_name, keyword='*.fits')
+    list_files = inventory.search('*.fits')
     print(list_files)
+    catalog.refresh(list_files)
 
-    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(list_files, PATH)
+    obj_lst, obj_list_gr7, obj_list_gr8, pas_lst = list_object(
+        list_files, PATH, catalog=catalog)
     print(obj_list_gr7)
     flux_calibrate(obj_list=obj_list_gr8, location=PATH,
                    default_path=default_path, CCD=CCD)
     flux_calibrate(obj_list=obj_list_gr7, location=PATH,
                    default_path=default_path, CCD=CCD)
+    # standard, sensfunc and calibrate outputs are not reported
+    inventory.scan()
     print("OK")
 
 
@@ -328,12 +402,20 @@ def b_headercorr(folder_name):
     headercorr_k(file_list=list_files, location=folder_name)
 
 
-def batch_fuc(CCD):
+def batch_fuc(CCD, catalog=None, folder_name=None, inventory=None,
+              library=None):
     """Main function of batch operations."""
     batch_q()
     default_path = os.getcwd()
-    PATH = os.path.join(os.getcwd(), list_subdir()[0])
-    folder_name = list_subdir()[0]
+    if folder_name is None:
+        folder_name = list_subdir()[0]
+    PATH = os.path.join(os.getcwd(), folder_name)
+    if catalog is None:
+        catalog = FrameCatalog(location=PATH, persistent=True)
+    if inventory is None:
+        inventory = Inventory(PATH)
+    if library is None:
+        library = CalibrationLibrary()
     # print("default_path :", default_path)
     print("folder_name :", folder_name)
     # print("PATH :", PATH)
@@ -349,21 +431,23 @@ def batch_fuc(CCD):
         input = options(message, choices)
 
         if input == 'Bias correction':
-            b_bias(folder_name, PATH, CCD)
+            b_bias(folder_name, PATH, CCD, catalog, inventory, library)
         elif input == 'Cosmic-ray correction':
-            b_cosmic(folder_name, PATH, CCD)
+            b_cosmic(folder_name, PATH, CCD, catalog, inventory, library)
         elif input == 'Flat correction':
-            b_flat(folder_name, PATH, CCD)
+            b_flat(folder_name, PATH, CCD, catalog, inventory, library)
         elif input == 'Wavelength calibration':
-            b_wave(folder_name, PATH, CCD, default_path)
+            b_wave(folder_name, PATH, CCD, default_path, catalog, inventory,
+                   library)
         elif input == 'Flux calibration':
-            b_flux(folder_name, PATH, CCD, default_path)
+            b_flux(folder_name, PATH, CCD, default_path, catalog, inventory)
         elif input == 'Plot tools':
             b_plots(folder_name, PATH, default_path)
         elif input == 'Backup':
             b_backup(pathloc=PATH)
         elif input == 'Restore':
             b_restore(pathloc=PATH)
+            inventory.scan()
         elif input == 'Header correction':
             b_headercorr(folder_name)
         elif input == 'Quit':
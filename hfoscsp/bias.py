@@ -0,0 +1,191 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the bias subtraction. The master-bias is read once and every
+frame is memory mapped, scaled and subtracted in float32 in a reused buffer and
+written as a single image, without starting an IRAF task for each frame.
+Frames can be shared among worker processes, each with its own master-bias
+and buffer.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from hfoscsp.combine import frame_header
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Frames given to a worker process at a time.
+CHUNK_SIZE = 8
+
+# State of a worker process, see _init_worker().
+_worker = {}
+
+
+def read_master(master_bias):
+    """Image of the master-bias as float32."""
+    if isinstance(master_bias, np.ndarray):
+        return master_bias.astype(np.float32, copy=False)
+    with fits.open(master_bias, memmap=False) as hdu_list:
+        return np.asarray(hdu_list[0].data, dtype=np.float32)
+
+
+def _subtract_frame(file_name, output_file_name, master, buffer, index):
+    """Subtract the master-bias from a single frame using the buffer."""
+    # Raw integers are memory mapped and scaled into the buffer.
+    with fits.open(file_name, memmap=True,
+                   do_not_scale_image_data=True) as hdu_list:
+        hdu = hdu_list[index]
+        if hdu.data.shape != master.shape:
+            raise ValueError("Image size of " + os.path.basename(file_name) +
+                             " is different from the master-bias")
+        np.copyto(buffer, hdu.data, casting='unsafe')
+        bscale = hdu.header.get('BSCALE', 1.0)
+        bzero = hdu.header.get('BZERO', 0.0)
+        if bscale != 1.0:
+            buffer *= bscale
+        if bzero != 0.0:
+            buffer += bzero
+        buffer -= master
+        header = frame_header(hdu_list, index)
+
+    header.add_history('Bias corrected with master-bias')
+    fits.PrimaryHDU(buffer, header=header).writeto(output_file_name,
+                                                   overwrite=True)
+
+
+def _init_worker(master_bias, index):
+    """Read the master-bias and make the buffer of a worker process."""
+    _worker['master'] = read_master(master_bias)
+    _worker['buffer'] = np.empty(_worker['master'].shape, dtype=np.float32)
+    _worker['index'] = index
+
+
+def _work(files):
+    """Subtract the master-bias from a frame in a worker process."""
+    _subtract_frame(files[0], files[1], _worker['master'], _worker['buffer'],
+                    _worker['index'])
+    return files[1]
+
+
+def subtract_bias(file_list, master_bias, output_list, index=0, workers=1):
+    """
+    Subtract the master-bias from frames.
+
+    Parameters
+    ----------
+        file_list  : list
+            List of frames with complete path.
+        master_bias: str or numpy.ndarray
+            Master-bias file with complete path, or its image.
+        output_list: list
+            Names of the bias corrected frames with complete path, in the
+            order of file_list.
+        index      : int
+            HDU containing the image (1 for HFOSC2).
+        workers    : int
+            Number of worker processes, all CPUs if None. Every output
+            depends only on its own frame, so the outputs are the same for
+            any number of workers.
+    Returns
+    -------
+        none
+    """
+    start = time.time()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(int(workers), len(file_list)), 1)
+
+    if workers == 1:
+        master = read_master(master_bias)
+        buffer = np.empty(master.shape, dtype=np.float32)
+        for file_name, output_file_name in zip(file_list, output_list):
+            _subtract_frame(file_name, output_file_name, master, buffer, index)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(master_bias, index)) as executor:
+            list(executor.map(_work, list(zip(file_list, output_list)),
+                              chunksize=CHUNK_SIZE))
+
+    elapsed = time.time() - start
+    print("Bias corrected {} frames in {:.2f} s ({} workers)".format(
+        len(file_list), elapsed, workers))
+
+
+def benchmark_scaling(n_frames=500, shape=(1024, 1024), workers_list=None,
+                      location=None):
+    """
+    Time subtract_bias on a synthetic night for different numbers of workers\
+    and check that the outputs do not depend on the number of workers.
+
+    Parameters
+    ----------
+        n_frames    : int
+            Number of synthetic frames.
+        shape       : tuple
+            Image size of the frames (lines, columns).
+        workers_list: list
+            Numbers of workers to time, 1 to the number of CPUs if None.
+        location    : str
+            Folder for the synthetic night, a temporary folder if None.
+    Returns
+    -------
+        timing      : list
+            Rows of [workers, time (s), frames/s, speedup].
+    """
+    if workers_list is None:
+        workers_list = list(range(1, (os.cpu_count() or 1) + 1))
+    folder = tempfile.mkdtemp(dir=location)
+    try:
+        rng = np.random.RandomState(0)
+        master = rng.normal(1000.0, 5.0, shape).astype(np.float32)
+        file_list = []
+        for i in range(n_frames):
+            data = rng.normal(1200.0, 30.0, shape).astype(np.int32) - 32768
+            file_name = os.path.join(folder, 'frame{:04d}.fits'.format(i))
+            hdu = fits.PrimaryHDU(data.astype(np.int16))
+            hdu.header['BZERO'] = 32768
+            hdu.writeto(file_name)
+            file_list.append(file_name)
+
+        timing = []
+        reference = None
+        for workers in workers_list:
+            output_list = [os.path.join(folder, 'b_{}_'.format(workers) +
+                                        os.path.basename(file))
+                           for file in file_list]
+            start = time.time()
+            subtract_bias(file_list, master, output_list, workers=workers)
+            elapsed = time.time() - start
+
+            result = [fits.getdata(output_list[0]),
+                      fits.getdata(output_list[-1])]
+            if reference is None:
+                reference = result
+            elif not all(np.array_equal(a, b) for a, b in zip(reference,
+                                                              result)):
+                print("Outputs with {} workers are different".format(workers))
+            for file in output_list:
+                os.remove(file)
+
+            timing.append([workers, round(elapsed, 2),
+                           round(n_frames / elapsed, 1),
+                           round(timing[0][1] / elapsed if timing else 1.0,
+                                 2)])
+    finally:
+        shutil.rmtree(folder)
+
+    print("workers  time (s)  frames/s  speedup")
+    for row in timing:
+        print("{:7d}  {:8.2f}  {:8.1f}  {:7.2f}".format(*row))
+    return timing
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,484 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the frame catalog of a night folder. The header of every
+frame is read only once and the keywords required by the pipeline are kept in
+columns, so that the file management utilities can classify the frames
+without opening the files again.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import time
+import json
+import sqlite3
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
+from hfoscsp.fitsheader import read_headers
+from hfoscsp.instrument import REGISTRY
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Header keywords kept in the catalog, one column for each keyword.
+CATALOG_KEYWORDS = ['OBJECT', 'GRISM', 'LAMP', 'APERTUR', 'NAXIS1', 'NAXIS2',
+                    'INSTRUME', 'EXPTIME', 'DATE-OBS', 'DATE-AVG', 'TM_START',
+                    'COMMENT', 'CCDSUM', 'GAINM', 'FPIX']
+
+# Keywords read from the image extension instead of the primary header.
+IMAGE_KEYWORDS = ['NAXIS1', 'NAXIS2']
+
+# Header index kept in every night folder by the persistent catalog.
+CATALOG_FILE = 'hfoscsp_catalog.sqlite'
+
+# Version of the rows of the header index, rows of an older version are read
+# again (1: NAXIS of the image HDU found by image_index).
+CATALOG_VERSION = 1
+
+# Number of threads reading headers. Header reading on network mounted night
+# folders is bound by I/O latency, not by CPU.
+SCAN_WORKERS = 8
+
+# Values used when a keyword is not present in the header.
+DEFAULTS = {'NAXIS1': 0, 'NAXIS2': 0, 'EXPTIME': 0.0}
+
+
+def image_index(headers):
+    """
+    Index of the HDU containing the image of a frame, the first HDU which is\
+    the primary HDU or an IMAGE extension with NAXIS = 2. Tables such as the\
+    CRMASK extension of cosmic ray corrected frames are skipped.
+
+    Parameters
+    ----------
+        headers: list
+            Headers of the HDUs of the file.
+    Returns
+    -------
+        index  : int
+            Index of the image HDU, 0 if there is none.
+    """
+    for index, header in enumerate(headers):
+        is_image = index == 0 or \
+            str(header.get('XTENSION', '')).strip() == 'IMAGE'
+        if is_image and header.get('NAXIS', 0) == 2:
+            return index
+    return 0
+
+
+def read_frame(file_name):
+    """
+    Read the catalog keywords of a single frame.
+
+    Parameters
+    ----------
+        file_name: str
+            Name of the fits file with complete path.
+    Returns
+    -------
+        row      : dict
+            Catalog keywords and their values.
+    """
+    # Primary header and the first extension (image of HFOSC2) only.
+    headers = read_headers(file_name, max_ext=1)
+    hdr = headers[0]
+    instrument = str(hdr.get('INSTRUME', '')).strip(' ')
+    img_hdr = headers[image_index(headers)]
+
+    row = {}
+    for key in CATALOG_KEYWORDS:
+        source = img_hdr if key in IMAGE_KEYWORDS else hdr
+        value = source.get(key, DEFAULTS.get(key, ''))
+        if not isinstance(value, (str, int, float)):
+            value = str(value)  # e.g. empty header values
+        row[key] = value
+
+    # Only the first COMMENT card is used (grism fall back for HFOSC).
+    try:
+        row['COMMENT'] = str(hdr['COMMENT'][0])
+    except (KeyError, IndexError):
+        row['COMMENT'] = ''
+    row['INSTRUME'] = instrument
+
+    return row
+
+
+class HeaderCache:
+    """
+    Header index of a night folder saved on the disk as a SQLite file.
+
+    Each row keeps the catalog keywords of a frame together with the
+    modification time and size of the file when the header was read, so a
+    header is parsed again only if the file is new or changed.
+    """
+
+    def __init__(self, location='', read_only=False):
+        """
+        Open (or create) the header index in the location provided. A\
+        read_only index must exist and is not changed.
+        """
+        self.file_name = os.path.join(location, CATALOG_FILE)
+        if read_only:
+            self.connection = sqlite3.connect(
+                'file:' + pathname2url(os.path.abspath(self.file_name)) +
+                '?mode=ro', uri=True)
+            return
+        self.connection = sqlite3.connect(self.file_name)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS frames "
+                                    "(file TEXT PRIMARY KEY, mtime REAL, "
+                                    "size INTEGER, header TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS manifest "
+                                    "(file TEXT PRIMARY KEY, kind TEXT, "
+                                    "ratio REAL, selected INTEGER)")
+            if self.version() < CATALOG_VERSION:
+                self.connection.execute("DELETE FROM frames")
+                self.connection.execute("DELETE FROM manifest")
+                self.connection.execute("PRAGMA user_version = " +
+                                        str(CATALOG_VERSION))
+
+    def version(self):
+        """Version of the rows of the header index, see CATALOG_VERSION."""
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def load(self):
+        """
+        Read every entry of the header index.
+
+        Returns
+        -------
+            entries: dict
+                File name as key and (mtime, size, row) as value.
+        """
+        entries = {}
+        for file, mtime, size, header in self.connection.execute(
+                "SELECT file, mtime, size, header FROM frames"):
+            entries[file] = (mtime, size, json.loads(header))
+        return entries
+
+    def save(self, entries):
+        """Write entries of the form (file, mtime, size, row)."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)",
+                [(file, mtime, size, json.dumps(row))
+                 for file, mtime, size, row in entries])
+
+    def load_manifest(self):
+        """
+        Read the spectroscopic/photometric manifest.
+
+        Returns
+        -------
+            manifest: dict
+                File name as key and (kind, ratio, selected) as value.
+        """
+        manifest = {}
+        for file, kind, ratio, selected in self.connection.execute(
+                "SELECT file, kind, ratio, selected FROM manifest"):
+            manifest[file] = (kind, ratio, bool(selected))
+        return manifest
+
+    def save_manifest(self, entries):
+        """Write manifest entries of the form (file, kind, ratio, selected)."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)",
+                [(file, kind, ratio, int(selected))
+                 for file, kind, ratio, selected in entries])
+
+    def remove(self, file_list, table='frames'):
+        """Remove the entries of files which are not in the folder anymore."""
+        with self.connection:
+            self.connection.executemany("DELETE FROM " + table +
+                                        " WHERE file = ?",
+                                        [(file,) for file in file_list])
+
+    def close(self):
+        """Close the connection to the header index."""
+        self.connection.close()
+
+
+def file_stat(file_name):
+    """Modification time and size of a file."""
+    stat = os.stat(file_name)
+    return stat.st_mtime, stat.st_size
+
+
+class FrameCatalog:
+    """Columnar catalog of the header keywords of frames in a night folder."""
+
+    def __init__(self, file_list=(), location='', persistent=False,
+                 workers=SCAN_WORKERS, registry=None):
+        """
+        Initialise the catalog and read the headers of the files provided.
+
+        Parameters
+        ----------
+            file_list : list
+                List of files to catalog.
+            location  : str
+                Location of the files if it is not in the working directory.
+            persistent: bool
+                Keep the header index in a SQLite file in the location, so
+                the headers are not read again on the next run. Otherwise
+                an existing index is only read, and no index is written.
+            workers   : int
+                Number of threads reading headers at the same time, 1 for a
+                serial scan.
+            registry  : ProfileRegistry
+                Instrument profiles attached to the frames, REGISTRY if None.
+        """
+        self.location = location
+        self.workers = max(int(workers), 1)
+        self.registry = REGISTRY if registry is None else registry
+        self.files = []
+        self.columns = dict((key, []) for key in CATALOG_KEYWORDS)
+        self.profiles = []
+        self._position = {}
+        self._stat = {}
+
+        # Throughput of the last update which read headers, see update().
+        self.scan = None
+        self.n_scans = 0
+
+        # Spectroscopic/photometric split, see record() and selected().
+        self.manifest = {}
+
+        self.cache = None
+        self._stored = {}
+        if persistent:
+            try:
+                self.cache = HeaderCache(location)
+                self._stored = self.cache.load()
+                self.manifest = self.cache.load_manifest()
+            except sqlite3.Error as error:
+                print(error)
+                print("Header index is not available, reading all headers")
+                self.cache = None
+        elif os.path.isfile(os.path.join(location, CATALOG_FILE)):
+            # headers and split recorded by the driver
+            try:
+                cache = HeaderCache(location, read_only=True)
+                try:
+                    if cache.version() == CATALOG_VERSION:
+                        self._stored = cache.load()
+                        self.manifest = cache.load_manifest()
+                finally:
+                    cache.close()
+            except sqlite3.Error as error:
+                print(error)
+
+        self.update(file_list)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, file):
+        return file in self._position
+
+    def __getitem__(self, key):
+        """Column of the catalog for the header keyword provided."""
+        return self.columns[key]
+
+    def _append(self, file, row, stat):
+        self._position[file] = len(self.files)
+        self.files.append(file)
+        self._stat[file] = stat
+        for key in CATALOG_KEYWORDS:
+            self.columns[key].append(row[key])
+        self.profiles.append(self.registry.profile(row))
+
+    def _replace(self, file, row, stat):
+        i = self._position[file]
+        self._stat[file] = stat
+        for key in CATALOG_KEYWORDS:
+            self.columns[key][i] = row[key]
+        self.profiles[i] = self.registry.profile(row)
+
+    def update(self, file_list):
+        """
+        Read the headers of the files which are new or changed since they\
+        were catalogued. If headers are read, the scan attribute is set to\
+        a dict with 'frames' (headers read), 'time' (s), 'frames_per_s' and\
+        'workers'. The throughput is printed for the first scan only, the\
+        scan of the night folder.
+
+        Parameters
+        ----------
+            file_list: list
+                List of files need to be in the catalog.
+        Returns
+        -------
+            new_files: list
+                List of files read from the disk.
+        """
+        start = time.time()
+        stats = self._map(file_stat, [os.path.join(self.location, file)
+                                      for file in file_list])
+
+        changed = []
+        new_files = []
+        for file, stat in zip(file_list, stats):
+            if self._stat.get(file) == stat:
+                continue
+            changed.append((file, stat))
+            stored = self._stored.get(file)
+            if stored is None or (stored[0], stored[1]) != stat or \
+                    any(key not in stored[2] for key in CATALOG_KEYWORDS):
+                new_files.append(file)
+
+        # Headers are read concurrently, rows come back in file_list order.
+        rows = self._map(read_frame, [os.path.join(self.location, file)
+                                      for file in new_files])
+        rows = dict(zip(new_files, rows))
+
+        entries = []
+        for file, stat in changed:
+            if file in rows:
+                row = rows[file]
+                entries.append((file, stat[0], stat[1], row))
+                self.manifest.pop(file, None)  # NAXIS might have changed
+            else:
+                row = self._stored[file][2]
+
+            if file in self._position:
+                self._replace(file, row, stat)
+            else:
+                self._append(file, row, stat)
+
+        if self.cache is not None and len(entries) != 0:
+            self.cache.save(entries)
+            for file, mtime, size, row in entries:
+                self._stored[file] = (mtime, size, row)
+
+        if len(new_files) != 0:
+            elapsed = time.time() - start
+            self.scan = {'frames': len(new_files), 'time': elapsed,
+                         'frames_per_s': len(new_files) / max(elapsed, 1e-6),
+                         'workers': self.workers}
+            self.n_scans += 1
+            if self.n_scans == 1:
+                print("Scanned {frames} headers in {time:.2f} s "
+                      "({frames_per_s:.1f} frames/s, {workers} "
+                      "workers)".format(**self.scan))
+        return new_files
+
+    def _map(self, func, items):
+        """Apply func to every item using a bounded thread pool."""
+        if self.workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(func, items))
+
+    def refresh(self, file_list):
+        """
+        Make the catalog follow the directory after a reduction step. Files\
+        which are not in the file_list are dropped, new or changed files are\
+        read again.
+
+        Parameters
+        ----------
+            file_list: list
+                List of files presently in the directory.
+        Returns
+        -------
+            none
+        """
+        keep = set(file_list)
+        rows = [(file, self.row(file), self._stat[file]) for file in self.files
+                if file in keep]
+
+        self.files = []
+        self.columns = dict((key, []) for key in CATALOG_KEYWORDS)
+        self.profiles = []
+        self._position = {}
+        self._stat = {}
+        for file, row, stat in rows:
+            self._append(file, row, stat)
+
+        if self.cache is not None:
+            removed = [file for file in self._stored if file not in keep]
+            self.cache.remove(removed)
+            for file in removed:
+                del self._stored[file]
+
+        removed = [file for file in self.manifest if file not in keep]
+        for file in removed:
+            del self.manifest[file]
+        if self.cache is not None:
+            self.cache.remove(removed, table='manifest')
+
+        self.update(file_list)
+
+    def record(self, entries):
+        """
+        Record the spectroscopic/photometric split of frames in the manifest.
+
+        Parameters
+        ----------
+            entries: list
+                List of (file, kind, ratio, selected), where kind is 'spec'
+                or 'phot', ratio is NAXIS2/NAXIS1 and selected tells whether
+                later stages should use the frame.
+        Returns
+        -------
+            none
+        """
+        changed = [entry for entry in entries
+                   if self.manifest.get(entry[0]) != tuple(entry[1:])]
+        for file, kind, ratio, selected in changed:
+            self.manifest[file] = (kind, ratio, selected)
+        if self.cache is not None and len(changed) != 0:
+            self.cache.save_manifest(changed)
+
+    def selected(self, file_list):
+        """
+        Files which are selected for reduction in the manifest. Files which\
+        are not in the manifest (e.g. products of reduction steps) are kept.
+
+        Parameters
+        ----------
+            file_list: list
+                List of files.
+        Returns
+        -------
+            file_list: list
+                List of files without the frames left out in the manifest.
+        """
+        return [file for file in file_list
+                if file not in self.manifest or self.manifest[file][2]]
+
+    def row(self, file):
+        """
+        Catalog keywords of a single file.
+
+        Parameters
+        ----------
+            file: str
+                File name as given in the file list.
+        Returns
+        -------
+            row : dict
+                Header keywords and their values.
+        """
+        if file not in self._position:
+            self.update([file])
+        i = self._position[file]
+        return dict((key, self.columns[key][i]) for key in CATALOG_KEYWORDS)
+
+    def value(self, file, key):
+        """Value of a single header keyword of a file."""
+        if file not in self._position:
+            self.update([file])
+        return self.columns[key][self._position[file]]
+
+    def profile(self, file):
+        """Instrument profile of a file, None if the instrument is unknown."""
+        if file not in self._position:
+            self.update([file])
+        return self.profiles[self._position[file]]
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,157 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the frame-type classifier. The KEYWORDS of the file
+management utilities are compiled once into lookup tables and every frame
+of a catalog is classified in a single vectorized pass into a frame type and
+a grism code.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+from enum import IntEnum
+import numpy as np
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Aperture used for the standard stars (see flux_calibrate).
+STANDARD_APERTURE = '2 1340 l'
+
+
+class FrameType(IntEnum):
+    """Type of a frame identified from the header."""
+
+    BIAS = 1
+    FLAT = 2
+    LAMP = 3       # OBJECT = 'lamp' with unknown LAMP header term
+    LAMP_FEAR = 4
+    LAMP_FENE = 5
+    OBJECT = 6
+    STANDARD = 7
+
+
+# Grism codes
+NO_GRISM = 0
+GR7 = 7
+GR8 = 8
+
+_compiled = {}
+
+
+def compile_keywords(keywords):
+    """
+    Compile the KEYWORDS dictionary into lookup tables. Tables are made only\
+    once for each dictionary.
+
+    Parameters
+    ----------
+        keywords: dict
+            KEYWORDS dictionary of the file management utilities.
+    Returns
+    -------
+        tables  : dict
+            'OBJECT', 'LAMP' and 'GRISM' lookup tables from the lower case
+            header value to the frame type or grism code.
+    """
+    key = id(keywords)
+    if key in _compiled and _compiled[key][0] is keywords:
+        return _compiled[key][1]
+
+    object_table = {}
+    for word in keywords['LAMP']:
+        object_table[word] = FrameType.LAMP
+    for word in keywords['FEAR']:
+        object_table[word] = FrameType.LAMP_FEAR
+    for word in keywords['FENE']:
+        object_table[word] = FrameType.LAMP_FENE
+    for word in keywords['FLAT']:
+        object_table[word] = FrameType.FLAT
+    for word in keywords['BIAS']:
+        object_table[word] = FrameType.BIAS
+
+    lamp_table = {}
+    for word in keywords['FEAR']:
+        lamp_table[word] = FrameType.LAMP_FEAR
+    for word in keywords['FENE']:
+        lamp_table[word] = FrameType.LAMP_FENE
+
+    grism_table = {}
+    for word in keywords['GR7']:
+        grism_table[word] = GR7
+    for word in keywords['GR8']:
+        grism_table[word] = GR8
+
+    tables = {'OBJECT': object_table, 'LAMP': lamp_table,
+              'GRISM': grism_table}
+    _compiled[key] = (keywords, tables)
+    return tables
+
+
+def _lookup(values, table, default):
+    """Look up every value in the table, each distinct value only once."""
+    values = np.char.lower(np.asarray(values, dtype=str))
+    if values.size == 0:
+        return np.zeros(0, dtype='i1')
+    unique, inverse = np.unique(values, return_inverse=True)
+    codes = np.array([table.get(value, default) for value in unique],
+                     dtype='i1')
+    return codes[inverse.reshape(-1)]
+
+
+def classify_frames(file_list, catalog, keywords):
+    """
+    Classify frames into frame types and grisms.
+
+    Parameters
+    ----------
+        file_list: list
+            List of files to classify.
+        catalog  : FrameCatalog
+            Catalog containing the files.
+        keywords : dict
+            KEYWORDS dictionary of the file management utilities.
+    Returns
+    -------
+        frames   : numpy.ndarray
+            Structured array with fields 'file', 'ftype' (FrameType) and
+            'grism' (GR7, GR8 or NO_GRISM), in the order of file_list.
+    """
+    tables = compile_keywords(keywords)
+    catalog.update(file_list)
+    rows = [catalog.row(file) for file in file_list]
+
+    width = max([len(file) for file in file_list] + [1])
+    frames = np.zeros(len(file_list), dtype=[('file', 'U' + str(width)),
+                                             ('ftype', 'i1'),
+                                             ('grism', 'i1')])
+    frames['file'] = file_list
+
+    objects = [row['OBJECT'] for row in rows]
+    ftype = _lookup(objects, tables['OBJECT'], FrameType.OBJECT)
+
+    # For HFOSC1 old CCD, OBJECT is 'lamp' and the lamp is in LAMP.
+    is_lamp = np.char.lower(np.asarray(objects, dtype=str)) == 'lamp'
+    if is_lamp.any():
+        lamps = _lookup([row['LAMP'] for row in rows], tables['LAMP'],
+                        FrameType.LAMP)
+        ftype[is_lamp] = lamps[is_lamp]
+
+    apertures = np.asarray([row['APERTUR'] for row in rows], dtype=str)
+    ftype[(ftype == FrameType.OBJECT) & (apertures == STANDARD_APERTURE)] = \
+        FrameType.STANDARD
+    frames['ftype'] = ftype
+
+    # GRISM header term, grism from the first COMMENT card as fall back.
+    grism = _lookup([row['GRISM'] for row in rows], tables['GRISM'], NO_GRISM)
+    missing = grism == NO_GRISM
+    if missing.any():
+        comment = _lookup([row['COMMENT'][3:6] for row in rows],
+                          tables['GRISM'], NO_GRISM)
+        grism[missing] = comment[missing]
+    frames['grism'] = grism
+
+    return frames
+
+# -------------------------------------------------------------------------------------------------------------------- #
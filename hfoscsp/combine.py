@@ -0,0 +1,556 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the image combiner used for the master-bias. The frames are
+combined in blocks of rows, so only a block of every frame is in memory at a
+time, and the blocks can be combined by a pool of threads. The 'median'
+combine with 'avsigclip' rejection follows IRAF zerocombine. BiasAccumulator
+stores the combined frames to add new frames later.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import time
+import tracemalloc
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+from hfoscsp.fitsheader import read_header
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Memory allowed for the working arrays of the combine (bytes).
+MEMORY_LIMIT = 256 * 1024 ** 2
+
+# Working arrays used for each pixel of a block (stack, residuals, sigma).
+WORK_ARRAYS = 4
+
+MAX_ITERATIONS = 10
+
+# Keywords describing the stored data, set again when the image is written.
+SCALING_KEYWORDS = ['BZERO', 'BSCALE', 'BLANK']
+
+
+def frame_header(hdu_list, index=0):
+    """
+    Header of a frame for a single image file. For the image in an extension\
+    (HFOSC2), the primary header is merged with the extension header as\
+    IRAF does for file[1].
+
+    Parameters
+    ----------
+        hdu_list: astropy.io.fits.HDUList
+            Opened fits file.
+        index   : int
+            HDU containing the image.
+    Returns
+    -------
+        header  : astropy.io.fits.Header
+            Header without the scaling keywords.
+    """
+    header = hdu_list[0].header.copy()
+    if index != 0:
+        header.extend(hdu_list[index].header, strip=True, update=True)
+    for key in SCALING_KEYWORDS + ['INHERIT', 'EXTNAME']:
+        header.remove(key, ignore_missing=True, remove_all=True)
+    return header
+
+
+def scale_image(data, header):
+    """Scale raw data in place with BSCALE and BZERO of the header."""
+    bscale = header.get('BSCALE', 1.0)
+    bzero = header.get('BZERO', 0.0)
+    if bscale != 1.0:
+        data *= bscale
+    if bzero != 0.0:
+        data += bzero
+    return data
+
+
+def avsigclip(stack, lsigma=3.0, hsigma=3.0):
+    """
+    Average sigma clipping of a stack of frames, as avsigclip in IRAF. The\
+    sigma is taken proportional to the square root of the median, with the\
+    constant of proportionality found from every pixel of a line. Pixels\
+    beyond the limits are rejected and the median is found again until no\
+    more pixels are rejected.
+
+    Parameters
+    ----------
+        stack : numpy.ndarray
+            Frames as (frame, line, column), float32.
+        lsigma: float
+            Low clipping sigma factor.
+        hsigma: float
+            High clipping sigma factor.
+    Returns
+    -------
+        stack : numpy.ndarray
+            Stack with the rejected pixels set to NaN.
+    """
+    if stack.shape[0] < 3:
+        return stack  # nothing to compare against
+
+    center = np.median(stack, axis=0)
+    for iteration in range(MAX_ITERATIONS):
+        level = np.maximum(np.abs(center), 1.0)
+        residual = stack - center
+        # sigma^2 = scale * median, scale found for every line
+        ratio = residual ** 2 / level
+        scale = np.nanmean(ratio, axis=(0, 2)) * stack.shape[0] / \
+            max(stack.shape[0] - 1, 1)
+        sigma = np.sqrt(scale[:, None] * level)
+
+        reject = (residual > hsigma * sigma) | (residual < -lsigma * sigma)
+        reject &= ~np.isnan(stack)
+        if not reject.any():
+            break
+        stack[reject] = np.nan
+        center = np.nanmedian(stack, axis=0)
+    return stack
+
+
+def _combine_block(stack, combine, reject, lsigma, hsigma):
+    """Combine a block of rows of the stack."""
+    if reject == 'avsigclip':
+        stack = avsigclip(stack, lsigma=lsigma, hsigma=hsigma)
+    elif reject != 'none':
+        raise ValueError("Rejection " + str(reject) + " is not available")
+
+    if combine == 'median':
+        return np.nanmedian(stack, axis=0)
+    elif combine == 'average':
+        return np.nanmean(stack, axis=0)
+    raise ValueError("Combine " + str(combine) + " is not available")
+
+
+def block_rows(n_frames, n_columns, memory_limit=MEMORY_LIMIT):
+    """Number of rows in a block for the memory limit provided."""
+    row_size = n_frames * n_columns * 4 * WORK_ARRAYS  # float32
+    return max(int(memory_limit // max(row_size, 1)), 1)
+
+
+def combine_frames(file_list, output, index=0, combine='median',
+                   reject='avsigclip', lsigma=3.0, hsigma=3.0,
+                   memory_limit=MEMORY_LIMIT, workers=1, accumulator=None):
+    """
+    Combine frames into a single image, e.g. master-bias from bias frames.
+
+    Parameters
+    ----------
+        file_list   : list
+            List of fits files with complete path.
+        output      : str
+            Name of the combined image with complete path.
+        index       : int
+            HDU containing the image (1 for HFOSC2).
+        combine     : str ('median' or 'average')
+            Type of combine operation.
+        reject      : str ('avsigclip' or 'none')
+            Type of rejection.
+        lsigma      : float
+            Low clipping sigma factor.
+        hsigma      : float
+            High clipping sigma factor.
+        memory_limit: int
+            Memory (bytes) for the working arrays, sets the size of blocks.
+        workers     : int
+            Number of threads combining blocks at the same time.
+        accumulator : BiasAccumulator
+            Frames stored before, the frames are stored in the same pass.
+    Returns
+    -------
+        stats       : dict
+            'time' (s), 'peak_memory' (bytes), 'blocks' and 'rows' (rows in
+            a block) of the combine.
+    """
+    if len(file_list) == 0:
+        raise ValueError("No frames to combine")
+
+    start = time.time()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):  # Python 3.9
+        tracemalloc.reset_peak()
+
+    # Raw integers are memory mapped and scaled in the stack, astropy can not
+    # memory map scaled (BZERO) images.
+    hdu_lists = [fits.open(file, memmap=True, do_not_scale_image_data=True)
+                 for file in file_list]
+    try:
+        header = frame_header(hdu_lists[0], index)
+        n_lines, n_columns = hdu_lists[0][index].shape
+        for file, hdu_list in zip(file_list, hdu_lists):
+            if hdu_list[index].shape != (n_lines, n_columns):
+                raise ValueError("Image size of " + os.path.basename(file) +
+                                 " is different from the other frames")
+
+        rows = min(block_rows(len(file_list), n_columns,
+                              memory_limit // max(int(workers), 1)), n_lines)
+        blocks = [(i, min(i + rows, n_lines)) for i in range(0, n_lines, rows)]
+        result = np.empty((n_lines, n_columns), dtype=np.float32)
+        if accumulator is not None:
+            accumulator.reserve(len(file_list), stored_type(
+                [hdu_list[index].header for hdu_list in hdu_lists]))
+
+        def work(block):
+            # section reads only the rows of the block from every frame
+            stack = np.empty((len(hdu_lists), block[1] - block[0],
+                              n_columns), dtype=np.float32)
+            for i, hdu_list in enumerate(hdu_lists):
+                stack[i] = hdu_list[index].section[block[0]:block[1], :]
+                scale_image(stack[i], hdu_list[index].header)
+            if accumulator is not None:
+                # before the rejection, which changes the stack
+                accumulator.add_block(slice(block[0], block[1]), stack)
+            result[block[0]:block[1]] = _combine_block(stack, combine, reject,
+                                                       lsigma, hsigma)
+
+        if workers <= 1 or len(blocks) == 1:
+            for block in blocks:
+                work(block)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(work, blocks))
+    finally:
+        for hdu_list in hdu_lists:
+            hdu_list.close()
+    if accumulator is not None:
+        accumulator.commit(file_list)
+
+    header['NCOMBINE'] = (len(file_list), 'Number of images combined')
+    header.add_history('{} combine of {} frames with {} rejection'.format(
+        combine, len(file_list), reject))
+    fits.PrimaryHDU(result, header=header).writeto(output, overwrite=True)
+
+    peak = tracemalloc.get_traced_memory()[1]
+    if not tracing:
+        tracemalloc.stop()
+    stats = {'time': time.time() - start, 'peak_memory': peak,
+             'blocks': len(blocks), 'rows': rows}
+    print("Combined {} frames into {} in {:.2f} s ({} blocks of {} rows, "
+          "peak memory {:.1f} MB)".format(len(file_list),
+                                          os.path.basename(output),
+                                          stats['time'], stats['blocks'],
+                                          stats['rows'], peak / 1024.0 ** 2))
+    return stats
+
+
+def stored_type(headers):
+    """
+    Type which holds the scaled images of frames exactly: 16 bit integers\
+    for raw frames (unsigned for BZERO = 32768), otherwise float32 as in\
+    the stack of combine_frames.
+
+    Parameters
+    ----------
+        headers: list
+            Headers of the image HDU of the frames, with BZERO and BSCALE.
+    Returns
+    -------
+        dtype  : numpy.dtype
+            Type the frames are stored in.
+    """
+    types = set()
+    for header in headers:
+        bscale = header.get('BSCALE', 1.0)
+        bzero = header.get('BZERO', 0.0)
+        if header['BITPIX'] == 16 and bscale == 1.0 and bzero == 32768:
+            types.add(np.dtype(np.uint16))
+        elif header['BITPIX'] == 16 and bscale == 1.0 and bzero == 0.0:
+            types.add(np.dtype(np.int16))
+        else:
+            types.add(np.dtype(np.float32))
+    if len(types) == 1:
+        return types.pop()
+    return np.dtype(np.float32)
+
+
+class BiasAccumulator:
+    """
+    Every bias frame combined so far, so that new bias frames are folded\
+    into the master-bias after the old frames are removed from the night\
+    folder. Each batch of added frames is stored in a .npy file in the type\
+    of the raw frames and memory mapped, and the master-bias is combined\
+    from all the frames in blocks of rows, the same as combine_frames of\
+    all the frames.
+    """
+
+    def __init__(self, shape, state_file):
+        """
+        Parameters
+        ----------
+            shape     : tuple
+                Image size (lines, columns).
+            state_file: str
+                List of the frames (.npz) with complete path. The frames
+                are stored next to it, see batch_name().
+        """
+        self.shape = tuple(int(size) for size in shape)
+        self.state_file = state_file
+        self.files = []
+        self.batches = []  # number of the first frame of every batch
+        self.frames = []   # memory mapped frames of every batch
+        self._new = None   # batch being added, see reserve()
+
+    @property
+    def n_frames(self):
+        """Number of frames stored."""
+        return len(self.files)
+
+    def batch_name(self, first):
+        """Name of the .npy file of the batch starting with frame first."""
+        return '{}-{}.npy'.format(os.path.splitext(self.state_file)[0], first)
+
+    @classmethod
+    def load(cls, state_file):
+        """Read the list of frames written by save() and map the frames."""
+        with np.load(state_file) as state:
+            accumulator = cls(tuple(state['shape']), state_file)
+            accumulator.files = [str(file) for file in state['files']]
+            accumulator.batches = [int(first) for first in state['batches']]
+        for first in accumulator.batches:
+            accumulator.frames.append(np.load(accumulator.batch_name(first),
+                                              mmap_mode='r'))
+        if sum(len(frames) for frames in accumulator.frames) != \
+                accumulator.n_frames:
+            raise ValueError("Frames of " + os.path.basename(state_file) +
+                             " are incomplete")
+        return accumulator
+
+    def save(self):
+        """Write the list of frames, after commit()."""
+        temp_name = self.state_file + '.' + str(os.getpid())
+        with open(temp_name, 'wb') as f:
+            np.savez(f, shape=np.array(self.shape),
+                     files=np.array(self.files, dtype=str),
+                     batches=np.array(self.batches, dtype=np.int64))
+        os.replace(temp_name, self.state_file)
+
+    def remove(self):
+        """Remove the list of frames and the stored frames."""
+        names = [self.state_file] + [self.batch_name(first)
+                                     for first in self.batches]
+        self.frames = []
+        for name in names:
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def reserve(self, n_new, dtype=np.float32):
+        """
+        New batch for n_new frames stored as dtype (see stored_type), before\
+        add_block().
+        """
+        temp_name = self.batch_name(self.n_frames) + '.' + str(os.getpid())
+        self._new = np.lib.format.open_memmap(temp_name, mode='w+',
+                                              dtype=dtype,
+                                              shape=(n_new,) + self.shape)
+
+    def add_block(self, rows, stack):
+        """
+        Store rows of the new frames. After reserve(), every block of rows\
+        of the frames is added once (blocks can be added by threads at the\
+        same time), then commit() stores the batch.
+
+        Parameters
+        ----------
+            rows : slice
+                Rows of the block.
+            stack: numpy.ndarray
+                Rows of the frames as (frame, line, column), in the order
+                they are committed.
+        """
+        self._new[:, rows] = stack
+
+    def commit(self, file_list):
+        """Store the batch of frames added with add_block()."""
+        first = self.n_frames
+        self._new.flush()
+        temp_name = self._new.filename
+        self._new = None
+        os.replace(temp_name, self.batch_name(first))
+        self.batches.append(first)
+        self.frames.append(np.load(self.batch_name(first), mmap_mode='r'))
+        self.files += [os.path.basename(file) for file in file_list]
+
+    def add(self, file_list, index=0):
+        """
+        Store new bias frames. Frames already stored (same file name) are\
+        skipped.
+
+        Parameters
+        ----------
+            file_list: list
+                List of bias frames with complete path.
+            index    : int
+                HDU containing the image (1 for HFOSC2).
+        Returns
+        -------
+            n_added  : int
+                Number of frames added.
+        """
+        new_files = [file for file in file_list
+                     if os.path.basename(file) not in self.files]
+        if len(new_files) == 0:
+            return 0
+
+        headers = [read_header(file, index) for file in new_files]
+        for file, header in zip(new_files, headers):
+            if (header['NAXIS2'], header['NAXIS1']) != self.shape:
+                raise ValueError("Image size of " + os.path.basename(file) +
+                                 " is different from the master-bias")
+
+        self.reserve(len(new_files), stored_type(headers))
+        data = np.empty(self.shape, dtype=np.float32)
+        for i, file in enumerate(new_files):
+            with fits.open(file, memmap=True,
+                           do_not_scale_image_data=True) as hdu_list:
+                data[:] = hdu_list[index].data
+                scale_image(data, hdu_list[index].header)
+            self._new[i] = data
+        self.commit(new_files)
+        return len(new_files)
+
+    def master(self, combine='median', reject='avsigclip', lsigma=3.0,
+               hsigma=3.0, memory_limit=MEMORY_LIMIT):
+        """
+        Master-bias from the stored frames, combined as in combine_frames.
+
+        Parameters
+        ----------
+            combine     : str ('median' or 'average')
+                Type of combine operation.
+            reject      : str ('avsigclip' or 'none')
+                Type of rejection.
+            lsigma      : float
+                Low clipping sigma factor.
+            hsigma      : float
+                High clipping sigma factor.
+            memory_limit: int
+                Memory (bytes) for the working arrays, sets the size of
+                blocks.
+        Returns
+        -------
+            master      : numpy.ndarray
+                Master-bias as float32.
+        """
+        if self.n_frames == 0:
+            raise ValueError("No frames to combine")
+        rows = block_rows(self.n_frames, self.shape[1], memory_limit)
+        master = np.empty(self.shape, dtype=np.float32)
+        for line in range(0, self.shape[0], rows):
+            block = slice(line, min(line + rows, self.shape[0]))
+            stack = np.empty((self.n_frames, block.stop - block.start,
+                              self.shape[1]), dtype=np.float32)
+            for first, frames in zip(self.batches, self.frames):
+                stack[first:first + len(frames)] = frames[:, block]
+            master[block] = _combine_block(stack, combine, reject, lsigma,
+                                           hsigma)
+        return master
+
+
+def update_master(file_list, output, state_file, index=0):
+    """
+    Make the master-bias from the frames and the frames stored with the\
+    state_file by the runs before, whose files are removed after the bias\
+    correction. Only the new frames are read, and the master-bias is the\
+    same as combine_frames of all the frames. Without a state (or if the\
+    image size has changed) the frames are combined with combine_frames,\
+    which stores them in the same pass. If every frame is already stored\
+    and the output is made from them, the master-bias is left as it is.
+
+    Parameters
+    ----------
+        file_list : list
+            List of bias frames with complete path.
+        output    : str
+            Name of the master-bias with complete path.
+        state_file: str
+            List of the frames stored before (.npz).
+        index     : int
+            HDU containing the image (1 for HFOSC2).
+    Returns
+    -------
+        n_frames  : int
+            Number of frames in the master-bias.
+    """
+    folder = os.path.dirname(state_file)
+    if folder != '' and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with fits.open(file_list[0], memmap=True) as hdu_list:
+        header = frame_header(hdu_list, index)
+        shape = hdu_list[index].shape
+
+    accumulator = None
+    if os.path.isfile(state_file):
+        try:
+            accumulator = BiasAccumulator.load(state_file)
+        except (IOError, OSError, KeyError, ValueError) as error:
+            print(error)
+            print("Stored bias frames can not be read, master-bias is made "
+                  "from the bias files")
+    if accumulator is not None and accumulator.shape != shape:
+        print("Image size has changed, master-bias is made again")
+        accumulator.remove()
+        accumulator = None
+
+    if accumulator is None:
+        accumulator = BiasAccumulator(shape, state_file)
+        combine_frames(file_list, output, index=index,
+                       accumulator=accumulator)
+        accumulator.save()
+        return accumulator.n_frames
+
+    new_files = [file for file in file_list
+                 if os.path.basename(file) not in accumulator.files]
+    if len(new_files) == 0 and os.path.isfile(output) and \
+            read_header(output).get('NCOMBINE') == accumulator.n_frames:
+        print("Master-bias of {} frames is up to date".format(
+            accumulator.n_frames))
+        return accumulator.n_frames
+
+    start = time.time()
+    n_added = accumulator.add(new_files, index=index)
+    header['NCOMBINE'] = (accumulator.n_frames, 'Number of images combined')
+    header.add_history('median combine of {} frames with avsigclip '
+                       'rejection, {} added to the stored frames'.format(
+                           accumulator.n_frames, n_added))
+    fits.PrimaryHDU(accumulator.master(), header=header).writeto(
+        output, overwrite=True)
+    accumulator.save()
+    print("Added {} frames to the master-bias of {} frames in {:.2f} "
+          "s".format(n_added, accumulator.n_frames - n_added,
+                     time.time() - start))
+    return accumulator.n_frames
+
+
+def compare_images(file_name, reference, tolerance):
+    """
+    Compare a combined image with a reference, e.g. the master-bias made by\
+    zerocombine.
+
+    Parameters
+    ----------
+        file_name: str
+            Name of the image with complete path.
+        reference: str
+            Name of the reference image with complete path.
+        tolerance: float
+            Largest absolute difference allowed (ADU).
+    Returns
+    -------
+        match    : bool
+            True if every pixel is within the tolerance.
+    """
+    data = fits.getdata(file_name).astype(np.float64)
+    data_ref = fits.getdata(reference).astype(np.float64)
+    difference = np.abs(data - data_ref)
+    print("Difference from {} : max {:.3f}, mean {:.3f} ADU".format(
+        os.path.basename(reference), difference.max(), difference.mean()))
+    return bool(difference.max() <= tolerance)
+
+# -------------------------------------------------------------------------------------------------------------------- #
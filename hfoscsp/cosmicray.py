@@ -12,12 +12,28 @@ __version__ = '1.0.0'
 
 import os
 import time
-import subprocess
-import threading
+import traceback
+import tracemalloc
 import ccdproc
+import astroscrappy
+import matplotlib
+import numpy as np
+import matplotlib.pyplot as plt
 from astropy.io import fits
+from astropy.visualization import ZScaleInterval
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from tabulate import tabulate
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
 
 from hfoscsp.interactive import options
+from hfoscsp.badpixel import fix_file
+from hfoscsp.badpixel import fix_bad_pixels
+from hfoscsp.crstack import exposure_groups
+from hfoscsp.crstack import stack_reject
+from hfoscsp.crcache import ResultCache
+from hfoscsp.crcache import data_hash
 
 try:
     from pyraf import iraf
@@ -28,6 +44,62 @@ bar = """
 ###############################################################################
 """
 
+# State of a worker process of cosmic_correction_batch(), see _init_worker().
+_worker = {}
+
+# la_cosmic tiles (pixels). With the L.A.Cosmic of astroscrappy (niter=4)
+# tiles of 256 pixels gave the same image and mask as a single call from an
+# overlap of 8 pixels, on a synthetic spectrum with a trace, sky lines and
+# cosmic rays; the overlap is kept 4 times that as a margin. Check other
+# data with benchmark_tiling().
+TILE_SIZE = 1024
+TILE_OVERLAP = 32
+
+# la_cosmic engines. 'ccdproc' is ccdproc.cosmicray_lacosmic on the image as
+# astropy reads it. 'float32' is astroscrappy (the L.A.Cosmic of ccdproc) on
+# float32 work buffers kept between the frames of a batch, without the
+# scaled and float64 copies of the frame. The 16-bit frames of HFOSC are
+# exact in float32 (integers below 2**24). precision_check() measures the
+# difference between the engines: with astroscrappy 1.3.0 and ccdproc 2.5.1
+# the masks were the same and the cleaned pixels within 5e-4 ADU (1e-5 of
+# the noise) on synthetic frames and a synthetic spectrum.
+LACOSMIC_ENGINES = ('ccdproc', 'float32')
+LACOSMIC_ENGINE = 'float32'
+
+# Work buffers of the float32 engine in this process, see _buffer().
+_buffers = {}
+
+# Region of interest around the spectral trace (columns, dispersion along
+# the lines). The half width is the apall aperture.
+TRACE_HALF_WIDTH = 15
+SKY_MARGIN = 60
+TRACE_BLOCKS = 8       # blocks of lines collapsed to find the trace
+TRACE_SIGMA = 5.0      # detection of the trace above the sky
+
+# Extensions of a cosmic ray corrected frame: mask of the corrected pixels
+# (compressed) and the flux removed from them, from which the residual is
+# made when it is viewed.
+CR_MASK = 'CRMASK'
+CR_FLUX = 'CRFLUX'
+
+# Inspection views of the corrected frames (cleaned, residual, original),
+# PNG files in CR_Check shown in a matplotlib window instead of ds9.
+VIEW_PREFIX = 'view_'
+VIEW_SIZE = (12, 8)  # inches
+VIEW_DPI = 100
+VIEW_WINDOW = 'Cosmic-ray inspection'
+
+# Methods and parameters tried by parameter_sweep(), changes from the
+# parameters of cosmic_correction_individual().
+SWEEP_GRID = [('la_cosmic', {'sigclip': 4.5, 'objlim': 5.0}),
+              ('la_cosmic', {'sigclip': 6.0, 'objlim': 5.0}),
+              ('la_cosmic', {'sigclip': 8.0, 'objlim': 8.0}),
+              ('la_cosmic', {'sigclip': 15.0, 'sigfrac': 0.5}),
+              ('irafcrmedian', {'lsigma': 25, 'ncsig': 10}),
+              ('irafcrmedian', {'lsigma': 10, 'ncsig': 10}),
+              ('irafcosmicrays', {'threshold': 25, 'fluxrate': 2}),
+              ('irafcosmicrays', {'threshold': 15, 'fluxrate': 2})]
+
 
 def remove_file(file_name):
     """
@@ -96,34 +168,980 @@ def irafcrmedian(input, output, lsigma, hsigma, ncmed, nlmed, ncsig, nlsig):
                                     lsigma=lsigma, hsigma=hsigma, ncmed=ncmed, ncsig=ncsig, nlsig=nlsig)
 
 
-def la_cosmic(input, output, sigclip, sigfrac, objlim, read_noise, data_max):
+def frame_tiles(shape, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Overlapping tiles of a frame.
+
+    Parameters
+    ----------
+        shape    : tuple
+            Image size (lines, columns).
+        tile_size: int
+            Size of the tiles without the overlap.
+        overlap  : int
+            Margin added on every side of a tile (within the frame).
+    Returns
+    -------
+        tiles    : list
+            (tile, core, core_in_tile) slices for every tile. The cores
+            cover the frame once.
+    """
+    tiles = []
+    for line in range(0, shape[0], tile_size):
+        for column in range(0, shape[1], tile_size):
+            core = (slice(line, min(line + tile_size, shape[0])),
+                    slice(column, min(column + tile_size, shape[1])))
+            tile = tuple(slice(max(part.start - overlap, 0),
+                               min(part.stop + overlap, size))
+                         for part, size in zip(core, shape))
+            core_in_tile = tuple(slice(part.start - outer.start,
+                                       part.stop - outer.start)
+                                 for part, outer in zip(core, tile))
+            tiles.append((tile, core, core_in_tile))
+    return tiles
+
+
+def _buffer(name, shape, dtype=np.float32):
+    """Work buffer of a name, allocated again only if its size changes."""
+    buffer = _buffers.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or \
+            buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        _buffers[name] = buffer
+    return buffer
+
+
+def _lacosmic(data, read_noise, data_max, sigclip=4.5, sigfrac=0.3,
+              objlim=5.0, ccd_gain=1.0, engine=LACOSMIC_ENGINE):
+    """
+    L.A.Cosmic of an image (ADU) as (cleaned image, cosmic-ray mask).
+
+    L.A.Cosmic is given the image in electrons with gain=1, so that the
+    result does not depend on how a version of ccdproc or astroscrappy
+    returns a gain applied image. The float32 engine converts the image in
+    place, it has to be a work buffer.
+    """
+    settings = dict(sigclip=float(sigclip), sigfrac=float(sigfrac),
+                    objlim=float(objlim), gain=1.0,
+                    readnoise=float(read_noise),
+                    satlevel=float(data_max) * ccd_gain, niter=4, sepmed=True,
+                    cleantype='meanmask', fsmode='median', psfmodel='gauss',
+                    psffwhm=2.5, psfsize=7, psfk=None, psfbeta=4.765,
+                    verbose=False)
+    if engine == 'float32':
+        data *= np.float32(ccd_gain)
+        cr_mask, cr_cleaned = astroscrappy.detect_cosmics(data, **settings)
+        cr_cleaned = np.asarray(cr_cleaned, dtype=np.float32)
+        cr_cleaned /= np.float32(ccd_gain)
+        return cr_cleaned, np.asarray(cr_mask)
+
+    cr_cleaned, cr_mask = ccdproc.cosmicray_lacosmic(ccd=data * ccd_gain,
+                                                     **settings)
+    return np.asarray(cr_cleaned) / ccd_gain, np.asarray(cr_mask)
+
+
+def lacosmic_image(data, read_noise, data_max, sigclip=4.5, sigfrac=0.3,
+                   objlim=5.0, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                   workers=1, ccd_gain=1.0, engine=LACOSMIC_ENGINE,
+                   out=None):
+    """
+    L.A.Cosmic of an image, in overlapping tiles cleaned in parallel. Only\
+    the core of every tile is kept; with an overlap beyond the reach of\
+    L.A.Cosmic (see TILE_OVERLAP) the result matches a single call, while\
+    the temporaries of L.A.Cosmic are only of the tile size.
+
+    Parameters
+    ----------
+        data      : numpy.ndarray
+            Image (ADU).
+        read_noise: float
+            Read noise of the CCD (e-).
+        data_max  : float
+            Saturation level of the CCD (ADU).
+        sigclip   : float
+            Detection limit of cosmic rays (sigma).
+        sigfrac   : float
+            Detection limit of the neighbouring pixels, fraction of sigclip.
+        objlim    : float
+            Contrast limit between cosmic rays and the object.
+        tile_size : int
+            Size of the tiles, the whole image in one call if None.
+        overlap   : int
+            Margin around the tiles.
+        workers   : int
+            Number of threads cleaning tiles, all CPUs if None.
+        ccd_gain  : float
+            Gain of the CCD (e-/ADU).
+        engine    : str ('ccdproc', 'float32')
+            L.A.Cosmic engine, see LACOSMIC_ENGINES.
+        out       : tuple
+            (cleaned, mask) arrays of the image size the result is written
+            to, new arrays if None.
+    Returns
+    -------
+        cr_cleaned: numpy.ndarray
+            Cosmic ray corrected image (float32).
+        cr_mask   : numpy.ndarray
+            True for the pixels with cosmic rays.
+    """
+    if engine not in LACOSMIC_ENGINES:
+        raise ValueError("Unknown L.A.Cosmic engine " + str(engine))
+    if tile_size is None:
+        tile_size = max(data.shape)
+    tiles = frame_tiles(data.shape, tile_size, overlap)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(int(workers), len(tiles)), 1)
+
+    if out is None:
+        out = (np.empty(data.shape, dtype=np.float32),
+               np.empty(data.shape, dtype=bool))
+    cr_cleaned, cr_mask = out
+    tile_area = max((outer[0].stop - outer[0].start) *
+                    (outer[1].stop - outer[1].start)
+                    for outer, core, core_in_tile in tiles)
+
+    def work(slot):
+        # every thread cleans its share of the tiles in its own buffer
+        for outer, core, core_in_tile in tiles[slot::workers]:
+            if engine == 'float32':
+                shape = (outer[0].stop - outer[0].start,
+                         outer[1].stop - outer[1].start)
+                work_data = _buffer(('tile', slot), (tile_area,))
+                work_data = work_data[:shape[0] * shape[1]].reshape(shape)
+                np.copyto(work_data, data[outer], casting='unsafe')
+            else:
+                work_data = np.ascontiguousarray(data[outer])
+            cleaned, found = _lacosmic(work_data, read_noise, data_max,
+                                       sigclip, sigfrac, objlim, ccd_gain,
+                                       engine)
+            # only the cosmic rays go through the gain, the other pixels are
+            # kept as they are
+            cr_mask[core] = found[core_in_tile]
+            np.copyto(cr_cleaned[core], data[core], casting='unsafe')
+            np.copyto(cr_cleaned[core], cleaned[core_in_tile],
+                      casting='unsafe', where=cr_mask[core])
+
+    if workers == 1:
+        work(0)
+    else:
+        # the tiles write separate parts of the outputs
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(work, range(workers)))
+    return cr_cleaned, cr_mask
+
+
+def _read_float32(file_name, name):
+    """
+    Image of the primary HDU of a file read into the float32 work buffer of\
+    a name, without the float64 (or scaled copy) of astropy.
+
+    Returns
+    -------
+        data  : numpy.ndarray
+            Work buffer with the image.
+        header: astropy.io.fits.Header
+            Header of the image without the scaling keywords.
+        hdus  : list
+            Copies of the other HDUs of the file.
+    """
+    with fits.open(file_name, memmap=True,
+                   do_not_scale_image_data=True) as hdu_list:
+        header = hdu_list[0].header.copy()
+        raw = hdu_list[0].data
+        data = _buffer(name, raw.shape)
+        np.copyto(data, raw, casting='unsafe')
+        hdus = [hdu.copy() for hdu in hdu_list[1:]]
+        del raw
+
+    bscale = header.get('BSCALE', 1.0)
+    bzero = header.get('BZERO', 0.0)
+    if bscale != 1.0:
+        data *= np.float32(bscale)
+    if bzero != 0.0:
+        data += np.float32(bzero)
+    for key in ('BZERO', 'BSCALE', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    return data, header, hdus
+
+
+def la_cosmic(input, output, sigclip, sigfrac, objlim, read_noise, data_max,
+              mask=None, tile_size=TILE_SIZE, workers=1, ccd_gain=1.0,
+              engine=LACOSMIC_ENGINE):
     """
     La cosmic cosmic-ray correction module from Astropy.
 
     Parameters
     ----------
-        input   : file name of file to correct cosmic rays.
-        output  : file name of cosmic ray corrected file.
-        sigclip :
+        input    : file name of file to correct cosmic rays.
+        output   : file name of cosmic ray corrected file.
+        sigclip  : detection limit of cosmic rays (sigma).
+        sigfrac  : detection limit of the neighbouring pixels, fraction of
+                   sigclip.
+        objlim   : contrast limit between cosmic rays and the object.
+        mask     : bad-pixel mask (True for bad pixels), interpolated over
+                   before the search.
+        tile_size: size of the tiles cleaned separately, the whole frame in
+                   one call if None.
+        workers  : number of threads cleaning tiles, all CPUs if None.
+        ccd_gain : gain of the CCD (e-/ADU).
+        engine   : L.A.Cosmic engine ('ccdproc', 'float32'). The float32
+                   engine reuses its work buffers for the next frame.
+    Returns
+    -------
+        cr_mask  : True for the pixels with cosmic rays.
+    """
+    if engine == 'float32':
+        original, header, hdus = _read_float32(input, 'original')
+        out = (_buffer('cleaned', original.shape),
+               _buffer('mask', original.shape, bool))
+    else:
+        with fits.open(input) as hdul:
+            original = np.array(hdul[0].data)
+            header = hdul[0].header.copy()
+            hdus = [hdu.copy() for hdu in hdul[1:]]
+        out = None
+        for key in ('BZERO', 'BSCALE', 'BLANK'):
+            header.remove(key, ignore_missing=True)
+
+    # image searched for cosmic rays, with the bad pixels interpolated
+    image = original
+    if mask is not None:
+        if mask.shape == original.shape:
+            if engine != 'float32':  # the work buffer is fixed in place
+                image = original.astype(np.float32)
+            image = fix_bad_pixels(image, mask)
+        else:
+            print("Bad-pixel mask is not used for " + os.path.basename(input))
+
+    cr_cleaned, cr_mask = lacosmic_image(image, read_noise, data_max,
+                                         sigclip=sigclip, sigfrac=sigfrac,
+                                         objlim=objlim, tile_size=tile_size,
+                                         workers=workers, ccd_gain=ccd_gain,
+                                         engine=engine, out=out)
+    header['EXTEND'] = True
+    # Write the new HDU structure to outfile, the interpolated bad pixels
+    # are not cosmic rays (as for the other modules)
+    hdu_list = fits.HDUList([fits.PrimaryHDU(cr_cleaned, header=header)] +
+                            hdus + cr_extensions(image, cr_cleaned, cr_mask))
+    hdu_list.writeto(output, overwrite=True)
+    return cr_mask.copy()
+
+
+def benchmark_tiling(shape=(4096, 4096), tile_sizes=(512, 1024),
+                     workers_list=None, read_noise=5.75, data_max=700000):
+    """
+    Time L.A.Cosmic on a synthetic frame in a single call and in tiles, with\
+    the peak memory of each run and the difference from the single call.
+
+    Parameters
+    ----------
+        shape       : tuple
+            Image size of the frame (lines, columns).
+        tile_sizes  : list
+            Tile sizes to time.
+        workers_list: list
+            Numbers of threads to time, 1 and the number of CPUs if None.
+        read_noise  : float
+            Read noise of the CCD.
+        data_max    : float
+            Saturation level of the CCD.
+    Returns
+    -------
+        timing      : list
+            Rows of [tile size, workers, time (s), peak memory (MB), speedup,
+            max difference, mask pixels different].
+    """
+    if workers_list is None:
+        workers_list = sorted(set([1, os.cpu_count() or 1]))
+    rng = np.random.RandomState(0)
+    data = rng.normal(1000.0, 30.0, shape).astype(np.float32)
+    hits = rng.randint(0, data.size, data.size // 2000)
+    data.flat[hits] += rng.uniform(2000.0, 20000.0, hits.size)
+
+    runs = [(None, 1)] + [(tile_size, workers) for tile_size in tile_sizes
+                          for workers in workers_list]
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+
+    timing = []
+    reference = None
+    for tile_size, workers in runs:
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9
+            tracemalloc.reset_peak()
+        start = time.time()
+        cr_cleaned, cr_mask = lacosmic_image(data, read_noise, data_max,
+                                             tile_size=tile_size,
+                                             workers=workers)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+        if reference is None:
+            reference = (elapsed, cr_cleaned, cr_mask)
+        timing.append([tile_size or max(shape), workers, round(elapsed, 2),
+                       round(peak, 1), round(reference[0] / elapsed, 2),
+                       float(np.max(np.abs(cr_cleaned - reference[1]))),
+                       int(np.sum(cr_mask != reference[2]))])
+
+    if not tracing:
+        tracemalloc.stop()
+
+    print("tile  workers  time (s)  peak (MB)  speedup  max diff  mask diff")
+    for row in timing:
+        print("{:4d}  {:7d}  {:8.2f}  {:9.1f}  {:7.2f}  {:8.3g}  "
+              "{:9d}".format(*row))
+    return timing
+
+
+def precision_check(file_name=None, shape=(1024, 1024), read_noise=4.87,
+                    ccd_gain=1.22, data_max=55000):
+    """
+    Compare the float32 engine of la_cosmic with the ccdproc engine on a\
+    frame, or on a synthetic 16-bit frame with cosmic rays.
+
+    Parameters
+    ----------
+        file_name : str
+            Frame with complete path, a synthetic frame if None.
+        shape     : tuple
+            Image size of the synthetic frame (lines, columns).
+        read_noise: float
+            Read noise of the CCD (e-).
+        ccd_gain  : float
+            Gain of the CCD (e-/ADU).
+        data_max  : float
+            Saturation level of the CCD (ADU).
+    Returns
+    -------
+        check     : dict
+            'max_diff' largest difference of the cleaned images (ADU),
+            'max_diff_noise' the same in units of the noise of the pixel,
+            'mask_diff' pixels flagged by one engine only.
+    """
+    if file_name is None:
+        rng = np.random.RandomState(0)
+        data = rng.poisson(800.0, shape).astype(np.uint16)
+        hits = rng.randint(0, data.size, data.size // 2000)
+        data.flat[hits] += rng.randint(2000, 20000, hits.size).astype(
+            np.uint16)
+    else:
+        data = fits.getdata(file_name, 0)
+
+    results = {}
+    for engine in LACOSMIC_ENGINES:
+        results[engine] = lacosmic_image(data, read_noise, data_max,
+                                         ccd_gain=ccd_gain, engine=engine)
+    cleaned, found = results['ccdproc']
+    diff = np.abs(results['float32'][0].astype(np.float64) - cleaned)
+    noise = np.sqrt(read_noise ** 2 +
+                    np.clip(cleaned, 0, None) * ccd_gain) / ccd_gain
+
+    check = {'max_diff': float(np.max(diff)),
+             'max_diff_noise': float(np.max(diff / noise)),
+             'mask_diff': int(np.sum(results['float32'][1] != found))}
+    print("float32 - ccdproc : max diff {max_diff:.3g} ADU "
+          "({max_diff_noise:.3g} sigma), {mask_diff} mask pixels "
+          "different".format(**check))
+    return check
+
+
+def trace_window(data, margin=SKY_MARGIN, half_width=TRACE_HALF_WIDTH,
+                 blocks=TRACE_BLOCKS, sigma=TRACE_SIGMA):
+    """
+    Columns of the spectral trace and the sky on both sides, from the\
+    profiles of blocks of lines collapsed along the dispersion axis, so that\
+    a tilted trace is covered.
+
+    Parameters
+    ----------
+        data      : numpy.ndarray
+            Image with the dispersion along the lines.
+        margin    : int
+            Sky columns kept on each side of the trace.
+        half_width: int
+            Half width of the trace.
+        blocks    : int
+            Number of blocks of lines.
+        sigma     : float
+            The peak of a profile must be sigma above the sky.
+    Returns
+    -------
+        window    : slice
+            Columns of the region of interest, None if no trace is found.
+    """
+    peaks = []
+    for block in np.array_split(np.arange(data.shape[0]), blocks):
+        if block.size == 0:
+            continue
+        profile = np.median(data[block[0]:block[-1] + 1], axis=0)
+        level = np.median(profile)
+        noise = 1.4826 * np.median(np.abs(profile - level))
+        peak = int(np.argmax(profile))
+        if profile[peak] - level > sigma * max(noise, 1e-6):
+            peaks.append(peak)
+    if len(peaks) == 0:
+        return None
+    return slice(max(min(peaks) - half_width - margin, 0),
+                 min(max(peaks) + half_width + margin + 1, data.shape[1]))
+
+
+def cr_extensions(original, cleaned, cr_mask=None):
+    """
+    Mask and removed flux extensions of a cosmic ray corrected frame.
+
+    Parameters
+    ----------
+        original: numpy.ndarray
+            Image before cosmic-ray correction.
+        cleaned : numpy.ndarray
+            Cosmic ray corrected image.
+        cr_mask : numpy.ndarray
+            Cosmic-ray mask of the module, if it gives one. The pixels
+            changed by the correction are always in the mask.
+    Returns
+    -------
+        hdus    : list
+            CR_MASK (RICE compressed 0/1 image) and CR_FLUX (flux removed at
+            the masked pixels, in the order of numpy.nonzero).
+    """
+    mask = np.asarray(original) != np.asarray(cleaned)
+    if cr_mask is not None:
+        mask |= cr_mask
+    flux = np.asarray(original, dtype=np.float32)[mask] - \
+        np.asarray(cleaned, dtype=np.float32)[mask]
+
+    mask_hdu = fits.CompImageHDU(mask.astype(np.uint8), name=CR_MASK,
+                                 compression_type='RICE_1')
+    mask_hdu.header['NCRPIX'] = (int(flux.size),
+                                 'Pixels corrected for cosmic rays')
+    return [mask_hdu, fits.ImageHDU(flux, name=CR_FLUX)]
+
+
+def add_cr_mask(file_name, output_file_name, cr_mask=None):
+    """
+    Add the mask and removed flux extensions to a cosmic ray corrected file.
+
+    Parameters
+    ----------
+        file_name       : str
+            Frame before cosmic-ray correction.
+        output_file_name: str
+            Cosmic ray corrected frame, updated.
+        cr_mask         : numpy.ndarray
+            Cosmic-ray mask of the module, if it gives one.
     Returns
     -------
         none
     """
-    hdul = fits.open(input)
-    gain_corrected = hdul[0].data
+    original = fits.getdata(file_name, 0)
+    with fits.open(output_file_name) as hdu_list:
+        hdus = [hdu.copy() for hdu in hdu_list
+                if hdu.name not in (CR_MASK, CR_FLUX)]
+    hdus[0].header['EXTEND'] = True
+    hdus += cr_extensions(original, hdus[0].data, cr_mask)
+    fits.HDUList(hdus).writeto(output_file_name, overwrite=True)
+
+
+def read_cr_mask(output_file_name):
+    """
+    Cosmic-ray mask of a corrected frame.
+
+    Returns
+    -------
+        mask: numpy.ndarray
+            True for the corrected pixels, None if the file has no mask.
+    """
+    with fits.open(output_file_name) as hdu_list:
+        if CR_MASK not in hdu_list:
+            return None
+        return hdu_list[CR_MASK].data.astype(bool)
+
+
+def residual_image(output_file_name):
+    """
+    Cosmic rays removed from a frame (input - output) from the mask and flux\
+    extensions of the corrected frame.
+
+    Returns
+    -------
+        residual: numpy.ndarray
+            Residual image (float32).
+        header  : astropy.io.fits.Header
+            Header of the corrected frame.
+    """
+    with fits.open(output_file_name) as hdu_list:
+        header = hdu_list[0].header.copy()
+        mask = hdu_list[CR_MASK].data.astype(bool)
+        flux = hdu_list[CR_FLUX].data
+        residual = np.zeros(mask.shape, dtype=np.float32)
+        if flux is not None:
+            residual[mask] = flux
+    for key in ('BZERO', 'BSCALE', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    return residual, header
+
+
+def residual_file(output_file_name, cr_check_file_name):
+    """
+    Write the residual of a corrected frame for viewing, the cosmic rays\
+    removed as imarith (input - output) gave them.
+
+    Parameters
+    ----------
+        output_file_name  : str
+            Cosmic ray corrected frame.
+        cr_check_file_name: str
+            Residual file, made only if it is older than the corrected frame.
+    Returns
+    -------
+        cr_check_file_name: str
+    """
+    if os.path.isfile(cr_check_file_name) and \
+            os.path.getmtime(cr_check_file_name) >= \
+            os.path.getmtime(output_file_name):
+        return cr_check_file_name
+    residual, header = residual_image(output_file_name)
+    header.add_history('Residual of the cosmic-ray correction')
+    fits.PrimaryHDU(residual, header=header).writeto(cr_check_file_name,
+                                                     overwrite=True)
+    return cr_check_file_name
+
+
+def render_view(output_file_name, view_file_name):
+    """
+    Render the cleaned, residual and original images of a corrected frame\
+    side by side as a PNG. The original is the cleaned image plus the\
+    residual, so the input frame is not needed.
+
+    Parameters
+    ----------
+        output_file_name: str
+            Cosmic ray corrected frame.
+        view_file_name  : str
+            PNG file, rendered only if it is older than the corrected frame.
+    Returns
+    -------
+        view_file_name  : str
+    """
+    if os.path.isfile(view_file_name) and \
+            os.path.getmtime(view_file_name) >= \
+            os.path.getmtime(output_file_name):
+        return view_file_name
+    cleaned = fits.getdata(output_file_name, 0).astype(np.float32)
+    residual, header = residual_image(output_file_name)
+    original = cleaned + residual
+
+    # zscale of the cleaned image for the cleaned and original images, the
+    # residual with the same contrast above zero
+    low, high = ZScaleInterval().get_limits(cleaned)
+    panels = [('Cleaned', cleaned, low, high),
+              ('Residual', residual, 0, high - low),
+              ('Original', original, low, high)]
+
+    # pyplot is not used, it is not safe in a background thread
+    figure = Figure(figsize=VIEW_SIZE)
+    FigureCanvasAgg(figure)
+    for count, (title, data, vmin, vmax) in enumerate(panels):
+        axes = figure.add_subplot(1, 3, count + 1)
+        axes.imshow(data, cmap='gray', origin='lower', vmin=vmin, vmax=vmax,
+                    interpolation='nearest', aspect='auto')
+        axes.set_title(title)
+    figure.suptitle(os.path.basename(output_file_name))
+    figure.savefig(view_file_name, dpi=VIEW_DPI)
+    return view_file_name
+
+
+def prerender(items, render):
+    """
+    Results of render(*item) in the order of the items. The next item is\
+    rendered in a background thread while the current result is in use.
+
+    Parameters
+    ----------
+        items : list
+            Arguments of render for every item.
+        render: function
+            Rendering of an item.
+    Yields
+    ------
+        item  : tuple
+        result: object
+            Return of render, None if it failed.
+        error : str
+            Traceback of the failure, None if the item is rendered.
+    """
+    def work(item):
+        try:
+            return render(*item), None
+        except Exception:
+            return None, traceback.format_exc()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        for item in items:
+            following = executor.submit(work, item)
+            if future is not None:
+                yield (previous,) + future.result()
+            future, previous = following, item
+        if future is not None:
+            yield (previous,) + future.result()
+
+
+def show_view(view_file_name):
+    """Show a rendered view in the inspection window."""
+    print("Cleaned, residual and original : " + view_file_name)
+    if matplotlib.get_backend().lower() == 'agg':
+        return  # no display, the PNG can be opened from CR_Check
+    figure = plt.figure(VIEW_WINDOW, figsize=VIEW_SIZE)
+    figure.clf()
+    axes = figure.add_axes([0, 0, 1, 1])
+    axes.imshow(plt.imread(view_file_name))
+    axes.axis('off')
+    plt.show(block=False)
+    plt.pause(0.1)
+
+
+def _run_method(file_name, output_file_name, method, parameters, mask):
+    """Run a cosmic ray correction module on a file."""
+    if method == 'irafcosmicrays':
+        irafcosmicrays(input=file_name, output=output_file_name,
+                       threshold=parameters['threshold'],
+                       fluxrate=parameters['fluxrate'],
+                       npasses=parameters['npasses'],
+                       window=parameters['window'])
+        add_cr_mask(file_name, output_file_name)
+    elif method == 'irafcrmedian':
+        irafcrmedian(input=file_name, output=output_file_name,
+                     lsigma=parameters['lsigma'], hsigma=3, ncmed=5, nlmed=5,
+                     ncsig=parameters['ncsig'], nlsig=25)
+        add_cr_mask(file_name, output_file_name)
+    elif method == 'la_cosmic':
+        la_cosmic(input=file_name, output=output_file_name,
+                  sigclip=parameters['sigclip'],
+                  sigfrac=parameters['sigfrac'],
+                  objlim=parameters['objlim'],
+                  read_noise=parameters['read_noise'],
+                  data_max=parameters['data_max'], mask=mask,
+                  workers=parameters.get('workers', 1),
+                  ccd_gain=parameters.get('ccd_gain', 1.0),
+                  engine=parameters.get('engine', LACOSMIC_ENGINE))
+    else:
+        raise ValueError("Unknown cosmic ray correction module " + str(method))
+
+
+def _correct_region(file_name, output_file_name, method, parameters, mask,
+                    window):
+    """
+    Run a cosmic ray correction module on the columns of the window only,\
+    the other pixels are copied unchanged.
+    """
+    location, name = os.path.split(output_file_name)
+    roi_input = os.path.join(location, 'roi_' + os.path.basename(file_name))
+    roi_output = os.path.join(location, 'roi_' + name)
+    remove_file(roi_input)
+    remove_file(roi_output)
+
+    with fits.open(file_name) as hdu_list:
+        header = hdu_list[0].header.copy()
+        data = hdu_list[0].data.astype('float32')
+    for key in ('BZERO', 'BSCALE', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    # bad pixels are fixed in the whole frame, as fix_file() does for the
+    # other modules, and are not recorded as cosmic rays
+    if mask is not None and mask.shape == data.shape:
+        fix_bad_pixels(data, mask)
+
+    try:
+        fits.PrimaryHDU(data[:, window], header=header).writeto(roi_input)
+        _run_method(roi_input, roi_output, method, parameters, None)
+        cleaned = data.copy()
+        cleaned[:, window] = fits.getdata(roi_output, 0)
+        cr_mask = np.zeros(data.shape, dtype=bool)
+        cr_mask[:, window] = read_cr_mask(roi_output)
+    finally:
+        remove_file(roi_input)
+        remove_file(roi_output)
+
+    header.add_history('Cosmic rays corrected in columns {}:{}'.format(
+        window.start + 1, window.stop))
+    hdu_list = fits.HDUList([fits.PrimaryHDU(cleaned, header=header)] +
+                            cr_extensions(data, cleaned, cr_mask))
+    hdu_list.writeto(output_file_name, overwrite=True)
+
+
+def _correct_frame(file_name, output_file_name, cr_check_file_name, method,
+                   parameters, mask, cache=None):
+    """
+    Cosmic-ray correction of a single frame, around the spectral trace only\
+    if parameters['roi'] is set. The residual is made when it is viewed. The\
+    result is copied from the cache if the frame was corrected before with\
+    the same parameters.
+    """
+    remove_file(output_file_name)
+    remove_file(cr_check_file_name)
+
+    if cache is not None:
+        key = cache.key([data_hash(file_name)], method, parameters, mask)
+        if cache.fetch(key, file_name, output_file_name):
+            print(os.path.basename(output_file_name) + " from the cache")
+            return
+
+    if mask is not None and method != 'la_cosmic':
+        fix_file(file_name, mask)
+
+    window = None
+    if parameters.get('roi'):
+        window = trace_window(fits.getdata(file_name),
+                              margin=parameters.get('sky_margin', SKY_MARGIN))
+        if window is None:
+            print("No spectral trace found in " +
+                  os.path.basename(file_name) + ", whole frame is corrected")
+
+    if window is None:
+        _run_method(file_name, output_file_name, method, parameters, mask)
+    else:
+        _correct_region(file_name, output_file_name, method, parameters, mask,
+                        window)
+
+    if cache is not None:
+        cache.store(key, output_file_name)
+
+
+def _init_worker(method, parameters, mask, cache_location=None):
+    """
+    Keep the method, parameters, bad-pixel mask and result cache of a worker\
+    process.
+    """
+    _worker['method'] = method
+    _worker['parameters'] = parameters
+    _worker['mask'] = mask
+    _worker['cache'] = None
+    if cache_location is not None:
+        _worker['cache'] = ResultCache(cache_location)
+
+
+def _work(files):
+    """
+    Correct a frame in a worker process. Errors are returned instead of\
+    raised, so that one bad frame does not stop the others.
 
-    # print (hdul[1].data)
-    # print (hdul[0].header)
-    cr_cleaned = ccdproc.cosmicray_lacosmic(ccd=gain_corrected, sigclip=4.5, sigfrac=0.3, objlim=5.0, gain=1.0,
-                                            readnoise=float(read_noise), satlevel=int(data_max), pssl=0.0, niter=4,
-                                            sepmed=True, cleantype='meanmask', fsmode='median', psfmodel='gauss',
-                                            psffwhm=2.5, psfsize=7, psfk=None, psfbeta=4.765, verbose=False)
-    hdul[0].data = cr_cleaned
-    # Write the new HDU structure to outfile
-    hdul.writeto(output, overwrite=True)
+    Returns
+    -------
+        error: str
+            None if the frame is corrected.
+    """
+    try:
+        _correct_frame(files[0], files[1], files[2], _worker['method'],
+                       _worker['parameters'], _worker['mask'],
+                       _worker['cache'])
+    except Exception:
+        # partial outputs are not left for the next steps
+        remove_file(files[1])
+        remove_file(files[2])
+        return traceback.format_exc()
+    return None
+
+
+def _correct_group(group, parameters, mask, cache=None):
+    """Cosmic-ray rejection in the stack of a group, or from the cache."""
+    for files in group:
+        remove_file(files[1])
+        remove_file(files[2])
+
+    if cache is not None:
+        hashes = [data_hash(files[0]) for files in group]
+        keys = [cache.key(hashes, 'stack', parameters, mask, member)
+                for member in range(len(group))]
+        if all(cache.fetch(key, files[0], files[1])
+               for key, files in zip(keys, group)):
+            print("Stack of {} from the cache".format(
+                os.path.basename(group[0][0])))
+            return
+
+    data_list = []
+    headers = []
+    for files in group:
+        with fits.open(files[0]) as hdu_list:
+            header = hdu_list[0].header.copy()
+            data = hdu_list[0].data.astype('float32')
+        for key in ('BZERO', 'BSCALE', 'BLANK'):
+            header.remove(key, ignore_missing=True)
+        if mask is not None and mask.shape == data.shape:
+            fix_bad_pixels(data, mask)
+        data_list.append(data)
+        headers.append(header)
+
+    cleaned, cr_masks = stack_reject(data_list, parameters['read_noise'],
+                                     parameters['ccd_gain'])
+    for files, original, data, header, cr_mask in zip(group, data_list,
+                                                      cleaned, headers,
+                                                      cr_masks):
+        header.add_history('Cosmic rays rejected in a stack of {} '
+                           'exposures'.format(len(group)))
+        hdu_list = fits.HDUList([fits.PrimaryHDU(data, header=header)] +
+                                cr_extensions(original, data, cr_mask))
+        hdu_list.writeto(files[1], overwrite=True)
+
+    if cache is not None:
+        for key, files in zip(keys, group):
+            cache.store(key, files[1])
+
+
+def _work_group(group):
+    """
+    Correct a group of exposures in a worker process, or each frame by\
+    itself if the stack fails.
 
+    Returns
+    -------
+        errors: list
+            Error of every frame, None if the frame is corrected.
+    """
+    if len(group) > 1:
+        try:
+            _correct_group(group, _worker['parameters'], _worker['mask'],
+                           _worker['cache'])
+            return [None] * len(group)
+        except Exception:
+            print("Stack of {} failed, frames are corrected one by "
+                  "one\n".format(os.path.basename(group[0][0])) +
+                  traceback.format_exc())
+    return [_work(files) for files in group]
+
+
+def _progress(count, total, files, error, start):
+    """Print the progress of cosmic_correction_batch() after a frame."""
+    if error is None:
+        status = 'done'
+    else:
+        status = 'FAILED\n' + error
+    print("[{}/{}] {:.1f} s  {} {}".format(count, total, time.time() - start,
+                                          os.path.basename(files[1]), status))
+
+
+def _run_trial(file_name, output_file_name, method, parameters):
+    """Run a trial of parameter_sweep(), errors are returned."""
+    try:
+        _run_method(file_name, output_file_name, method, parameters, None)
+    except Exception:
+        remove_file(output_file_name)
+        return traceback.format_exc()
+    return None
+
+
+def sweep_metrics(output_file_name, aperture):
+    """
+    Metrics of a cosmic ray corrected frame for comparing parameters.
+
+    Parameters
+    ----------
+        output_file_name: str
+            Cosmic ray corrected frame with the mask extensions.
+        aperture        : slice
+            Columns of the spectral trace, None if there is no trace.
+    Returns
+    -------
+        metrics         : dict
+            'flagged' pixels, 'trace_flux' removed from the trace and the
+            'aperture_fraction' of the trace pixels flagged.
+    """
+    residual, header = residual_image(output_file_name)
+    mask = read_cr_mask(output_file_name)
+    metrics = {'flagged': int(mask.sum()), 'trace_flux': np.nan,
+               'aperture_fraction': np.nan}
+    if aperture is not None:
+        metrics['trace_flux'] = float(residual[:, aperture].sum())
+        metrics['aperture_fraction'] = float(mask[:, aperture].mean())
+    return metrics
+
+
+def parameter_sweep(file_name, output_file_name, parameters, mask=None,
+                    grid=SWEEP_GRID, workers=None):
+    """
+    Correct a frame with every method and parameters of a grid, la_cosmic\
+    trials in worker processes while the IRAF trials run in this process,\
+    and print the metrics of the results.
 
-def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_string='c'):
+    Parameters
+    ----------
+        file_name       : str
+            Frame to correct for cosmic rays.
+        output_file_name: str
+            Name of the corrected frame, the trials are written with a
+            'sweep<n>_' prefix in the same folder.
+        parameters      : dict
+            Parameters of the methods, changed by the grid.
+        mask            : numpy.ndarray
+            Bad-pixel mask (True for bad pixels).
+        grid            : list
+            (method, changes of parameters) of the trials.
+        workers         : int
+            Number of worker processes, all CPUs if None.
+    Returns
+    -------
+        trials          : list
+            'label', 'method', 'parameters', 'file', 'error' and the
+            metrics of sweep_metrics() of every trial.
+    """
+    if mask is not None:
+        fix_file(file_name, mask)
+    # the aperture of apall around the trace
+    aperture = trace_window(fits.getdata(file_name), margin=0)
+
+    location, name = os.path.split(output_file_name)
+    trials = []
+    for count, (method, changes) in enumerate(grid, 1):
+        trial_parameters = dict(parameters)
+        trial_parameters.update(changes)
+        trial_parameters['workers'] = 1
+        label = ' '.join([method] + ['{}={}'.format(key, changes[key])
+                                     for key in sorted(changes)])
+        trials.append({'label': label, 'method': method,
+                       'parameters': trial_parameters, 'error': None,
+                       'file': os.path.join(location, 'sweep{}_'.format(
+                           count) + name)})
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max(int(workers), 1)) as executor:
+        futures = {}
+        for trial in trials:
+            if trial['method'] == 'la_cosmic':
+                futures[executor.submit(_run_trial, file_name, trial['file'],
+                                        trial['method'],
+                                        trial['parameters'])] = trial
+        # IRAF parameter files are shared by the processes
+        for trial in trials:
+            if trial['method'] != 'la_cosmic':
+                trial['error'] = _run_trial(file_name, trial['file'],
+                                            trial['method'],
+                                            trial['parameters'])
+        for future in as_completed(futures):
+            try:
+                futures[future]['error'] = future.result()
+            except Exception as error:  # e.g. a worker process killed
+                futures[future]['error'] = repr(error)
+
+    table = []
+    for count, trial in enumerate(trials, 1):
+        if trial['error'] is None:
+            trial.update(sweep_metrics(trial['file'], aperture))
+            table.append([count, trial['label'], trial['flagged'],
+                          round(trial['trace_flux'], 1),
+                          round(trial['aperture_fraction'], 5)])
+        else:
+            print(trial['label'] + " failed\n" + trial['error'])
+            table.append([count, trial['label'], 'failed', '', ''])
+    print("Parameter sweep of {} trials in {:.1f} s".format(
+        len(trials), time.time() - start))
+    print(tabulate(table, headers=['', 'TRIAL', 'FLAGGED', 'TRACE FLUX',
+                                   'APERTURE FRACTION']))
+    return trials
+
+
+def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_string='c', inventory=None, mask=None,
+                                 roi=None, sky_margin=SKY_MARGIN, cache=None):
     """
     Corrects for cosmic rays in the individually for each OBJECT images and\
     allow to adjust the parameters manually.
@@ -136,6 +1154,20 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
             Location of the files if it is not in the working directory.
         prefix_string   : str
             Prefix to distinguish FITS file from the original FITS file
+        inventory       : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
+        mask            : numpy.ndarray
+            Bad-pixel mask (True for bad pixels), interpolated over before
+            cosmic rays are searched.
+        roi             : str ('Yes' or 'No')
+            Correct only the columns around the spectral trace, asked if not
+            provided.
+        sky_margin      : int
+            Sky columns corrected on each side of the trace.
+        cache           : ResultCache
+            Results of earlier corrections, reused for the same input and
+            parameters.
     Returns
     -------
         cr_check_list   : list
@@ -145,33 +1177,40 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
     cr_currected_list = []
     cr_check_list = []
 
-    # opening ds9 for manually inspecting images
-    subprocess.Popen('ds9')
-    # process_ds9open.wait()
-    ds9_time_delay = 2  # Depends upon how fast your system opens up ds9
-    ds9_waiting = threading.Thread(time.sleep(ds9_time_delay))
-    ds9_waiting.start()
+    if roi is None:
+        message = "Correct cosmic rays only around the spectral trace ?"
+        choices = ['Yes', 'No']
+        roi = options(message, choices)
 
     # Default method for cr correction corresponds to cosmic-ray task in IRAF
     message = "Select the cosmic ray correction module"
     choices = ['irafcrmedian', 'irafcosmicrays', 'la_cosmic']
     cr_currection_method = options(message, choices)
+
+    parameters = {}
     # cosmicray correction task default parameters
-    threshold = 25
-    fluxrate = 2
-    npasses = 5
-    window = 5
+    parameters['threshold'] = 25
+    parameters['fluxrate'] = 2
+    parameters['npasses'] = 5
+    parameters['window'] = 5
 
     # crmedian
-    lsigma = 25       # Low Clipping Sigma Factor
-    ncsig = 10        # Column Box Size For Sigma Calculation
+    parameters['lsigma'] = 25       # Low Clipping Sigma Factor
+    parameters['ncsig'] = 10        # Column Box Size For Sigma Calculation
 
     # la_cosmic parameters
-    sigclip = 15.0
-    sigfrac = 0.5
-    objlim = 5.0
-    data_max = CCD.max_count  # 700000  # Depend up on CCD
-    read_noise = CCD.read_noise  # 5.75  # Depend up on CCD
+    parameters['sigclip'] = 4.5
+    parameters['sigfrac'] = 0.3
+    parameters['objlim'] = 5.0
+    parameters['data_max'] = CCD.max_count  # 700000  # Depend up on CCD
+    parameters['read_noise'] = CCD.read_noise  # 5.75  # Depend up on CCD
+    parameters['ccd_gain'] = CCD.ccd_gain
+    parameters['engine'] = LACOSMIC_ENGINE
+
+    # region of interest around the spectral trace
+    parameters['roi'] = roi == 'Yes'
+    parameters['sky_margin'] = sky_margin
+    parameters['workers'] = None
 
     cr_check_folder = os.path.join(location, 'CR_Check')
     try:
@@ -183,6 +1222,7 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
     sentinel = object()
     iterobj = iter(cosmic_curr_list)    # Explicitly get iterator from iterable (for does this implicitly)
     x = next(iterobj, sentinel)         # Get next object or sentinel
+    corrected = False                   # True if a result of a sweep is kept
     while x is not sentinel:            # Keep going until we exhaust iterator
 
         file_name = x
@@ -193,58 +1233,54 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
         cr_check_file_name = str('chk_') + output_file_name
         cr_check_file_name2 = os.path.join(location, 'CR_Check',
                                            cr_check_file_name)
+        view_file_name = os.path.join(
+            location, 'CR_Check',
+            VIEW_PREFIX + os.path.splitext(output_file_name)[0] + '.png')
 
         file_name = os.path.join(location, file_name)
 
         print(output_file_name)
         print(cr_check_file_name)
 
-        remove_file(output_file_name2)
-        remove_file(cr_check_file_name2)
-
-        if cr_currection_method == 'irafcosmicrays':
-            irafcosmicrays(input=file_name, output=output_file_name2,
-                           threshold=threshold, fluxrate=fluxrate,
-                           npasses=npasses, window=window)
-
-        elif cr_currection_method == 'irafcrmedian':
-            irafcrmedian(input=file_name, output=output_file_name2,
-                         lsigma=lsigma, hsigma=3, ncmed=5, nlmed=5,
-                         ncsig=ncsig, nlsig=25)
-
-        elif cr_currection_method == 'la_cosmic':
-            la_cosmic(input=file_name, output=output_file_name2,
-                      sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
-                      read_noise=read_noise, data_max=data_max)
-
-        iraf.images.imutil.imarith.unlearn()
-        iraf.images.imutil.imarith(operand1=str(file_name), op='-',
-                                   operand2=str(output_file_name2),
-                                   result=str(cr_check_file_name2))
-
-        # time.sleep(3)
-        ds9_waiting.join()
-        # try:
-        #     iraf.display(cr_check_file_name2, 2)
-        iraf.display(output_file_name2, 1)
-        iraf.display(cr_check_file_name2, 2)
-        iraf.display(file_name, 3)
+        if not corrected:
+            _correct_frame(file_name, output_file_name2, cr_check_file_name2,
+                           cr_currection_method, parameters, mask, cache)
+        corrected = False
+
+        # the next frame depends on the parameters accepted for this one,
+        # so the view is rendered here and not in the background
+        show_view(render_view(output_file_name2, view_file_name))
         print(bar)
-        print("Try ds9>>>Frame>>>Blink to check how good is the cosmic ray correction")
+        print("Compare the cleaned, residual and original images to check how good is the cosmic ray correction")
         print(bar)
-        # except iraf.IrafError as error:
-        #     # ds9 might not be open, hence open it and try again
-        #     print('DS9 window is not active. Opening a DS9 window please wait')
-        #     subprocess.Popen('ds9')
 
         print(file_name)
 
         check = ''
-        message = "Enter Yes accept, No for reject"
-        choices = ['Yes', 'No']
+        message = "Enter Yes accept, No for reject, Sweep to try a grid of parameters"
+        choices = ['Yes', 'No', 'Sweep']
         check = options(message, choices)
         # check = raw_input('Enter "y" accept, "n" reject:')
 
+        if check == 'Sweep':  # Should try the grid and keep one result
+            trials = parameter_sweep(file_name, output_file_name2, parameters,
+                                     mask=mask)
+            message = "Select the result to keep"
+            choices = [trial['label'] for trial in trials
+                       if trial['error'] is None] + ['None']
+            label = options(message, choices)
+            for trial in trials:
+                if trial['label'] == label:
+                    os.replace(trial['file'], output_file_name2)
+                    cr_currection_method = trial['method']
+                    parameters.update(trial['parameters'])
+                    parameters['workers'] = None
+                remove_file(trial['file'])
+            # the kept result (or the earlier one) is displayed again
+            remove_file(cr_check_file_name2)
+            corrected = True
+            continue
+
         if check == 'No':  # Should redo
             print(x)
             # cr_currection_method = raw_input("Enter new cosmic-ray correction method (1/2/3) :")
@@ -253,20 +1289,20 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
             cr_currection_method = options(message, choices)
             if cr_currection_method == 'irafcosmicrays':
                 print("Enter new cosmicray correction parameters")
-                threshold = raw_input('threshold='+str(threshold)+'; Enter new threshold :')
-                fluxrate = raw_input('fluxrate ='+str(fluxrate)+'; Enter new fluxrate :')
-                npasses = raw_input('npasses ='+str(npasses)+'; Enter new npasses :')
-                window = raw_input('window'+str(window)+'Enter new window (5/7) :')
+                parameters['threshold'] = raw_input('threshold='+str(parameters['threshold'])+'; Enter new threshold :')
+                parameters['fluxrate'] = raw_input('fluxrate ='+str(parameters['fluxrate'])+'; Enter new fluxrate :')
+                parameters['npasses'] = raw_input('npasses ='+str(parameters['npasses'])+'; Enter new npasses :')
+                parameters['window'] = raw_input('window'+str(parameters['window'])+'Enter new window (5/7) :')
             if cr_currection_method == 'irafcrmedian':
                 print("Enter new crmedian correction parameters")
-                lsigma = raw_input('lsigma='+str(lsigma)+'; Enter new lsigma :')  # Low Clipping Sigma Factor
-                ncsig = raw_input('ncsig='+str(ncsig)+'; Enter new ncsig (minimum=10):')
+                parameters['lsigma'] = raw_input('lsigma='+str(parameters['lsigma'])+'; Enter new lsigma :')  # Low Clipping Sigma Factor
+                parameters['ncsig'] = raw_input('ncsig='+str(parameters['ncsig'])+'; Enter new ncsig (minimum=10):')
                 # Column Box Size For Sigma Calculation
             if cr_currection_method == 'la_cosmic':
                 print("Enter new la_cosmic cosmic-ray correction parameters")
-                sigclip = raw_input('sigclip='+str(sigclip)+'; Enter new sigclip :')
-                sigfrac = raw_input('sigfrac='+str(sigfrac)+'; Enter new sigfrac :')
-                objlim = raw_input('objlim='+str(objlim)+'; Enter new objlim :')
+                parameters['sigclip'] = raw_input('sigclip='+str(parameters['sigclip'])+'; Enter new sigclip :')
+                parameters['sigfrac'] = raw_input('sigfrac='+str(parameters['sigfrac'])+'; Enter new sigfrac :')
+                parameters['objlim'] = raw_input('objlim='+str(parameters['objlim'])+'; Enter new objlim :')
             continue
 
         if check == 'Yes':  # Should continue
@@ -289,10 +1325,16 @@ def cosmic_correction_individual(cosmic_curr_list, CCD, location='', prefix_stri
         x = next(iterobj, sentinel)
         break
 
+    if inventory is not None:
+        # only the accepted files are removed
+        inventory.update(created=cr_currected_list,
+                         removed=[file for file in cosmic_curr_list
+                                  if str(prefix_string) + str(file) in
+                                  cr_currected_list])
     return cr_check_list
 
 
-def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
+def cosmic_correction(cosmic_curr_list, location='', prefix_string='c', inventory=None):
     """
     Corrects for cosmic rays in the OBJECT image.
 
@@ -304,10 +1346,14 @@ def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
             Location of the files if it is not in the working directory.
         prefix_string   : str
             Prefix to distinguish FITS file from the original FITS file
+        inventory       : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
     Returns
     -------
         cr_check_list   : list
-            List of files to check how good is the cosmic ray correction.
+            List of files to check how good is the cosmic ray correction,
+            made by residual_file() if they are needed.
     """
 #     if location != '':
 #         pathloc = os.path.join(os.getcwd(), location, 'cosmic_curr_list')
@@ -337,9 +1383,6 @@ def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
         task(input=file_name, output=output_file_name, interac='no', train='no')
         cr_currected_list.append(output_file_name)
 
-    task = iraf.images.imutil.imarith
-    task.unlearn()
-
     cr_check_list = []
     for file_name in cosmic_curr_list:
 
@@ -350,12 +1393,18 @@ def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
         cr_check_file_name2 = os.path.join(location, cr_check_file_name)
         cr_check_list.append(cr_check_file_name2)
 
-        task(operand1=str(file_name), op='-', operand2=str(output_file_name2), result=str(cr_check_file_name2))
+        # residual is made from the mask when it is viewed
+        add_cr_mask(file_name, output_file_name2)
         remove_file(str(file_name))   # removing the older files which is needed to bias correct.
+
+    if inventory is not None:
+        inventory.update(created=cr_currected_list, removed=cosmic_curr_list)
     return cr_check_list
 
 
-def cosmic_correction_batch(cosmic_curr_list, CCD, location='',  prefix_string='c'):
+def cosmic_correction_batch(cosmic_curr_list, CCD, location='',  prefix_string='c', method=None, verify=None,
+                            inventory=None, mask=None, workers=1, roi=None, sky_margin=SKY_MARGIN, stack=None,
+                            cache=None):
     """
     Corrects for cosmic rays in the OBJECT image.
 
@@ -367,39 +1416,88 @@ def cosmic_correction_batch(cosmic_curr_list, CCD, location='',  prefix_string='
             Location of the files if it is not in the working directory.
         prefix_string   : str
             Prefix to distinguish FITS file from the original FITS file
+        method          : str ('irafcrmedian', 'irafcosmicrays', 'la_cosmic')
+            Cosmic ray correction module, asked if not provided.
+        verify          : str ('Yes' or 'No')
+            Keep verification files, asked if not provided. Otherwise the
+            residuals are made from the mask extensions when they are
+            viewed.
+        inventory       : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
+        mask            : numpy.ndarray
+            Bad-pixel mask (True for bad pixels), interpolated over before
+            cosmic rays are searched.
+        workers         : int
+            Number of worker processes for la_cosmic, all CPUs if None. The
+            IRAF modules share their parameter files, so they correct one
+            frame at a time.
+        roi             : str ('Yes' or 'No')
+            Correct only the columns around the spectral trace, asked if not
+            provided.
+        sky_margin      : int
+            Sky columns corrected on each side of the trace.
+        stack           : str ('Yes' or 'No')
+            Reject cosmic rays in stacks of consecutive exposures of the
+            same OBJECT and GRISM, asked if not provided. The other frames
+            are corrected with the method.
+        cache           : ResultCache
+            Results of earlier corrections, reused for the same input and
+            parameters.
     Returns
     -------
         cr_check_list   : list
             List of files to check how good is the cosmic ray correction.
+            Frames which failed are left uncorrected and are not listed.
     """
     print(cosmic_curr_list)
     cr_currected_list = []
     cr_check_list = []
 
-    message = "Select the cosmic ray correction module"
-    choices = ['irafcrmedian', 'irafcosmicrays', 'la_cosmic']
-    cr_currection_method = options(message, choices)
+    cr_currection_method = method
+    if cr_currection_method is None:
+        message = "Select the cosmic ray correction module"
+        choices = ['irafcrmedian', 'irafcosmicrays', 'la_cosmic']
+        cr_currection_method = options(message, choices)
 
-    message = "Do you need to keep verification files for cosmic-ray correction ?"
-    choices = ['Yes', 'No']
-    verify = options(message, choices)
+    if verify is None:
+        message = "Do you need to keep verification files for cosmic-ray correction ?"
+        choices = ['Yes', 'No']
+        verify = options(message, choices)
+
+    if roi is None:
+        message = "Correct cosmic rays only around the spectral trace ?"
+        choices = ['Yes', 'No']
+        roi = options(message, choices)
 
+    if stack is None:
+        message = "Reject cosmic rays in stacks of repeated exposures ?"
+        choices = ['Yes', 'No']
+        stack = options(message, choices)
+
+    parameters = {}
     # cosmicray correction task default parameters
-    threshold = 25
-    fluxrate = 2
-    npasses = 5
-    window = 5
+    parameters['threshold'] = 25
+    parameters['fluxrate'] = 2
+    parameters['npasses'] = 5
+    parameters['window'] = 5
 
     # crmedian
-    lsigma = 25       # Low Clipping Sigma Factor
-    ncsig = 10        # Column Box Size For Sigma Calculation
+    parameters['lsigma'] = 25       # Low Clipping Sigma Factor
+    parameters['ncsig'] = 10        # Column Box Size For Sigma Calculation
 
     # la_cosmic parameters
-    sigclip = 15.0
-    sigfrac = 0.5
-    objlim = 5.0
-    data_max = CCD.max_count  # 700000  # Depend up on CCD
-    read_noise = CCD.read_noise  # 5.75  # Depend up on CCD
+    parameters['sigclip'] = 4.5
+    parameters['sigfrac'] = 0.3
+    parameters['objlim'] = 5.0
+    parameters['data_max'] = CCD.max_count  # 700000  # Depend up on CCD
+    parameters['read_noise'] = CCD.read_noise  # 5.75  # Depend up on CCD
+    parameters['ccd_gain'] = CCD.ccd_gain
+    parameters['engine'] = LACOSMIC_ENGINE
+
+    # region of interest around the spectral trace
+    parameters['roi'] = roi == 'Yes'
+    parameters['sky_margin'] = sky_margin
 
     cr_check_folder = os.path.join(location, 'CR_Check')
     try:
@@ -407,123 +1505,142 @@ def cosmic_correction_batch(cosmic_curr_list, CCD, location='',  prefix_string='
     except OSError:
         pass
 
-    # Cosmic ray correction loop
+    # (input, output, residual) of every frame
+    jobs = {}
     for file_name in cosmic_curr_list:
-
         output_file_name = str(prefix_string) + str(file_name)
-        output_file_name2 = os.path.join(location, output_file_name)
-
-        file_name = os.path.join(location, file_name)
-
-        print(output_file_name)
-
-        remove_file(output_file_name2)
-
-        if cr_currection_method == 'irafcosmicrays':
-            irafcosmicrays(input=file_name, output=output_file_name2, threshold=threshold, fluxrate=fluxrate,
-                           npasses=npasses, window=window)
-        elif cr_currection_method == 'irafcrmedian':
-            irafcrmedian(input=file_name, output=output_file_name2, lsigma=lsigma, hsigma=3, ncmed=5, nlmed=5,
-                         ncsig=ncsig, nlsig=25)
-        elif cr_currection_method == 'la_cosmic':
-            la_cosmic(input=file_name, output=output_file_name2, sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
-                      read_noise=read_noise, data_max=data_max)
+        cr_check_file_name = str('chk_') + output_file_name
+        jobs[file_name] = (os.path.join(location, file_name),
+                           os.path.join(location, output_file_name),
+                           os.path.join(cr_check_folder, cr_check_file_name))
+
+    # groups of repeated exposures are corrected together
+    if stack == 'Yes':
+        groups, singles = exposure_groups(cosmic_curr_list, location)
+        print("{} groups of repeated exposures, {} single frames".format(
+            len(groups), len(singles)))
+    else:
+        groups, singles = [], list(cosmic_curr_list)
+    tasks = [[jobs[file_name] for file_name in group] for group in groups] + \
+        [[jobs[file_name]] for file_name in singles]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if cr_currection_method != 'la_cosmic':
+        workers = 1  # IRAF parameter files are shared by the processes
+    workers = max(min(int(workers), len(tasks)), 1)
+    cache_location = None if cache is None else cache.location
+
+    # Cosmic ray correction of the frames, errors are kept for every frame
+    errors = {}
+    count = 0
+    start = time.time()
+    if workers == 1:
+        _init_worker(cr_currection_method, parameters, mask)
+        _worker['cache'] = cache
+        for task in tasks:
+            for files, error in zip(task, _work_group(task)):
+                errors[files] = error
+                count += 1
+                _progress(count, len(jobs), files, error, start)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(cr_currection_method, parameters,
+                                           mask, cache_location)) as executor:
+            futures = {executor.submit(_work_group, task): task
+                       for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    task_errors = future.result()
+                except Exception as error:  # e.g. a worker process killed
+                    task_errors = [repr(error)] * len(task)
+                    for files in task:
+                        remove_file(files[1])
+                        remove_file(files[2])
+                for files, error in zip(task, task_errors):
+                    errors[files] = error
+                    count += 1
+                    _progress(count, len(jobs), files, error, start)
+
+    failed_list = []
+    for file_name in cosmic_curr_list:
+        files = jobs[file_name]
+        if errors[files] is not None:
+            failed_list.append(file_name)
+            continue
 
-        cr_currected_list.append(output_file_name)
+        cr_currected_list.append(os.path.basename(files[1]))
+        if verify == 'Yes':
+            residual_file(files[1], files[2])
 
         if verify == 'No':
-            cr_check_file_name = str('chk_') + output_file_name
-            cr_check_file_name2 = os.path.join(location, 'CR_Check', cr_check_file_name)
-
-            remove_file(cr_check_file_name2)
-
-            iraf.images.imutil.imarith.unlearn()
-            iraf.images.imutil.imarith(operand1=str(file_name), op='-', operand2=str(output_file_name2),
-                                       result=str(cr_check_file_name2))
-
-            print(cr_check_file_name)
-            cr_check_list.append(cr_check_file_name)
+            cr_check_list.append(os.path.basename(files[2]))
             # it will not remove files
-
         elif verify == 'Yes':
-            cr_check_file_name = str('chk_') + output_file_name
-            cr_check_file_name2 = os.path.join(location, 'CR_Check', cr_check_file_name)
-            cr_check_folder = os.path.join(location, 'CR_Check')
-            try:
-                os.makedirs(cr_check_folder)
-            except OSError:
-                pass
+            cr_check_list.append(files[2])  # it will remove files
 
-            remove_file(cr_check_file_name2)
-
-            iraf.images.imutil.imarith.unlearn()
-            iraf.images.imutil.imarith(operand1=str(file_name), op='-',
-                                       operand2=str(output_file_name2),
-                                       result=str(cr_check_file_name2))
+        remove_file(files[0])
 
-            print(cr_check_file_name)
-            cr_check_list.append(cr_check_file_name2)  # it will remove files
+    print("Cosmic ray corrected {} frames in {:.2f} s ({} workers)".format(
+        len(cr_currected_list), time.time() - start, workers))
+    if len(failed_list) != 0:
+        print("Cosmic ray correction failed, frames are kept uncorrected :")
+        print(failed_list)
 
-        remove_file(str(file_name))
-        # remove_file(cr_check_file_name2)
+    # verification files are in CR_Check, not in the inventory
+    if inventory is not None:
+        inventory.update(created=cr_currected_list,
+                         removed=[file for file in cosmic_curr_list
+                                  if file not in failed_list])
     return cr_check_list
 
 
 def display_co(image_list, location='', prefix_string='c'):
-    """Function for displaying the image files in ds9"""
-
-    # opening ds9 for manually inspecting images
-    subprocess.Popen('ds9')
-    # process_ds9open.wait()
-    ds9_time_delay = 3  # Depends upon how fast your system opens up ds9
-    # time.sleep(4)
-    ds9_waiting = threading.Thread(time.sleep(ds9_time_delay))
-    ds9_waiting.start()
-    ds9_waiting.join()
-    # Create guaranteed unique sentinel
-    # (can't use None since iterator might produce None)
-    sentinel = object()
-    iterobj = iter(image_list)   # Explicitly get iterator from iterable
-    # (for does this implicitly)
-    x = next(iterobj, sentinel)  # Get next object or sentinel
-    while x is not sentinel:     # Keep going until we exhaust iterator
+    """
+    Show the cosmic ray corrected frames for inspection. The view of the\
+    next frame is rendered in the background while a frame is inspected.
 
-        file_name = x
-        print(file_name)
+    Parameters
+    ----------
+        image_list   : list
+            List of files before cosmic-ray correction.
+        location     : str
+            Location of the files if it is not in the working directory.
+        prefix_string: str
+            Prefix of the cosmic ray corrected files.
+    Returns
+    -------
+        none
+    """
+    cr_check_folder = os.path.join(location, 'CR_Check')
+    try:
+        os.makedirs(cr_check_folder)
+    except OSError:
+        pass
 
+    views = []
+    for file_name in image_list:
         output_file_name = str(prefix_string) + str(file_name)
         output_file_name2 = os.path.join(location, output_file_name)
-
-        cr_check_file_name = str('chk_') + output_file_name
-        cr_check_file_name2 = os.path.join(location, cr_check_file_name)
-
-        # file_name = os.path.join(location, file_name)
-
-        print(output_file_name)
-        print(cr_check_file_name)
-
-        try:
-            iraf.display(output_file_name2, 1)
-            iraf.display(cr_check_file_name2, 2)
-        except:
-            time.sleep(2)
-            iraf.display(output_file_name2, 1)
-            iraf.display(cr_check_file_name2, 2)
-        # iraf.display(file_name, 3)
+        if not os.path.isfile(output_file_name2):
+            print(output_file_name + " is not corrected for cosmic rays")
+            continue
+        view_file_name = os.path.join(
+            cr_check_folder,
+            VIEW_PREFIX + os.path.splitext(output_file_name)[0] + '.png')
+        views.append((output_file_name2, view_file_name))
+
+    for item, view_file_name, error in prerender(views, render_view):
+        print(os.path.basename(item[0]))
+        if error is not None:
+            print("View of " + os.path.basename(item[0]) + " failed\n" + error)
+            continue
+        show_view(view_file_name)
         print(bar)
-        print("Try ds9>>>Frame>>>Blink to check how good is the cosmic ray correction")
+        print("Compare the cleaned, residual and original images to check how good is the cosmic ray correction")
         print(bar)
-        # except iraf.IrafError as error:
-        #     # ds9 might not be open, hence open it and try again
-        #     print('DS9 window is not active. Opening a DS9 window please wait')
-        #     subprocess.Popen('ds9')
 
-        check = ''
         message = "Continue to next image"
         choices = ['Yes']
-        check = options(message, choices)
-
-        if check == 'Yes':  # Should continue
-            x = next(iterobj, sentinel)
-            #  Explicitly advance loop for continue case
-            continue
+        options(message, choices)
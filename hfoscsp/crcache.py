@@ -0,0 +1,222 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the cache of cosmic-ray correction results. A result is kept
+under a hash of the input pixels, the bad-pixel mask, the method and its
+parameters, so that a frame corrected again with the same data and parameters
+(e.g. when a night is reduced again) is copied from the cache. The cache is a
+folder in the working directory with a SQLite index; the least recently used
+results are removed above the size limit.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import time
+import json
+import shutil
+import hashlib
+import sqlite3
+import numpy as np
+from astropy.io import fits
+from hfoscsp.fitsheader import read_header
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+CACHE_DIR = 'HFOSC_CRCache'  # in the working directory
+CACHE_INDEX = 'cache.sqlite'
+
+MAX_SIZE = 4 * 1024 ** 3     # bytes
+
+# Parameters which do not change the result.
+IGNORED_PARAMETERS = ('workers',)
+
+
+def data_hash(file_name, index=0):
+    """
+    Hash of the pixels of a frame (as stored, with the scaling).
+
+    Parameters
+    ----------
+        file_name: str
+            Frame with complete path.
+        index    : int
+            HDU containing the image.
+    Returns
+    -------
+        digest   : str
+    """
+    digest = hashlib.sha1()
+    with fits.open(file_name, memmap=True,
+                   do_not_scale_image_data=True) as hdu_list:
+        hdu = hdu_list[index]
+        data = np.ascontiguousarray(hdu.data)
+        digest.update(str((data.shape, data.dtype.str,
+                           hdu.header.get('BSCALE', 1.0),
+                           hdu.header.get('BZERO', 0.0))).encode())
+        digest.update(data.data)
+    return digest.hexdigest()
+
+
+def mask_hash(mask):
+    """Hash of a bad-pixel mask, '' if there is no mask."""
+    if mask is None:
+        return ''
+    digest = hashlib.sha1(str(mask.shape).encode())
+    digest.update(np.packbits(mask.ravel()).data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Cosmic ray corrected frames keyed by their input and parameters."""
+
+    def __init__(self, location=None, max_size=MAX_SIZE):
+        """
+        Open (or create) the cache.
+
+        Parameters
+        ----------
+            location: str
+                Folder of the cache, CACHE_DIR in the working directory if
+                None.
+            max_size: int
+                Size (bytes) of the cache kept by evict().
+        """
+        if location is None:
+            location = os.path.join(os.getcwd(), CACHE_DIR)
+        self.location = location
+        self.max_size = max_size
+
+        if not os.path.isdir(location):
+            os.makedirs(location)
+        # Worker processes and nights reduced in parallel share the index.
+        self.connection = sqlite3.connect(os.path.join(location, CACHE_INDEX),
+                                          timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                    "(key TEXT PRIMARY KEY, size INTEGER, "
+                                    "created REAL, used REAL)")
+
+    @staticmethod
+    def key(data_hashes, method, parameters, mask=None, member=0):
+        """
+        Key of a result.
+
+        Parameters
+        ----------
+            data_hashes: list
+                data_hash() of the input frames (more than one for a stack).
+            method     : str
+                Cosmic ray correction module.
+            parameters : dict
+                Parameters of the module.
+            mask       : numpy.ndarray
+                Bad-pixel mask used.
+            member     : int
+                Frame of the stack the result belongs to.
+        Returns
+        -------
+            key        : str
+        """
+        parameters = {name: value for name, value in parameters.items()
+                      if name not in IGNORED_PARAMETERS}
+        text = json.dumps([list(data_hashes), method, parameters,
+                           mask_hash(mask), member], sort_keys=True,
+                          default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        """Cached result of a key with complete path."""
+        return os.path.join(self.location, key + '.fits')
+
+    def fetch(self, key, file_name, output_file_name):
+        """
+        Write the cached result of a key as the corrected frame, with the\
+        header of the input frame.
+
+        Parameters
+        ----------
+            key             : str
+                Key of the result.
+            file_name       : str
+                Frame before cosmic-ray correction.
+            output_file_name: str
+                Cosmic ray corrected frame.
+        Returns
+        -------
+            found           : bool
+                False if the result is not in the cache.
+        """
+        cached = self._file(key)
+        row = self.connection.execute("SELECT key FROM results WHERE "
+                                      "key = ?", (key,)).fetchone()
+        if row is None or not os.path.isfile(cached):
+            return False
+
+        header = read_header(file_name)
+        for name in ('BZERO', 'BSCALE', 'BLANK'):
+            header.remove(name, ignore_missing=True)
+        header['EXTEND'] = True
+        header.add_history('Cosmic-ray correction from the cache')
+        with fits.open(cached) as hdu_list:
+            hdus = [fits.PrimaryHDU(hdu_list[0].data, header=header)] + \
+                [hdu.copy() for hdu in hdu_list[1:]]
+            fits.HDUList(hdus).writeto(output_file_name, overwrite=True)
+
+        with self.connection:
+            self.connection.execute("UPDATE results SET used = ? WHERE "
+                                    "key = ?", (time.time(), key))
+        return True
+
+    def store(self, key, output_file_name):
+        """Copy a corrected frame into the cache under a key."""
+        cached = self._file(key)
+        # copied under a temporary name, other processes may read it
+        temp_name = cached + '.' + str(os.getpid())
+        shutil.copy(output_file_name, temp_name)
+        os.replace(temp_name, cached)
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES "
+                                    "(?, ?, ?, ?)",
+                                    (key, os.path.getsize(cached), now, now))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache is within\
+        max_size.
+
+        Returns
+        -------
+            removed: list
+                Keys removed from the cache.
+        """
+        rows = self.connection.execute(
+            "SELECT key, size FROM results ORDER BY used").fetchall()
+        total = sum(row[1] for row in rows)
+
+        removed = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            removed.append(key)
+            total -= size
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM results WHERE key = ?",
+                                        [(key,) for key in removed])
+        for key in removed:
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+        return removed
+
+    def close(self):
+        """Close the index of the cache."""
+        self.connection.close()
+
+# -------------------------------------------------------------------------------------------------------------------- #
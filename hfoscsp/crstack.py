@@ -0,0 +1,198 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the cosmic-ray rejection in stacks of repeated exposures.
+Consecutive exposures of the same OBJECT and GRISM are grouped from their
+headers, aligned by the offset of the spectral trace and scaled to the same
+flux. A pixel is a cosmic ray when it is above the median of the stack by more
+than the noise expected from the read noise, the gain and a sensitivity term
+(as the crreject of imcombine), and it is replaced by the median.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import warnings
+import numpy as np
+
+from hfoscsp.association import frame_time
+from hfoscsp.fitsheader import read_header
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+STACK_SIGMA = 5.0        # rejection above the median of the stack (sigma)
+SENSITIVITY_NOISE = 0.1  # fraction of the signal added to the noise (snoise)
+GROW = 1                 # pixels flagged around a cosmic ray
+STACK_ITERATIONS = 2
+MAX_GAP = 3600.0         # seconds between exposures of a group
+MAX_SHIFT = 50           # columns, largest trace offset searched
+
+
+def exposure_groups(file_list, location=''):
+    """
+    Group consecutive exposures of the same target and grism.
+
+    Parameters
+    ----------
+        file_list: list
+            List of files.
+        location : str
+            Location of the files if it is not in the working directory.
+    Returns
+    -------
+        groups   : list
+            Lists of two or more files, in order of time.
+        singles  : list
+            Files not in a group.
+    """
+    frames = []
+    singles = []
+    for file_name in file_list:
+        header = read_header(os.path.join(location, file_name))
+        row = {key: header.get(key, '') for key in ('DATE-AVG', 'DATE-OBS',
+                                                     'TM_START')}
+        start = frame_time(row)
+        if start is None:
+            singles.append(file_name)
+            continue
+        key = (str(header.get('OBJECT', '')).strip().lower(),
+               str(header.get('GRISM', '')).strip().lower(),
+               header.get('NAXIS1'), header.get('NAXIS2'))
+        frames.append((start, key, file_name))
+    frames.sort()
+
+    groups = []
+    group = []
+    for count, (start, key, file_name) in enumerate(frames):
+        if len(group) != 0 and (key != frames[count - 1][1] or
+                                start - frames[count - 1][0] > MAX_GAP):
+            groups.append(group)
+            group = []
+        group.append(file_name)
+    if len(group) != 0:
+        groups.append(group)
+
+    for group in [group for group in groups if len(group) == 1]:
+        singles.append(group[0])
+    return [group for group in groups if len(group) > 1], singles
+
+
+def _profile(data):
+    """Spatial profile (median along the dispersion) without the sky."""
+    profile = np.median(data, axis=0)
+    return profile - np.median(profile)
+
+
+def trace_offset(profile, reference, max_shift=MAX_SHIFT):
+    """
+    Offset (columns) of a profile from the reference profile, from the peak\
+    of their cross-correlation.
+    """
+    max_shift = min(max_shift, profile.size - 1)
+    core = slice(max_shift, profile.size - max_shift)
+    shifts = np.arange(-max_shift, max_shift + 1)
+    correlation = [np.dot(np.roll(profile, -shift)[core], reference[core])
+                   for shift in shifts]
+    return int(shifts[int(np.argmax(correlation))])
+
+
+def _shift(data, shift):
+    """Columns shifted by -shift, the columns wrapped around are NaN."""
+    shifted = np.roll(data, -shift, axis=1)
+    if shift > 0:
+        shifted[:, -shift:] = np.nan
+    elif shift < 0:
+        shifted[:, :-shift] = np.nan
+    return shifted
+
+
+def _grow(flags, grow=GROW):
+    """Flags extended by grow pixels along the lines and columns."""
+    grown = flags.copy()
+    for shift in range(1, grow + 1):
+        grown[shift:] |= flags[:-shift]
+        grown[:-shift] |= flags[shift:]
+        grown[:, shift:] |= flags[:, :-shift]
+        grown[:, :-shift] |= flags[:, shift:]
+    return grown
+
+
+def stack_reject(data_list, read_noise, ccd_gain, sigma=STACK_SIGMA,
+                 snoise=SENSITIVITY_NOISE, grow=GROW,
+                 iterations=STACK_ITERATIONS):
+    """
+    Reject cosmic rays in a stack of exposures of the same target.
+
+    Parameters
+    ----------
+        data_list : list
+            Images (ADU) of the exposures, of the same size.
+        read_noise: float
+            Read noise of the CCD (e-).
+        ccd_gain  : float
+            Gain of the CCD (e-/ADU).
+        sigma     : float
+            Pixels above the median by sigma times the noise are rejected.
+        snoise    : float
+            Fraction of the signal added to the noise, for the differences
+            of seeing and guiding between the exposures.
+        grow      : int
+            Pixels rejected around a cosmic ray.
+        iterations: int
+            Rejections, the median is made again without the rejected pixels.
+    Returns
+    -------
+        cleaned   : list
+            Cosmic ray corrected images (float32).
+        masks     : list
+            True for the rejected pixels of every image.
+    """
+    data_list = [np.asarray(data, dtype=np.float32) for data in data_list]
+    profiles = [_profile(data) for data in data_list]
+    offsets = [trace_offset(profile, profiles[0]) for profile in profiles]
+    skies = [float(np.median(data)) for data in data_list]
+
+    # flux of the trace sets the scale of every exposure
+    flux = [np.sum(np.clip(profile, 0, None)) for profile in profiles]
+    scales = [f / flux[0] if flux[0] > 0 and f > 0 else 1.0 for f in flux]
+
+    aligned = np.array([_shift(data, offset) for data, offset in
+                        zip(data_list, offsets)])
+    stack = np.array([(frame - sky) / scale for frame, sky, scale in
+                      zip(aligned, skies, scales)])
+
+    sky_noise = (read_noise / ccd_gain) ** 2
+    scales = np.array(scales, dtype=np.float32)[:, None, None]
+    skies = np.array(skies, dtype=np.float32)[:, None, None]
+    flags = np.zeros(stack.shape, dtype=bool)
+    for iteration in range(iterations):
+        # columns shifted out of every exposure are NaN
+        with np.errstate(all='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(np.where(flags, np.nan, stack), axis=0)
+            model = median * scales + skies
+            noise = np.sqrt(sky_noise + np.clip(model, 0, None) / ccd_gain +
+                            (snoise * model) ** 2)
+            new_flags = (aligned - model) > sigma * noise
+        new_flags = np.array([_grow(frame, grow) for frame in new_flags])
+        # a pixel is kept in at least one exposure
+        new_flags[:, new_flags.all(axis=0)] = False
+        if np.array_equal(new_flags, flags):
+            break
+        flags = new_flags
+
+    cleaned = []
+    masks = []
+    for data, frame_flags, frame_model, offset in zip(data_list, flags, model,
+                                                       offsets):
+        mask = np.roll(frame_flags & np.isfinite(frame_model), offset, axis=1)
+        frame_model = np.roll(frame_model, offset, axis=1)
+        data = data.copy()
+        data[mask] = frame_model[mask]
+        cleaned.append(data)
+        masks.append(mask)
+    return cleaned, masks
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -11,9 +11,11 @@ __version__ = '0.0.9'
 # -------------------------------------------------------------------------------------------------------------------- #
 import os
 import glob
-import shutil
 # import re
-from astropy.io import fits
+from hfoscsp.catalog import FrameCatalog
+from hfoscsp.classify import FrameType
+from hfoscsp.classify import classify_frames
+from hfoscsp.classify import GR7, GR8, NO_GRISM
 
 # -------------------------------------------------------------------------------------------------------------------- #
 
@@ -34,53 +36,50 @@ KEYWORDS = {'BIAS': ["bias_snspec", "bias_sn", "bias", "bias snspec",
 class SetCCD:
     """Set CCD parameters from fits file provided."""
 
-    def __init__(self, file_list, location):
-        """Initialise parameters."""
+    def __init__(self, file_list, location, catalog=None):
+        """
+        Initialise parameters from the instrument profile of the frames. The\
+        reduction uses one read noise, gain and saturation for every frame,\
+        so frames taken in more than one instrument mode are refused with\
+        ValueError and have to be reduced in separate folders.
+        """
+        if catalog is None:
+            catalog = FrameCatalog(location=location)
+
+        counts = {}
+        unknown = 0
         for file in file_list:
-            file_name = os.path.join(location, file)
-            hdul = fits.open(file_name)  # HDU_List
-            hdr = hdul[0].header
-            inst = hdr['INSTRUME'].strip(' ')
-
-            if inst == 'HFOSC2':
-                self.ccd = "HFOSC2"  # New HCT CCD # HFOSC2 #
-                self.read_noise = 5.75
-                self.ccd_gain = 0.28
-                self.max_count = 700000
-                break
-            elif inst == "HFOSC":
-                self.ccd = "HFOSC"  # Old HCT CCD # HFOSC #
-                self.read_noise = 4.87
-                self.ccd_gain = 1.22
-                self.max_count = 52000  # 55000 ?
-                break
+            profile = catalog.profile(file)
+            if profile is None:
+                unknown += 1
             else:
-                print("HEADER ERROR")
-
-
-def setccd(file_list, location):
+                counts[profile.mode] = counts.get(profile.mode, 0) + 1
+
+        if unknown != 0:
+            print("HEADER ERROR : INSTRUME of {} frames is not "
+                  "known".format(unknown))
+        if len(counts) == 0:
+            return
+        if len(counts) > 1:
+            modes = ["{} : {} frames".format(mode, counts[mode])
+                     for mode in sorted(counts)]
+            raise ValueError("Frames are taken in {} instrument modes ({}), "
+                             "please move the frames of each mode to a "
+                             "folder of its own".format(len(counts),
+                                                        '; '.join(modes)))
+
+        mode = list(counts)[0]
+        self.profile = catalog.registry.lookup(mode)
+        self.ccd = self.profile.ccd
+        self.read_noise = self.profile.read_noise
+        self.ccd_gain = self.profile.ccd_gain
+        self.max_count = self.profile.max_count
+
+
+def setccd(file_list, location, catalog=None):
     """Select CCD based on header keywords in the fits files."""
-    for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdr = hdul[0].header
-        inst = hdr['INSTRUME'].strip(' ')
-
-        if inst == 'HFOSC2':
-            ccd = "HFOSC2"  # New HCT CCD # HFOSC2 #
-            read_noise = 5.75
-            ccd_gain = 0.28
-            max_count = 700000
-            break
-        elif inst == "HFOSC":
-            ccd = "HFOSC"  # Old HCT CCD # HFOSC #
-            read_noise = 4.87
-            ccd_gain = 1.22
-            max_count = 52000  # 55000 ?
-            break
-        else:
-            print("HEADER ERROR")
-    return read_noise, ccd_gain, max_count, ccd
+    CCD = SetCCD(file_list, location, catalog=catalog)
+    return CCD.read_noise, CCD.ccd_gain, CCD.max_count, CCD.ccd
 
 
 def Backup(BACKUPDIR):
@@ -149,7 +148,7 @@ def list_subdir():
     return sub_directories
 
 
-def spec_or_phot(file_list, location, CCD, func=''):
+def spec_or_phot(file_list, location, CCD, func='', catalog=None):
     """
     Check whether the file contains spectroscopy of photometry data and make\
     separate list for both spectroscopy and photometry with respective file\
@@ -163,8 +162,11 @@ def spec_or_phot(file_list, location, CCD, func=''):
         location : str
             Location of the files if it is not in the working directory
         func     : str ('spec' or 'phot')
-            type of files need keep in original folder as it is. Remaining
-            files will be moved to other directory.
+            type of files used by the later stages. Files are not moved, the
+            split is recorded in the manifest of the catalog and the other
+            type of files are left out by the list_* functions.
+        catalog  : FrameCatalog
+            Catalog of the night folder, headers are read if not provided.
     Returns
     -------
         spec_list: list
@@ -172,54 +174,42 @@ def spec_or_phot(file_list, location, CCD, func=''):
         phot_list: list
             List of photometric files
     """
-    if CCD.ccd == "HFOSC":
-        index = 0
-    elif CCD.ccd == "HFOSC2":
-        index = 1
+    # NAXIS1 and NAXIS2 in the catalog are taken from the image extension
+    # (hdul[1] for HFOSC2 and hdul[0] for HFOSC).
+    if catalog is None:
+        catalog = FrameCatalog(file_list, location)
 
     spec_list = []
     phot_list = []
-    spec_list_fullname = []
-    phot_list_fullname = []
+    entries = []
     for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdul[index].header
-        hdr = hdul[index].header
-        AXIS1 = hdr['NAXIS1']
-        AXIS2 = hdr['NAXIS2']
-        value = AXIS2/AXIS1
-        if value > 2:
+        if file in catalog.manifest:
+            kind, value = catalog.manifest[file][:2]
+        else:
+            AXIS1 = catalog.value(file, 'NAXIS1')
+            AXIS2 = catalog.value(file, 'NAXIS2')
+            value = float(AXIS2)/AXIS1 if AXIS1 else 0.0
+            kind = 'spec' if value > 2 else 'phot'
+
+        if kind == 'spec':
             spec_list.append(file)
-            spec_list_fullname.append(file_name)
-        elif value <= 2:
+        else:
             phot_list.append(file)
-            phot_list_fullname.append(file_name)
-
-    if func == 'spec':
-        try:
-            pathloc = os.path.join(location, 'phot')
-            os.mkdir(pathloc)
-            for file in phot_list_fullname:
-                shutil.move(file, pathloc)
+        entries.append((file, kind, value, func in ('', kind)))
 
-        except OSError as error:
-            print(error)
+    catalog.record(entries)
+    print("Spectroscopic files :", len(spec_list), "Photometric files :",
+          len(phot_list))
 
-    elif func == 'phot':
-        try:
-            pathloc = os.path.join(location, 'spec')
-            os.mkdir(pathloc)
-            for file in spec_list_fullname:
-                shutil.move(file, pathloc)
+    return spec_list, phot_list
 
-        except OSError as error:
-            print(error)
 
-    return spec_list, phot_list
+def _files(frames, selection):
+    """File names of the classified frames selected by a boolean mask."""
+    return frames['file'][selection].tolist()
 
 
-def list_bias(file_list, location='', keywords=KEYWORDS):
+def list_bias(file_list, location='', keywords=KEYWORDS, catalog=None):
     """
     Identify bias files from file_list provided by looking the header keyword\
     in the files.
@@ -231,6 +221,8 @@ def list_bias(file_list, location='', keywords=KEYWORDS):
             identify.
         location    : str
             Location of the files if it is not in the working directory.
+        catalog     : FrameCatalog
+            Catalog of the night folder, headers are read if not provided.
     Returns
     -------
         bias_list   : list
@@ -238,15 +230,12 @@ def list_bias(file_list, location='', keywords=KEYWORDS):
         passing_list: list
             Remaining files after removing bias files from the file_list.
     """
-    bias_list = []
-    for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdr = hdul[0].header        # Primary HDU header
-        OBJECT = hdr['OBJECT']
+    if catalog is None:
+        catalog = FrameCatalog(file_list, location)
+    file_list = catalog.selected(file_list)
 
-        if OBJECT.lower() in keywords['BIAS']:
-            bias_list.append(file)
+    frames = classify_frames(file_list, catalog, keywords)
+    bias_list = _files(frames, frames['ftype'] == FrameType.BIAS)
 
     passing_list = list(set(file_list).difference(bias_list))
     passing_list.sort()
@@ -298,7 +287,7 @@ def write_list(file_list, file_name, location=''):
                 f.write(file+'\n')
 
 
-def list_flat(file_list, location='', keywords=KEYWORDS):
+def list_flat(file_list, location='', keywords=KEYWORDS, catalog=None):
     """
     From the file_list provided, separate files into flat files and further\
     separate them into grism7 and grism8 files.
@@ -309,6 +298,8 @@ def list_flat(file_list, location='', keywords=KEYWORDS):
             List of files need to separate.
         location : str
             Location of the files if it is not in the working directory.
+        catalog  : FrameCatalog
+            Catalog of the night folder, headers are read if not provided.
     Returns
     -------
         flat_list    : list
@@ -320,42 +311,21 @@ def list_flat(file_list, location='', keywords=KEYWORDS):
         passing_list : list
             List of rest of the files in file-list.
     """
-    flat_list = []
-    flat_list_gr7 = []
-    flat_list_gr8 = []
-    passing_list = []
+    if catalog is None:
+        catalog = FrameCatalog(file_list, location)
+    file_list = catalog.selected(file_list)
 
-    for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdr = hdul[0].header         # Primary HDU header
-        OBJECT = hdr['OBJECT']
-        GRISM = hdr['GRISM']
-
-        try:
-            COMMENT = hdr['COMMENT']
-        except:
-            COMMENT = ''
-
-
-        if OBJECT.lower() in keywords['FLAT']:
-            flat_list.append(file)
-            if GRISM.lower() in keywords['GR7']:
-                flat_list_gr7.append(file)
-            elif GRISM.lower() in keywords['GR8']:
-                flat_list_gr8.append(file)
-            elif COMMENT != '':
-                GRISM = COMMENT[0][3:6]
-                if GRISM.lower() in keywords['GR7']:
-                    flat_list_gr7.append(file)
-                elif GRISM.lower() in keywords['GR8']:
-                    flat_list_gr8.append(file)
-            else:
-                print(file)
-                print("There is error in header term : GRISM")
+    frames = classify_frames(file_list, catalog, keywords)
+    is_flat = frames['ftype'] == FrameType.FLAT
 
-        else:
-            passing_list.append(file)
+    flat_list = _files(frames, is_flat)
+    flat_list_gr7 = _files(frames, is_flat & (frames['grism'] == GR7))
+    flat_list_gr8 = _files(frames, is_flat & (frames['grism'] == GR8))
+    passing_list = _files(frames, ~is_flat)
+
+    for file in _files(frames, is_flat & (frames['grism'] == NO_GRISM)):
+        print(file)
+        print("There is error in header term : GRISM")
 
     print('Grism 7 flat files :', flat_list_gr7)
     print('Grism 8 flat files :', flat_list_gr8)
@@ -363,7 +333,7 @@ def list_flat(file_list, location='', keywords=KEYWORDS):
     return flat_list, flat_list_gr7, flat_list_gr8, passing_list
 
 
-def list_lamp(file_list, location='', keywords=KEYWORDS):
+def list_lamp(file_list, location='', keywords=KEYWORDS, catalog=None):
     """
     From the file_list provided, separate files into lamp files and further\
     separate them into grism7 and grism8 files.
@@ -374,6 +344,8 @@ def list_lamp(file_list, location='', keywords=KEYWORDS):
             List of files need to separate.
         location : str
             Location of the files if it is not in the working directory.
+        catalog  : FrameCatalog
+            Catalog of the night folder, headers are read if not provided.
     Returns
     -------
         lamp_list_gr7: list
@@ -383,33 +355,20 @@ def list_lamp(file_list, location='', keywords=KEYWORDS):
         passing_list : list
             List of rest of the files in file-list.
     """
-    lamp_list_gr7 = []
-    lamp_list_gr8 = []
+    if catalog is None:
+        catalog = FrameCatalog(file_list, location)
+    file_list = catalog.selected(file_list)
 
-    for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdr = hdul[0].header         # Primary HDU header
-        OBJECT = hdr['OBJECT']
-        GRISM = hdr['GRISM']
-        LAMP = hdr['LAMP']
-
-        if OBJECT.lower() in keywords['FEAR']:
-            lamp_list_gr7.append(file)
-        elif OBJECT.lower() in keywords['FENE']:
-            lamp_list_gr8.append(file)
-        # For HFOSC1 old CCD, not kept using from KEYWORDS
-        elif (OBJECT.lower() == "lamp"):
-            if LAMP.lower() in keywords['FEAR']:
-                lamp_list_gr7.append(file)
-            elif LAMP.lower() in keywords['FENE']:
-                lamp_list_gr8.append(file)
+    # FeAr lamp is used for grism 7 and FeNe lamp for grism 8.
+    frames = classify_frames(file_list, catalog, keywords)
+    lamp_list_gr7 = _files(frames, frames['ftype'] == FrameType.LAMP_FEAR)
+    lamp_list_gr8 = _files(frames, frames['ftype'] == FrameType.LAMP_FENE)
 
     passing_list = list(set(file_list).difference(lamp_list_gr7).difference(lamp_list_gr8))
     return lamp_list_gr7, lamp_list_gr8, passing_list
 
 
-def list_object(file_list, location='', keywords=KEYWORDS):
+def list_object(file_list, location='', keywords=KEYWORDS, catalog=None):
     """
     From the file_list provided, separate files into object files and further\
     separate them into grism7 and grism8 files.
@@ -420,6 +379,8 @@ def list_object(file_list, location='', keywords=KEYWORDS):
             List of files need to separate.
         location : str
             Location of the files if it is not in the working directory.
+        catalog  : FrameCatalog
+            Catalog of the night folder, headers are read if not provided.
     Returns
     -------
         obj_list    : list
@@ -431,44 +392,23 @@ def list_object(file_list, location='', keywords=KEYWORDS):
         passing_list : list
             List of rest of the files in file-list.
     """
-    obj_list = []
-    obj_list_gr7 = []
-    obj_list_gr8 = []
-    passing_list = []
-    for file in file_list:
-        file_name = os.path.join(location, file)
-        hdul = fits.open(file_name)  # HDU_List
-        hdr = hdul[0].header         # Primary HDU header
-        OBJECT = hdr['OBJECT']
-        print(file)
-        GRISM = hdr['GRISM']
-
-        try:
-            COMMENT = hdr['COMMENT']
-        except:
-            COMMENT = ''
-
-        if OBJECT.lower() not in (
-                keywords['BIAS'] + keywords['FLAT'] + keywords['LAMP']):
-            obj_list.append(file)
-            if GRISM.lower() in keywords['GR7']:
-                obj_list_gr7.append(file)
-            elif GRISM.lower() in keywords['GR8']:
-                obj_list_gr8.append(file)
-
-            elif COMMENT != '':
-                GRISM = COMMENT[0][3:6]
-                print("GRISM from comment term : ",GRISM)
-                if GRISM.lower() in keywords['GR7']:
-                    obj_list_gr7.append(file)
-                elif GRISM.lower() in keywords['GR8']:
-                    obj_list_gr8.append(file)
+    if catalog is None:
+        catalog = FrameCatalog(file_list, location)
+    file_list = catalog.selected(file_list)
 
-            else:
-                print(file)
-                print("There is error in header term : GRISM")
-        else:
-            passing_list.append(file)
+    # Standard stars are also object files.
+    frames = classify_frames(file_list, catalog, keywords)
+    is_obj = ((frames['ftype'] == FrameType.OBJECT) |
+              (frames['ftype'] == FrameType.STANDARD))
+
+    obj_list = _files(frames, is_obj)
+    obj_list_gr7 = _files(frames, is_obj & (frames['grism'] == GR7))
+    obj_list_gr8 = _files(frames, is_obj & (frames['grism'] == GR8))
+    passing_list = _files(frames, ~is_obj)
+
+    for file in _files(frames, is_obj & (frames['grism'] == NO_GRISM)):
+        print(file)
+        print("There is error in header term : GRISM")
 
     # passing_list = list(set(file_list).difference(obj_list_gr7).difference(obj_list_gr8))
     return obj_list, obj_list_gr7, obj_list_gr8, passing_list
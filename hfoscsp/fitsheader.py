@@ -0,0 +1,123 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing a header-only FITS reader. Only the 2880-byte header blocks
+are read up to the END card, pixel data is skipped with a seek and the file
+is closed right away, so no file handles or memory maps are left open.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+from astropy.io import fits
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+BLOCK_SIZE = 2880  # FITS logical record
+CARD_SIZE = 80     # FITS header card
+END_CARD = b'END' + b' ' * 5
+
+
+def _read_header_blocks(f):
+    """
+    Read header blocks from the present position of the file up to the END\
+    card.
+
+    Parameters
+    ----------
+        f     : file
+            FITS file opened in binary mode.
+    Returns
+    -------
+        header: bytes or None
+            Header blocks, None at the end of the file.
+    """
+    blocks = []
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            if len(blocks) == 0 and len(block) == 0:
+                return None
+            raise IOError("Truncated FITS header in " + str(f.name))
+        blocks.append(block)
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            if block[i:i+8] == END_CARD:
+                return b''.join(blocks)
+
+
+def data_size(header):
+    """
+    Size of the data unit following a header, padded to the FITS block size.
+
+    Parameters
+    ----------
+        header: astropy.io.fits.Header
+            Header of the HDU.
+    Returns
+    -------
+        size  : int
+            Number of bytes to skip to reach the next HDU.
+    """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+
+    n_pixels = 1
+    for i in range(1, naxis + 1):
+        n_pixels *= header.get('NAXIS' + str(i), 0)
+
+    size = (abs(header.get('BITPIX', 8)) // 8 * header.get('GCOUNT', 1)
+            * (header.get('PCOUNT', 0) + n_pixels))
+    return ((size + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def read_headers(file_name, max_ext=None):
+    """
+    Read the headers of the HDUs in a FITS file without reading the data.
+
+    Parameters
+    ----------
+        file_name: str
+            Name of the fits file with complete path.
+        max_ext  : int
+            Index of the last HDU to read, all HDUs are read if not provided.
+    Returns
+    -------
+        headers  : list
+            List of astropy.io.fits.Header, one for each HDU read.
+    """
+    headers = []
+    with open(file_name, 'rb') as f:
+        while max_ext is None or len(headers) <= max_ext:
+            raw = _read_header_blocks(f)
+            if raw is None:
+                break
+            header = fits.Header.fromstring(raw.decode('ascii'))
+            headers.append(header)
+            f.seek(data_size(header), 1)
+    return headers
+
+
+def read_header(file_name, ext=0):
+    """
+    Read the header of a single HDU without reading the data.
+
+    Parameters
+    ----------
+        file_name: str
+            Name of the fits file with complete path.
+        ext      : int
+            Index of the HDU (e.g.: 1 for the image extension of HFOSC2).
+    Returns
+    -------
+        header   : astropy.io.fits.Header
+            Header of the HDU.
+    """
+    headers = read_headers(file_name, max_ext=ext)
+    if len(headers) <= ext:
+        raise IndexError("Extension " + str(ext) + " is not found in " +
+                         str(file_name))
+    return headers[ext]
+
+# -------------------------------------------------------------------------------------------------------------------- #
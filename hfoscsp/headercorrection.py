@@ -2,6 +2,7 @@
 import os
 from astropy.io import fits
 from astropy.io import ascii
+from hfoscsp.fitsheader import read_header
 # from hfoscsp.file_management import search_files
 from hfoscsp.interactive import options
 from astroquery.simbad import Simbad
@@ -29,8 +30,7 @@ def headcorr_k(file_list, location=''):
         else:
             loc = os.path.join(os.getcwd(), filename)
 
-        hdu = fits.open(loc)
-        header = hdu[0].header
+        header = read_header(loc)
 
         # HFOSC
         if 'TM_START' in header.keys():
@@ -180,8 +180,7 @@ def headcorr(file_list, location=''):
         else:
             loc = os.path.join(os.getcwd(), filename)
 
-        hdu = fits.open(loc)
-        header = hdu[0].header
+        header = read_header(loc)
 
         # HFOSC
         if 'TM_START' in header.keys():
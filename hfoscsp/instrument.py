@@ -0,0 +1,129 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the instrument profile registry. Detector parameters (read
+noise, gain and saturation) are kept for every instrument, and a profile is
+made once for each instrument, binning and readout mode found in the frames.
+The frame catalog attaches a profile to every frame.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Detector parameters of the instruments (read noise in e-, gain in e-/ADU,
+# saturation in ADU).
+INSTRUMENTS = {'HFOSC': {'read_noise': 4.87,    # Old HCT CCD # HFOSC #
+                         'ccd_gain': 1.22,
+                         'max_count': 52000},   # 55000 ?
+               'HFOSC2': {'read_noise': 5.75,   # New HCT CCD # HFOSC2 #
+                          'ccd_gain': 0.28,
+                          'max_count': 700000}}
+
+# Parameters of a particular (instrument, binning, readout) mode, when they
+# differ from INSTRUMENTS, e.g.
+# MODES[('HFOSC', '1 1', 'LOW')] = {'ccd_gain': ...}
+MODES = {}
+
+# Header term of the readout mode: gain mode of HFOSC and readout speed
+# (pix/sec) of HFOSC2.
+READOUT_KEYWORDS = {'HFOSC': 'GAINM', 'HFOSC2': 'FPIX'}
+
+DEFAULT_BINNING = '1 1'
+
+
+class InstrumentProfile:
+    """Detector parameters of an instrument in a binning and readout mode."""
+
+    def __init__(self, ccd, binning, readout, read_noise, ccd_gain, max_count):
+        self.ccd = ccd
+        self.binning = binning
+        self.readout = readout
+        self.read_noise = read_noise
+        self.ccd_gain = ccd_gain
+        self.max_count = max_count
+
+    @property
+    def mode(self):
+        """(instrument, binning, readout) of the profile."""
+        return self.ccd, self.binning, self.readout
+
+    def __repr__(self):
+        return ("InstrumentProfile({}, binning='{}', readout='{}', "
+                "read_noise={}, ccd_gain={}, max_count={})".format(
+                    self.ccd, self.binning, self.readout, self.read_noise,
+                    self.ccd_gain, self.max_count))
+
+
+def frame_mode(row):
+    """
+    Instrument, binning and readout mode of a frame.
+
+    Parameters
+    ----------
+        row : dict
+            Catalog row of the frame.
+    Returns
+    -------
+        mode: tuple
+            (instrument, binning, readout) as strings.
+    """
+    instrument = str(row.get('INSTRUME', '')).strip()
+    binning = ' '.join(str(row.get('CCDSUM', '')).split())
+    if binning == '':
+        binning = DEFAULT_BINNING
+    readout = str(row.get(READOUT_KEYWORDS.get(instrument, ''), '')).strip()
+    return instrument, binning, readout
+
+
+class ProfileRegistry:
+    """Profiles of every instrument mode seen, made once for each mode."""
+
+    def __init__(self, instruments=None, modes=None):
+        """
+        Parameters
+        ----------
+            instruments: dict
+                Detector parameters of the instruments, INSTRUMENTS if None.
+            modes      : dict
+                Parameters of particular modes, MODES if None.
+        """
+        self.instruments = INSTRUMENTS if instruments is None else instruments
+        self.modes = MODES if modes is None else modes
+        self._profiles = {}
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def lookup(self, mode):
+        """
+        Profile of an (instrument, binning, readout) mode.
+
+        Returns
+        -------
+            profile: InstrumentProfile
+                Profile of the mode, None if the instrument is not known.
+        """
+        if mode in self._profiles:
+            return self._profiles[mode]
+
+        if mode[0] not in self.instruments:
+            profile = None
+        else:
+            parameters = dict(self.instruments[mode[0]])
+            parameters.update(self.modes.get(mode, {}))
+            profile = InstrumentProfile(mode[0], mode[1], mode[2],
+                                        **parameters)
+        self._profiles[mode] = profile
+        return profile
+
+    def profile(self, row):
+        """Profile of a frame from its catalog row, None if not known."""
+        return self.lookup(frame_mode(row))
+
+
+# Registry shared by every catalog of the process.
+REGISTRY = ProfileRegistry()
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,82 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the directory inventory of a night folder. The folder is
+listed once with os.scandir and the reduction steps report the files they
+create and remove, so the inventory is updated in place instead of listing
+the folder again after every step.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import fnmatch
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+class Inventory:
+    """Names of the files in a night folder."""
+
+    def __init__(self, location=''):
+        """
+        List the files in the location provided.
+
+        Parameters
+        ----------
+            location: str
+                Location of the files if it is not in the working directory.
+        """
+        self.location = location
+        self.files = set()
+        self.scan()
+
+    def scan(self):
+        """List the folder again, e.g. after files are restored from backup."""
+        pathloc = os.path.join(os.getcwd(), self.location)
+        self.files = set()
+        for entry in os.scandir(pathloc):
+            if entry.is_file():
+                self.files.add(entry.name)
+
+    def search(self, keyword):
+        """
+        Files with names matching the keyword, same as search_files().
+
+        Parameters
+        ----------
+            keyword  : str
+                Keyword in the name of the file e.g.: "*.fits"
+        Returns
+        -------
+            file_list: list
+                List of files with the input keyword.
+        """
+        file_list = fnmatch.filter(sorted(self.files), keyword)
+        if not keyword.startswith('.'):
+            # hidden files are not listed by glob either
+            file_list = [file for file in file_list if not file.startswith('.')]
+        return file_list
+
+    def update(self, created=(), removed=()):
+        """
+        Update the inventory with the files created and removed by a step.
+
+        Parameters
+        ----------
+            created: list
+                Files created in the folder (name or path).
+            removed: list
+                Files removed from the folder (name or path).
+        Returns
+        -------
+            none
+        """
+        for file in removed:
+            self.files.discard(os.path.basename(str(file)))
+        for file in created:
+            self.files.add(os.path.basename(str(file)))
+
+# -------------------------------------------------------------------------------------------------------------------- #
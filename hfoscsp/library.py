@@ -0,0 +1,244 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the master-calibration library shared by the nights. Masters
+are kept in a folder in the working directory with a SQLite index, keyed by
+instrument mode (instrument, binning, readout) and date. A night without
+calibrations uses the master of the nearest date within a time window. Masters
+not used for long, or the least recently used ones above the size limit, are
+removed. Bad-pixel masks are kept once for every instrument mode.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import time
+import shutil
+import sqlite3
+import datetime
+
+from hfoscsp.association import frame_time, EPOCH
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+LIBRARY_DIR = 'HFOSC_Calibrations'  # in the working directory
+LIBRARY_INDEX = 'library.sqlite'
+
+REUSE_WINDOW = 7           # days, masters of other nights used within this
+MAX_SIZE = 2 * 1024 ** 3   # bytes
+MAX_AGE = 365              # days since the master was last used
+
+
+def night_date(file_list, catalog):
+    """
+    Date (UT) of a night from the earliest frame.
+
+    Parameters
+    ----------
+        file_list: list
+            List of files of the night.
+        catalog  : FrameCatalog
+            Catalog containing the files.
+    Returns
+    -------
+        date     : str
+            'YYYY-MM-DD', None if no frame has a time of observation.
+    """
+    catalog.update(file_list)
+    times = [frame_time(catalog.row(file)) for file in file_list]
+    times = [t for t in times if t is not None]
+    if len(times) == 0:
+        return None
+    start = EPOCH + datetime.timedelta(seconds=min(times))
+    return start.strftime('%Y-%m-%d')
+
+
+def _days(date, other):
+    """Number of days between two 'YYYY-MM-DD' dates."""
+    date = datetime.datetime.strptime(date, '%Y-%m-%d')
+    other = datetime.datetime.strptime(other, '%Y-%m-%d')
+    return abs((date - other).days)
+
+
+class CalibrationLibrary:
+    """Master calibrations of every night, keyed by instrument mode and date."""
+
+    def __init__(self, location=None, window=REUSE_WINDOW, max_size=MAX_SIZE,
+                 max_age=MAX_AGE):
+        """
+        Open (or create) the library.
+
+        Parameters
+        ----------
+            location: str
+                Folder of the library, LIBRARY_DIR in the working directory if
+                None.
+            window  : float
+                Masters of other nights are used within this many days.
+            max_size: int
+                Size (bytes) of the library kept by evict().
+            max_age : float
+                Masters not used for this many days are removed by evict().
+        """
+        if location is None:
+            location = os.path.join(os.getcwd(), LIBRARY_DIR)
+        self.location = location
+        self.window = window
+        self.max_size = max_size
+        self.max_age = max_age
+
+        if not os.path.isdir(location):
+            os.makedirs(location)
+        # Nights reduced in parallel share the index.
+        self.connection = sqlite3.connect(os.path.join(location,
+                                                       LIBRARY_INDEX),
+                                          timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS masters "
+                                    "(file TEXT PRIMARY KEY, kind TEXT, "
+                                    "instrument TEXT, binning TEXT, "
+                                    "readout TEXT, date TEXT, size INTEGER, "
+                                    "created REAL, used REAL)")
+
+    @staticmethod
+    def file_name(kind, mode, date=None, extension='.fits'):
+        """Name of a master in the library."""
+        parts = [kind] + list(mode)
+        if date is not None:
+            parts.append(date)
+        return '_'.join(str(part).replace(' ', 'x') for part in parts) + \
+            extension
+
+    def mask_file(self, mode):
+        """Bad-pixel mask of an instrument mode, one for every detector."""
+        return os.path.join(self.location,
+                            self.file_name('bpm', mode, extension='.npz'))
+
+    def store(self, kind, mode, date, file_name):
+        """
+        Copy a master into the library, replacing the one of the same date.
+
+        Parameters
+        ----------
+            kind     : str
+                Type of master, e.g. 'bias'.
+            mode     : tuple
+                (instrument, binning, readout) of the frames.
+            date     : str
+                Date of the night 'YYYY-MM-DD'.
+            file_name: str
+                Master file with complete path.
+        Returns
+        -------
+            stored   : str
+                Master in the library with complete path.
+        """
+        name = self.file_name(kind, mode, date)
+        stored = os.path.join(self.location, name)
+        shutil.copy(file_name, stored)
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO masters VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, kind, mode[0], mode[1], mode[2], date,
+                 os.path.getsize(stored), now, now))
+        print("Stored " + name + " in the calibration library")
+        self.evict()
+        return stored
+
+    def _find(self, kind, mode, date):
+        """Nearest master within the window as (days, date, file)."""
+        if date is None:
+            return None
+        rows = self.connection.execute(
+            "SELECT file, date FROM masters WHERE kind = ? AND "
+            "instrument = ? AND binning = ? AND readout = ?",
+            (kind, mode[0], mode[1], mode[2])).fetchall()
+        candidates = []
+        for file, master_date in rows:
+            if not os.path.isfile(os.path.join(self.location, file)):
+                continue
+            days = _days(date, master_date)
+            if days <= self.window:
+                # nearest date, earlier night if two are as near
+                candidates.append((days, master_date, file))
+        if len(candidates) == 0:
+            return None
+        return min(candidates)
+
+    def has_master(self, kind, mode, date):
+        """True if lookup() finds a master for the night."""
+        return self._find(kind, mode, date) is not None
+
+    def lookup(self, kind, mode, date):
+        """
+        Master of the nearest date within the window.
+
+        Parameters
+        ----------
+            kind: str
+                Type of master, e.g. 'bias'.
+            mode: tuple
+                (instrument, binning, readout) of the frames.
+            date: str
+                Date of the night 'YYYY-MM-DD' (None finds nothing).
+        Returns
+        -------
+            file: str
+                Master with complete path, None if there is none.
+            days: int
+                Days between the night and the master.
+        """
+        found = self._find(kind, mode, date)
+        if found is None:
+            return None, None
+
+        days, master_date, file = found
+        with self.connection:
+            self.connection.execute("UPDATE masters SET used = ? WHERE "
+                                    "file = ?", (time.time(), file))
+        return os.path.join(self.location, file), days
+
+    def evict(self):
+        """
+        Remove masters not used within max_age days, then the least recently\
+        used masters until the library is within max_size.
+
+        Returns
+        -------
+            removed: list
+                Masters removed from the library.
+        """
+        rows = self.connection.execute(
+            "SELECT file, size, used FROM masters ORDER BY used").fetchall()
+        oldest = time.time() - self.max_age * 86400.0
+        total = sum(row[1] for row in rows)
+
+        removed = []
+        for file, size, used in rows:
+            missing = not os.path.isfile(os.path.join(self.location, file))
+            if missing or used < oldest or total > self.max_size:
+                removed.append(file)
+                total -= size
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM masters WHERE file = ?",
+                                        [(file,) for file in removed])
+        for file in removed:
+            try:
+                os.remove(os.path.join(self.location, file))
+            except OSError:
+                pass
+        if len(removed) != 0:
+            print("Removed {} masters from the calibration "
+                  "library".format(len(removed)))
+        return removed
+
+    def close(self):
+        """Close the index of the library."""
+        self.connection.close()
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,226 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the multi-night driver. Every dated night folder returned
+by list_subdir() is reduced in its own worker process. The interactive steps
+(aperture selection, line identification, flux calibration) can not be run
+side by side, so the driver runs the non-interactive front part of the
+pipeline: catalog, spectroscopic/photometric split, bias correction and
+optionally the batch cosmic-ray correction. The IRAF tasks share one uparm
+directory, so the IRAF steps of the nights run one at a time and the IRAF
+cosmic-ray modules are not offered.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tabulate import tabulate
+
+from hfoscsp.file_management import list_subdir
+from hfoscsp.file_management import spec_or_phot
+from hfoscsp.file_management import list_bias
+from hfoscsp.file_management import list_object
+from hfoscsp.file_management import list_flat
+from hfoscsp.file_management import SetCCD
+from hfoscsp.catalog import FrameCatalog
+from hfoscsp.inventory import Inventory
+from hfoscsp.library import CalibrationLibrary
+from hfoscsp.crcache import ResultCache
+from hfoscsp.library import night_date
+from hfoscsp.badpixel import detector_mask
+from hfoscsp.reduction import bias_correction
+from hfoscsp.reduction import ccdsec_removal
+from hfoscsp.cosmicray import cosmic_correction_batch
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+LOG_FILE = 'hfoscsp_night.log'           # written in every night folder
+SUMMARY_FILE = 'hfoscsp_nights_summary'  # written in the working directory
+
+SUMMARY_KEYS = ['night', 'status', 'frames', 'spec', 'phot', 'bias',
+                'objects', 'time', 'log']
+
+# Cosmic ray correction modules which can run in the nights side by side.
+PARALLEL_COSMIC_METHODS = ['la_cosmic']
+
+# Lock of the IRAF steps, shared by the night processes (see _init_night).
+_iraf_lock = None
+
+
+def _init_night(lock):
+    """Keep the lock of the IRAF steps in a night process."""
+    global _iraf_lock
+    _iraf_lock = lock
+
+
+def reduce_night(folder_name, cosmic_method=None, defer=False):
+    """
+    Run the non-interactive reduction steps for a night folder. Everything\
+    printed by the pipeline goes into the log file of the night.
+
+    Parameters
+    ----------
+        folder_name  : str
+            Name of the night folder in the working directory.
+        cosmic_method: str ('irafcrmedian', 'irafcosmicrays', 'la_cosmic')
+            Cosmic ray correction module, no cosmic ray correction if None.
+        defer        : bool
+            Stop with the status 'deferred' if the night has no bias frames,
+            so that it is reduced after the masters of the other nights
+            are in the calibration library.
+    Returns
+    -------
+        summary      : dict
+            Summary of the night with the keys in SUMMARY_KEYS.
+    """
+    start = time.time()
+    PATH = os.path.join(os.getcwd(), folder_name)
+    summary = dict((key, 0) for key in SUMMARY_KEYS)
+    summary.update({'night': folder_name, 'status': 'failed',
+                    'log': os.path.join(PATH, LOG_FILE)})
+
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(summary['log'], 'w') as log:
+        sys.stdout = sys.stderr = log
+        try:
+            inventory = Inventory(PATH)
+            list_files = inventory.search('*.fits')
+            catalog = FrameCatalog(list_files, PATH, persistent=True)
+            CCD = SetCCD(file_list=list_files, location=PATH, catalog=catalog)
+            summary['frames'] = len(list_files)
+
+            speclist, photlist = spec_or_phot(list_files, PATH, CCD, 'spec',
+                                              catalog=catalog)
+            bias_list, passing_list = list_bias(speclist, PATH,
+                                                catalog=catalog)
+            summary.update({'spec': len(speclist), 'phot': len(photlist),
+                            'bias': len(bias_list)})
+
+            library = CalibrationLibrary()
+            date = night_date(speclist, catalog)
+            if len(bias_list) == 0 and defer:
+                print('Bias list is empty, the night is reduced after the '
+                      'nights with bias files')
+                summary['status'] = 'deferred'
+            elif len(bias_list) == 0 and \
+                    not library.has_master('bias', CCD.profile.mode, date):
+                print('Bias list is empty, please check header of bias files')
+                summary['status'] = 'no bias'
+            else:
+                # zerocombine, imarith and hedit are IRAF tasks
+                if _iraf_lock is not None:
+                    _iraf_lock.acquire()
+                try:
+                    bias_correction(bias_list, passing_list, CCD, PATH,
+                                    inventory=inventory, library=library,
+                                    date=date)
+                    list_files = inventory.search('*.fits')
+                    ccdsec_removal(file_list=catalog.selected(list_files),
+                                   location=PATH)
+                finally:
+                    if _iraf_lock is not None:
+                        _iraf_lock.release()
+
+                catalog.refresh(list_files)
+                obj_list, obj_list_gr7, obj_list_gr8, passing_list = \
+                    list_object(list_files, PATH, catalog=catalog)
+                summary['objects'] = len(obj_list)
+
+                if cosmic_method is not None:
+                    flat_list = list_flat(list_files, PATH,
+                                          catalog=catalog)[0]
+                    mask = detector_mask(library, CCD.profile.mode,
+                                         os.path.join(PATH, 'Backup',
+                                                      'master-bias.fits'),
+                                         [os.path.join(PATH, file)
+                                          for file in flat_list])
+                    cache = ResultCache()
+                    cosmic_correction_batch(obj_list, CCD=CCD, location=PATH,
+                                            method=cosmic_method, verify='No',
+                                            inventory=inventory, mask=mask,
+                                            roi='No', stack='No', cache=cache)
+                    cache.close()
+                summary['status'] = 'done'
+
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    summary['time'] = round(time.time() - start, 1)
+    return summary
+
+
+def reduce_nights(nights=None, workers=None, cosmic_method=None):
+    """
+    Reduce night folders in parallel, one night for each worker process.\
+    Nights without bias frames are reduced after the other nights, so the\
+    master they take from the calibration library does not depend on which\
+    night finishes first.
+
+    Parameters
+    ----------
+        nights       : list
+            Night folders to reduce, all folders from list_subdir() if None.
+        workers      : int
+            Number of worker processes, one for each night (up to the
+            number of CPUs) if None.
+        cosmic_method: str ('la_cosmic')
+            Cosmic ray correction module passed to reduce_night, one of
+            PARALLEL_COSMIC_METHODS.
+    Returns
+    -------
+        summaries    : list
+            Summary of every night, in the order of nights.
+    """
+    if cosmic_method is not None and \
+            cosmic_method not in PARALLEL_COSMIC_METHODS:
+        raise ValueError("IRAF cosmic ray modules share their parameter "
+                         "files, use one of " + str(PARALLEL_COSMIC_METHODS))
+    if nights is None:
+        nights = list_subdir()
+    if len(nights) == 0:
+        print("No night folders found in " + os.getcwd())
+        return []
+    if workers is None:
+        workers = min(len(nights), os.cpu_count() or 1)
+
+    print("Reducing {} nights with {} workers".format(len(nights), workers))
+    start = time.time()
+    lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_night,
+                             initargs=(lock,)) as executor:
+        summaries = list(executor.map(reduce_night, nights,
+                                      [cosmic_method] * len(nights),
+                                      [True] * len(nights)))
+
+        deferred = [count for count, summary in enumerate(summaries)
+                    if summary['status'] == 'deferred']
+        if len(deferred) != 0:
+            print("Reducing {} nights without bias files".format(
+                len(deferred)))
+            results = executor.map(reduce_night,
+                                   [nights[count] for count in deferred],
+                                   [cosmic_method] * len(deferred))
+            for count, summary in zip(deferred, results):
+                summaries[count] = summary
+
+    table = [[summary[key] for key in SUMMARY_KEYS] for summary in summaries]
+    text = tabulate(table, headers=SUMMARY_KEYS)
+    print("")
+    print(text)
+    print("")
+    print("All nights finished in {:.1f} s".format(time.time() - start))
+
+    with open(os.path.join(os.getcwd(), SUMMARY_FILE), 'w') as f:
+        f.write(text + '\n')
+    return summaries
+
+# -------------------------------------------------------------------------------------------------------------------- #
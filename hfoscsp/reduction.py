@@ -13,9 +13,12 @@ __version__ = '0.0.10'
 # -------------------------------------------------------------------------------------------------------------------- #
 import os
 import shutil
-from astropy.io import fits
+from hfoscsp.fitsheader import read_header
 from hfoscsp.interactive import options
 from hfoscsp.airmass import airmass
+from hfoscsp.combine import update_master
+from hfoscsp.bias import subtract_bias
+from hfoscsp.badpixel import fix_file
 
 try:
     from pyraf import iraf
@@ -94,10 +97,13 @@ def ccdsec_removal(file_list, location=''):
 
 
 def bias_correction(bias_list, list_file, CCD, location='',
-                    prefix_string='b_'):
+                    prefix_string='b_', inventory=None, method='iraf',
+                    library=None, date=None, workers=1):
     """
     From the input bias_list make master-bias, do bias correction to rest of \
     files in the directory, remove all past files and backup master-bias file.
+    If the bias_list is empty or the master-bias can not be made, the master\
+    of the nearest night is taken from the calibration library.
 
     Parameters
     ----------
@@ -109,6 +115,23 @@ def bias_correction(bias_list, list_file, CCD, location='',
             location of the files if it is not in the working directory.
         prefix_string: str
             prefix which add after doing bias correction to files.
+        inventory    : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
+        method       : str ('iraf' or 'numpy')
+            Make and subtract master-bias with IRAF zerocombine and imarith,\
+            or with combine_frames and subtract_bias. IRAF by default, until\
+            the numpy master-bias is compared with zerocombine on a real\
+            night (combine.compare_images).
+        library      : CalibrationLibrary
+            Library where the master-bias is stored, or taken from.
+        date         : str
+            Date of the night 'YYYY-MM-DD', needed for the library.
+        workers      : int
+            Number of processes subtracting the master-bias ('numpy'
+            method), all CPUs if None. One by default: on one CPU, 500
+            frames of 1024x1024 take 5.3 s with one process and 5.5 s with
+            two (bias.benchmark_scaling), more CPUs are not measured yet.
     Returns
     -------
         none
@@ -133,29 +156,67 @@ def bias_correction(bias_list, list_file, CCD, location='',
             for file in bias_list:
                 f.write(location+"/"+file+str([index])+'\n')
 
-    remove_file(str(master_bias))
-
-    task = iraf.noao.imred.ccdred.zerocombine
-    task.unlearn()
-    task(input='@' + pathloc, output=str(master_bias), combine='median',
-         reject='avsigclip', ccdtype='', process='no', delete='no',
-         rdnoise=float(CCD.read_noise), gain=float(CCD.ccd_gain))
+    made = False
+    if len(bias_list) == 0:
+        print("Bias list is empty")
+    elif method == 'iraf':
+        remove_file(str(master_bias)+'.fits')
+        task = iraf.noao.imred.ccdred.zerocombine
+        task.unlearn()
+        task(input='@' + pathloc, output=str(master_bias), combine='median',
+             reject='avsigclip', ccdtype='', process='no', delete='no',
+             rdnoise=float(CCD.read_noise), gain=float(CCD.ccd_gain))
+        made = True
+    else:
+        # Bias frames are stored in Backup, so bias frames added in a rerun
+        # are folded into the master-bias. An existing master-bias is kept
+        # if it is made from the same frames.
+        state_file = os.path.join(location, 'Backup', 'master-bias-state.npz')
+        try:
+            update_master([os.path.join(location, file)
+                           for file in bias_list],
+                          str(master_bias)+'.fits', state_file, index=index)
+            made = True
+        except (IOError, OSError, ValueError) as error:
+            print(error)
+            print("ERROR: master-bias is not made from the bias files")
+
+    use_library = library is not None and date is not None
+    if made and use_library:
+        library.store('bias', CCD.profile.mode, date, str(master_bias)+'.fits')
+    elif not made:
+        library_bias = None
+        if use_library:
+            library_bias, days = library.lookup('bias', CCD.profile.mode, date)
+        if library_bias is None:
+            raise ValueError("No master-bias for this night, please check "
+                             "header of bias files")
+        print("Using "+os.path.basename(library_bias)+" from the calibration "
+              "library ("+str(days)+" days apart)")
+        shutil.copy(library_bias, str(master_bias)+'.fits')
 
     # Bias correction using master_bias
-    task = iraf.images.imutil.imarith
-    task.unlearn()
+    created = [str(prefix_string) + str(file_name) for file_name in list_file]
+    if method == 'iraf':
+        task = iraf.images.imutil.imarith
+        task.unlearn()
+
+        for file_name, output_file_name in zip(list_file, created):
+            output_file_name = os.path.join(location, output_file_name)
+            file_name = os.path.join(location, file_name)
+            file_name_1 = file_name+str([index])
+            remove_file(str(output_file_name))
+            task(operand1=str(file_name_1), op='-', operand2=str(master_bias),
+                 result=str(output_file_name))
+    else:
+        subtract_bias([os.path.join(location, file) for file in list_file],
+                      str(master_bias)+'.fits',
+                      [os.path.join(location, file) for file in created],
+                      index=index, workers=workers)
 
+    # removing the older files which is needed to bias correct.
     for file_name in list_file:
-        output_file_name = str(prefix_string) + str(file_name)
-        output_file_name = os.path.join(location, output_file_name)
-        file_name = os.path.join(location, file_name)
-        file_name_1 = file_name+str([index])
-        remove_file(str(output_file_name))
-        task(operand1=str(file_name_1), op='-', operand2=str(master_bias),
-             result=str(output_file_name))
-
-        # removing the older files which is needed to bias correct.
-        remove_file(str(file_name))
+        remove_file(str(os.path.join(location, file_name)))
 
     # Removing the older bias files
     for file_name in bias_list:
@@ -163,12 +224,20 @@ def bias_correction(bias_list, list_file, CCD, location='',
 
     # Backup the master_bias
     pathloc = os.path.join(location, 'Backup')
-    os.makedirs(pathloc)
+    if not os.path.isdir(pathloc):
+        os.makedirs(pathloc)
     print("copying master-bias to "+location+"/Backup")
-    shutil.move(location+'/'+'master-bias.fits', pathloc)
+    shutil.move(os.path.join(location, 'master-bias.fits'),
+                os.path.join(pathloc, 'master-bias.fits'))
+
+    if inventory is not None:
+        inventory.update(created=created,
+                         removed=list(list_file) + list(bias_list) +
+                         ['bias_list', 'master-bias.fits'])
 
 
-def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
+def cosmic_correction(cosmic_curr_list, location='', prefix_string='c',
+                      inventory=None):
     """
     Corrects for cosmic rays in the OBJECT image.
 
@@ -180,6 +249,9 @@ def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
             Location of the files if it is not in the working directory.
         prefix_string   : str
             Prefix to distinguish FITS file from the original FITS file
+        inventory       : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
     Return
     ------
         cr_check_list   : list
@@ -222,11 +294,16 @@ def cosmic_correction(cosmic_curr_list, location='', prefix_string='c'):
         # removing the older files which is needed to bias correct.
         remove_file(str(file_name))
 
+    if inventory is not None:
+        inventory.update(created=cr_currected_list + cr_check_list,
+                         removed=cosmic_curr_list)
+
     return cr_check_list
 
 
 def flat_correction(flat_list, file_list, grism, CCD, location='',
-                    prefix_string='f'):
+                    prefix_string='f', association=None, inventory=None,
+                    mask=None):
     """
     Flat correction to object files.
 
@@ -242,12 +319,27 @@ def flat_correction(flat_list, file_list, grism, CCD, location='',
             Type of grism used.
         prefix_string : str
             Prefix added after flat fielding.
+        association   : CalibrationIndex
+            Time index of calibrations. If provided, only the flats of
+            flat_list taken with the apertures of the object files are used,
+            all of flat_list if none of them match.
+        inventory     : Inventory
+            Inventory of the location, updated with the created and removed
+            files.
+        mask          : numpy.ndarray
+            Bad-pixel mask (True for bad pixels), interpolated over in the
+            flat corrected files.
     Returns
     -------
         flat_curr_list: list
             List of flat corrected files.
         none
     """
+    if association is not None:
+        matched = association.flat_list(grism, file_list)
+        matched = [flat for flat in flat_list if flat in matched]
+        if len(matched) != 0:
+            flat_list = matched
     if location != '':
         pathloc = os.path.join(os.getcwd(), location,
                                'flat_corr_list'+str(grism))
@@ -317,22 +409,35 @@ def flat_correction(flat_list, file_list, grism, CCD, location='',
 
         task1(operand1=file_name, op='/', operand2=response_file,
               result=output_file_name2)
+        if mask is not None:
+            fix_file(output_file_name2 + '.fits', mask)
 
         remove_file(str(file_name))
 
     # Creating backup files
     backuploc = os.path.join(location, 'Backup')
+    if not os.path.isdir(backuploc):
+        os.makedirs(backuploc)
     # Location changes here caution!!!
     print("copying master-flat"+str(grism)+"to "+location+"/Backup")
     # backup the master_flat
-    shutil.move(location+'/'+'master-flat'+str(grism)+'.fits', backuploc)
+    shutil.move(os.path.join(location, 'master-flat'+str(grism)+'.fits'),
+                os.path.join(backuploc, 'master-flat'+str(grism)+'.fits'))
     print("copying nflat"+str(grism)+"to "+location+"/Backup")
-    shutil.move(location+'/'+'nflat'+str(grism)+'.fits', backuploc)
+    shutil.move(os.path.join(location, 'nflat'+str(grism)+'.fits'),
+                os.path.join(backuploc, 'nflat'+str(grism)+'.fits'))
+
+    if inventory is not None:
+        # imarith adds the .fits extension to the output files
+        inventory.update(created=[file + '.fits' for file in flat_curr_list],
+                         removed=list(flat_list) + list(file_list) +
+                         ['flat_corr_list'+str(grism)])
 
     return flat_curr_list
 
 
-def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
+def spectral_extraction(obj_list, lamp_list, grism, CCD, location='',
+                        association=None, inventory=None, mask=None):
     """
     Spectral extraction and calibration of wavelength. After\
     running this function a header term "Waveleng" added after successfully\
@@ -344,6 +449,14 @@ def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
         List of files which need to do spectral extraction
     location: str
         Location of the files if it is not in the working directory.
+    association: CalibrationIndex
+        Time index of calibrations. Each object uses the lamp taken nearest
+        in time, otherwise the first lamp of lamp_list is used.
+    inventory: Inventory
+        Inventory of the location, updated with the created files.
+    mask: numpy.ndarray
+        Bad-pixel mask (True for bad pixels), interpolated over in the object
+        files before extraction.
     """
     if not os.path.isdir(os.path.join(location, 'lamp')):
         if CCD.ccd == "HFOSC":
@@ -376,9 +489,11 @@ def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
     if not os.path.isdir(os.path.join(location, 'database')):
         os.makedirs(os.path.join(location, 'database'))
 
+    created = []
     try:
         shutil.copy(os.path.join(Databasefilepath, gr7_lamp),
                     os.path.join(location, gr7_lamp))
+        created.append(gr7_lamp)
         shutil.copy(os.path.join(Databasepath, gr7_lamp_id),
                     os.path.join(location, 'database', gr7_lamp_id))
     except IOError as e:
@@ -388,18 +503,30 @@ def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
     try:
         shutil.copy(os.path.join(Databasefilepath, gr8_lamp),
                     os.path.join(location, gr8_lamp))
+        created.append(gr8_lamp)
         shutil.copy(os.path.join(Databasepath, gr8_lamp_id),
                     os.path.join(location, 'database', gr8_lamp_id))
     except IOError as e:
         print(e)
         print("ERROR: gr8 lamp files are not copied")
 
+    lamp_path = os.path.join(os.getcwd(), location)
     if location != '':
-        lamp = os.path.join(os.getcwd(), location, lamp_list[0])
         iraf.cd(os.path.join(os.getcwd(), location))
 
     for file_name in obj_list:
+        lamp_name, dt = None, None
+        if association is not None:
+            lamp_name, dt = association.nearest('lamp', file_name, grism)
+        if lamp_name is None:
+            lamp_name = lamp_list[0]
+        lamp = os.path.join(lamp_path, lamp_name)
+        if dt is not None:
+            print("Lamp for "+str(file_name)+" : "+str(lamp_name) +
+                  " ({:.1f} min apart)".format(dt / 60.0))
         # obj_name = os.path.join(os.getcwd(), location, file_name)
+        if mask is not None:
+            fix_file(os.path.join(lamp_path, file_name), mask)
 
         print('''
         Following keys are for aperture selection.
@@ -493,8 +620,7 @@ def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
                    os.path.splitext(file_name)[0]+'_lamp.fits', add=1, ver=0)
 
         file_name_chk = os.path.join(location, file_name)
-        hdul = fits.open(file_name_chk)  # HDU_List
-        hdr = hdul[0].header             # Primary HDU header
+        hdr = read_header(file_name_chk)  # Primary HDU header
         OBJECT = hdr['OBJECT']
         file_name_out = str(OBJECT)+'_w'+os.path.splitext(file_name)[0]+'.ms.fits'
         # Doing dispersion correction using dispcor (w - wavelength calibration)
@@ -504,6 +630,12 @@ def spectral_extraction(obj_list, lamp_list, grism, CCD, location=''):
         # Add a header indicating that wavelength calibration is done.
         iraf.hedit(file_name_out, "Waveleng", "done", add=1, ver=0)
 
+        created += [os.path.splitext(file_name)[0]+'.ms.fits',
+                    os.path.splitext(file_name)[0]+'_lamp.fits',
+                    file_name_out]
+        if inventory is not None:
+            inventory.update(created=created)
+
 
 def flux_calibrate(obj_list, location, default_path, CCD, prefix_string='F_'):
     """
@@ -550,8 +682,7 @@ def flux_calibrate(obj_list, location, default_path, CCD, prefix_string='F_'):
     std_stars = []
     for file_name in obj_list:
         file_name_chk = os.path.join(location, file_name)
-        hdul = fits.open(file_name_chk)  # HDU_List
-        hdr = hdul[0].header             # Primary HDU header
+        hdr = read_header(file_name_chk)  # Primary HDU header
         OBJECT = hdr['OBJECT']
         aperture = hdr['APERTUR']
         try:
@@ -0,0 +1,102 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the tests of the frame catalog on synthetic frames.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import pytest
+import numpy as np
+from astropy.io import fits
+
+from hfoscsp.catalog import FrameCatalog
+from hfoscsp.catalog import CATALOG_FILE
+from hfoscsp.file_management import SetCCD
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+def write_frame(file_name, shape=(100, 20), instrument='HFOSC',
+                binning='1 1'):
+    """Write a synthetic frame with the image in the primary HDU."""
+    hdu = fits.PrimaryHDU(np.zeros(shape, dtype=np.int16))
+    hdu.header['INSTRUME'] = instrument
+    hdu.header['CCDSUM'] = binning
+    hdu.header['OBJECT'] = 'Bias_Snt'
+    hdu.writeto(file_name)
+
+
+def test_scan_throughput(tmp_path):
+    file_list = ['frame{:02d}.fits'.format(i) for i in range(12)]
+    for file_name in file_list:
+        write_frame(os.path.join(str(tmp_path), file_name))
+
+    catalog = FrameCatalog(file_list, str(tmp_path), workers=4)
+    assert catalog.scan['frames'] == 12
+    assert catalog.scan['workers'] == 4
+    assert catalog.scan['frames_per_s'] > 0
+
+    # nothing is read again, the last scan is kept
+    assert catalog.update(file_list) == []
+    assert catalog.scan['frames'] == 12 and catalog.n_scans == 1
+
+
+def test_image_hdu(tmp_path):
+    location = str(tmp_path)
+    write_frame(os.path.join(location, 'cframe.fits'), instrument='HFOSC2')
+    with fits.open(os.path.join(location, 'cframe.fits'), mode='append') as \
+            hdu_list:  # cosmic ray mask table, as written by la_cosmic
+        hdu_list.append(fits.BinTableHDU.from_columns(
+            [fits.Column(name='PIXELS', format='8J', array=np.zeros((3, 8)))],
+            name='CRMASK'))
+    hdu = fits.ImageHDU(np.zeros((100, 20), dtype=np.int16))
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(
+        os.path.join(location, 'frame2.fits'))
+
+    catalog = FrameCatalog(['cframe.fits', 'frame2.fits'], location)
+    for file_name in ['cframe.fits', 'frame2.fits']:
+        assert catalog.value(file_name, 'NAXIS1') == 20
+        assert catalog.value(file_name, 'NAXIS2') == 100
+
+
+def test_manifest_without_index(tmp_path):
+    location = str(tmp_path)
+    file_list = ['spec.fits', 'phot.fits']
+    write_frame(os.path.join(location, 'spec.fits'))
+    write_frame(os.path.join(location, 'phot.fits'), shape=(50, 50))
+
+    catalog = FrameCatalog(file_list, location)
+    catalog.record([('phot.fits', 'phot', 1.0, False)])
+    assert catalog.selected(file_list) == ['spec.fits']
+    assert not os.path.exists(os.path.join(location, CATALOG_FILE))
+
+    catalog = FrameCatalog(file_list, location, persistent=True)
+    catalog.record([('spec.fits', 'spec', 5.0, True),
+                    ('phot.fits', 'phot', 1.0, False)])
+    catalog.cache.close()
+    mtime = os.path.getmtime(os.path.join(location, CATALOG_FILE))
+
+    # the split recorded by the driver is used, the index is not changed
+    catalog = FrameCatalog(file_list, location)
+    assert catalog.selected(file_list) == ['spec.fits']
+    catalog.record([('phot.fits', 'phot', 1.0, True)])
+    assert os.path.getmtime(os.path.join(location, CATALOG_FILE)) == mtime
+
+
+def test_mixed_modes_refused(tmp_path):
+    file_list = ['frame{:02d}.fits'.format(i) for i in range(4)]
+    for i, file_name in enumerate(file_list):
+        write_frame(os.path.join(str(tmp_path), file_name),
+                    binning='1 1' if i < 3 else '2 2')
+    catalog = FrameCatalog(file_list, str(tmp_path))
+
+    CCD = SetCCD(file_list[:3], str(tmp_path), catalog=catalog)
+    assert CCD.profile.mode == ('HFOSC', '1 1', '')
+    with pytest.raises(ValueError):
+        SetCCD(file_list, str(tmp_path), catalog=catalog)
+
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,108 @@
+# -------------------------------------------------------------------------------------------------------------------- #
+"""
+This script is written for HFOSC spectroscopic-Pipeline.
+
+It is containing the tests of the master-bias combiner on synthetic bias
+frames.
+"""
+__author__ = 'Sonith L.S'
+__contact__ = 'sonith.ls@iiap.res.in'
+__version__ = '1.0.0'
+# -------------------------------------------------------------------------------------------------------------------- #
+import os
+import numpy as np
+from astropy.io import fits
+
+from hfoscsp.combine import combine_frames
+from hfoscsp.combine import update_master
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+def write_bias(location, n_frames, shape=(40, 30), seed=0, start=0):
+    """
+    Write synthetic raw bias frames as 16 bit integers with BZERO = 32768.
+
+    Returns
+    -------
+        file_list: list
+            List of the bias frames with complete path.
+        data     : numpy.ndarray
+            Scaled images of the frames as (frame, line, column).
+    """
+    rng = np.random.RandomState(seed)
+    ramp = np.linspace(0.0, 20.0, shape[1])[None, :]
+    file_list = []
+    data = []
+    for i in range(n_frames):
+        image = np.round(rng.normal(1200.0, 5.0, shape) + ramp)
+        if i % 3 == 0:
+            image[rng.randint(shape[0]), rng.randint(shape[1])] += 3000.0
+        hdu = fits.PrimaryHDU((image - 32768).astype(np.int16))
+        hdu.header['BZERO'] = 32768
+        file_name = os.path.join(str(location),
+                                 'bias{:03d}.fits'.format(start + i))
+        hdu.writeto(file_name)
+        file_list.append(file_name)
+        data.append(image)
+    return file_list, np.array(data, dtype=np.float32)
+
+
+def test_combine_scaled_frames(tmp_path):
+    file_list, data = write_bias(tmp_path, 5)
+    output = os.path.join(str(tmp_path), 'master-bias.fits')
+
+    combine_frames(file_list, output, reject='none', memory_limit=4096)
+    assert np.array_equal(fits.getdata(output), np.median(data, axis=0))
+
+    combine_frames(file_list, output, combine='average', reject='none')
+    assert np.allclose(fits.getdata(output), data.mean(axis=0), atol=1e-3)
+
+
+def test_combine_rejects_cosmic_rays(tmp_path):
+    file_list, data = write_bias(tmp_path, 9)
+    output = os.path.join(str(tmp_path), 'master-bias.fits')
+
+    combine_frames(file_list, output, combine='average')
+    master = fits.getdata(output)
+    assert np.abs(master - np.median(data, axis=0)).max() < 20.0
+
+
+def test_update_master_equals_full_combine(tmp_path):
+    night = tmp_path / 'night'
+    night.mkdir()
+    first, data = write_bias(night, 7)
+    late = write_bias(night, 6, seed=1, start=7)[0]
+    output = str(night / 'master-bias.fits')
+    state_file = str(night / 'Backup' / 'master-bias-state.npz')
+
+    assert update_master(first, output, state_file) == 7
+    for file_name in first:  # bias frames are removed after the correction
+        os.rename(file_name, str(tmp_path / os.path.basename(file_name)))
+    assert update_master(late, output, state_file) == 13
+
+    reference = str(tmp_path / 'reference.fits')
+    combine_frames([str(tmp_path / os.path.basename(file_name))
+                    for file_name in first] + late, reference)
+    assert np.array_equal(fits.getdata(output), fits.getdata(reference))
+    assert fits.getheader(output)['NCOMBINE'] == 13
+
+
+def test_update_master_up_to_date(tmp_path):
+    file_list = write_bias(tmp_path, 5)[0]
+    output = str(tmp_path / 'master-bias.fits')
+    state_file = str(tmp_path / 'master-bias-state.npz')
+
+    update_master(file_list, output, state_file)
+    mtime = os.path.getmtime(output)
+    os.utime(output, (mtime - 10, mtime - 10))
+    assert update_master(file_list, output, state_file) == 5
+    assert os.path.getmtime(output) == mtime - 10
+
+    os.remove(output)
+    update_master(file_list, output, state_file)
+    reference = str(tmp_path / 'reference.fits')
+    combine_frames(file_list, reference)
+    assert np.array_equal(fits.getdata(output), fits.getdata(reference))
+
+# -------------------------------------------------------------------------------------------------------------------- #